@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+""" benchmark of kind_helper.py itself, runs it against fake docker, kind and kubectl.
+
+The fake tools (bench/fake) and the fake api server (bench/fake_apiserver.py) answer at once
+(or after the configured latency), so that the time measured is the overhead of the script:
+its startup, the processes it starts, the api requests it sends and how this scales with the
+number of nodes. The results are appended to a history file (one json object per line);
+--compare checks the results against the last entry with the same configuration and
+fails if one of them got worse.
+"""
+
+import argparse
+import datetime
+import fcntl
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HELPER = os.path.join(os.path.dirname(BENCH_DIR), "kind_helper.py")
+
+# metrics that count something; any increase is a regression.
+COUNT_METRICS = ["forks", "processes", "api_requests"]
+
+
+class FakeEnvironment:
+    """ state directory, PATH with the fake tools and the fake api server of a benchmark run """
+
+    def __init__(self, cmd_args):
+        self.cmd_args = cmd_args
+        self.base_dir = tempfile.mkdtemp(prefix="kind-helper-bench-")
+        self.state_dir = os.path.join(self.base_dir, "state")
+        self.helper_dir = os.path.join(self.base_dir, "kind-tmp-dir")
+        os.makedirs(self.state_dir)
+
+        self.server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_apiserver.py"), \
+                "--state", self.state_dir, \
+                "--node-ready-delay", str(cmd_args.node_ready_delay), \
+                "--node-ready-stagger", str(cmd_args.node_ready_stagger)], stdout=subprocess.PIPE)
+        self.api_url = "http://127.0.0.1:{}".format(self.server.stdout.readline().decode().strip())
+
+        self.env = dict(os.environ)
+        self.env["PATH"] = os.path.join(BENCH_DIR, "fake") + os.pathsep + self.env.get("PATH", "")
+        self.env["FAKE_STATE"] = self.state_dir
+        self.env["FAKE_API_URL"] = self.api_url
+        self.env["FAKE_LATENCY"] = str(cmd_args.latency)
+        self.env["FAKE_KIND_CREATE_LATENCY"] = str(cmd_args.kind_create_latency)
+        self.env["FAKE_FAIL"] = " ".join(cmd_args.fail)
+
+    def close(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def forks(self):
+        """ number of calls of the fake tools so far, per tool """
+        counts = {}
+        try:
+            with open(os.path.join(self.state_dir, "calls.log"), "r") as input_file:
+                for line in input_file:
+                    tool = line.split(" ", 1)[0]
+                    counts[tool] = counts.get(tool, 0) + 1
+        except OSError:
+            pass
+        return counts
+
+    def api_requests(self):
+        with urllib.request.urlopen(self.api_url + "/_stats") as response:
+            return sum(json.loads(response.read()).values())
+
+    def run_helper(self, args):
+        """ runs kind_helper.py, returns the measurements of the run """
+        timings_file = os.path.join(self.base_dir, "timings.json")
+        if os.path.exists(timings_file):
+            os.remove(timings_file)
+
+        forks_before = self.forks()
+        requests_before = self.api_requests()
+        start_time = time.time()
+        process = subprocess.run([sys.executable, HELPER, "--dir", self.helper_dir, \
+                "--timings-json", timings_file] + args, env=self.env, \
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        seconds = time.time() - start_time
+        forks_after = self.forks()
+
+        result = {
+            "seconds": seconds,
+            "exit_code": process.returncode,
+            "forks": sum(forks_after.values()) - sum(forks_before.values()),
+            "forks_per_tool": {tool: count - forks_before.get(tool, 0) \
+                    for tool, count in forks_after.items() if count != forks_before.get(tool, 0)},
+            "api_requests": self.api_requests() - requests_before,
+        }
+        if self.cmd_args.verbose or (process.returncode != 0 and len(self.cmd_args.fail) == 0):
+            print(process.stdout.decode("utf-8", "replace"))
+
+        try:
+            with open(timings_file, "r") as input_file:
+                phases = json.load(input_file)["phases"]
+            result["processes"] = sum(len(phase["processes"]) for phase in phases)
+            result["phases"] = {phase["name"]: phase["seconds"] for phase in phases}
+        except (OSError, ValueError, KeyError):
+            pass
+        return result
+
+def summarize(name, runs):
+    """ the time of a scenario is the median of its runs, the counts are those of the last run """
+    result = dict(runs[-1])
+    result["seconds"] = statistics.median(run["seconds"] for run in runs)
+    result["runs"] = [run["seconds"] for run in runs]
+    result.pop("phases", None)
+    print("{:<16} {:>8.3f}s  forks {:>4}  api requests {:>4}  exit {}".format(name, \
+            result["seconds"], result["forks"], result["api_requests"], result["exit_code"]))
+    return result
+
+def run_pool_refill(fake):
+    """ claims the cluster of a pool without ingress, the background fill must replace it """
+    pool_file = os.path.join(fake.helper_dir, "pool", "pool.json")
+    fake.run_helper(["--pool-fill", "--pool-size", "1"])
+    start_time = time.time()
+    result = fake.run_helper(["--pool-claim"])
+
+    refilled = False
+    while not refilled and time.time() < start_time + 30:
+        time.sleep(0.05)
+        try:
+            with open(pool_file, "r") as input_file:
+                refilled = any(entry["state"] == "ready" for entry in json.load(input_file)["clusters"].values())
+        except (OSError, ValueError):
+            pass
+    result["seconds"] = time.time() - start_time
+    if not refilled:
+        result["exit_code"] = 1
+        with open(os.path.join(fake.helper_dir, "pool", "fill.log"), "r") as input_file:
+            print("pool was not refilled, fill.log:\n{}".format(input_file.read()[-2000:]))
+    fake.run_helper(["--pool-drain"])
+    # the background processes (fill, deletion) must not count in the next scenario.
+    for lock_file_name in [os.path.join(fake.helper_dir, "pool", "fill.lock")] + \
+            glob.glob(os.path.join(fake.helper_dir, "teardown-*.lock")):
+        try:
+            lock_file = open(lock_file_name, "r")
+        except FileNotFoundError:
+            # the deletion removes its lock file when it is done
+            continue
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return result
+
+def run_benchmark(cmd_args):
+    fake = FakeEnvironment(cmd_args)
+    results = {}
+    try:
+        # --stop without clusters runs check_prerequisites: tools-cold probes the tools,
+        # tools-warm uses the tools manifest of the run before.
+        for name, args in [("startup", ["--help"]), \
+                ("tools-cold", ["--refresh-tools", "--stop"]), \
+                ("tools-warm", ["--stop"]), \
+                ("kubectl", ["-c", "version"])]:
+            results[name] = summarize(name, [fake.run_helper(args) for _ in range(cmd_args.repeat)])
+
+        for workers in cmd_args.workers:
+            start_runs = []
+            stop_runs = []
+            for _ in range(cmd_args.repeat):
+                start_runs.append(fake.run_helper(["--start", "--workers", str(workers), \
+                        "--masters", str(cmd_args.masters)] + cmd_args.start_args))
+                start_runs[-1]["wait_seconds"] = \
+                        start_runs[-1].get("phases", {}).get("kind: wait for nodes")
+                stop_runs.append(fake.run_helper(["--stop"]))
+
+            results["start-w{}".format(workers)] = summarize("start-w{}".format(workers), start_runs)
+            results["stop-w{}".format(workers)] = summarize("stop-w{}".format(workers), stop_runs)
+
+        # start of a cluster that is running with the same spec
+        fake.run_helper(["--start", "--reuse"])
+        results["start-reuse"] = summarize("start-reuse", \
+                [fake.run_helper(["--start", "--reuse"]) for _ in range(cmd_args.repeat)])
+
+        # claim and background refill of a pool (without ingress)
+        results["pool-refill"] = summarize("pool-refill", \
+                [run_pool_refill(fake) for _ in range(cmd_args.repeat)])
+
+        archive = os.path.join(fake.base_dir, "diagnostics.tar.gz")
+        results["diagnostics"] = summarize("diagnostics", \
+                [fake.run_helper(["--diagnostics", archive]) for _ in range(cmd_args.repeat)])
+        fake.run_helper(["--stop"])
+    finally:
+        fake.close()
+    return results
+
+def benchmark_config(cmd_args):
+    return {
+        "repeat": cmd_args.repeat,
+        "masters": cmd_args.masters,
+        "workers": cmd_args.workers,
+        "latency": cmd_args.latency,
+        "kind_create_latency": cmd_args.kind_create_latency,
+        "node_ready_delay": cmd_args.node_ready_delay,
+        "node_ready_stagger": cmd_args.node_ready_stagger,
+        "fail": cmd_args.fail,
+        "start_args": cmd_args.start_args,
+    }
+
+def git_commit():
+    process = subprocess.run(["git", "-C", os.path.dirname(HELPER), "rev-parse", "--short", "HEAD"], \
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return process.stdout.decode("utf-8").strip() if process.returncode == 0 else ""
+
+def load_history(history_file):
+    entries = []
+    try:
+        with open(history_file, "r") as input_file:
+            for line in input_file:
+                if line.strip():
+                    entries.append(json.loads(line))
+    except OSError:
+        pass
+    return entries
+
+def compare(cmd_args, entry, history):
+    """ returns the regressions of entry against the last entry of history with the same config;
+    without such an entry there is nothing to compare with, that is an error too.
+    """
+    previous = next((old for old in reversed(history) if old["config"] == entry["config"]), None)
+    if previous is None:
+        return ["no earlier result with the same configuration in {} (record a baseline first: \
+make bench-baseline)".format(cmd_args.history)]
+
+    regressions = []
+    for name, result in entry["results"].items():
+        old = previous["results"].get(name)
+        if old is None:
+            continue
+        if result["seconds"] > old["seconds"] * (1 + cmd_args.threshold) and \
+                result["seconds"] - old["seconds"] > cmd_args.min_delta:
+            regressions.append("{}: {:.3f}s, was {:.3f}s".format(name, result["seconds"], old["seconds"]))
+        for metric in COUNT_METRICS:
+            if result.get(metric) is not None and old.get(metric) is not None and \
+                    result[metric] > old[metric]:
+                regressions.append("{}: {} {}, was {}".format(name, metric, result[metric], old[metric]))
+
+    print("compared with {} of {}".format(previous.get("commit", ""), previous["date"]))
+    return regressions
+
+def parse_cmd_line():
+    parser = argparse.ArgumentParser(description=__doc__, \
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], dest='workers', \
+            help='the number of worker nodes of the start/stop runs')
+    parser.add_argument('--masters', type=int, default=1, dest='masters', \
+            help='number of master nodes of the start/stop runs')
+    parser.add_argument('--repeat', type=int, default=3, dest='repeat', \
+            help='number of runs of each scenario, the median time is reported')
+    parser.add_argument('--latency', type=float, default=0, dest='latency', \
+            help='seconds each call of a fake tool takes')
+    parser.add_argument('--kind-create-latency', type=float, default=0.1, \
+            dest='kind_create_latency', help='seconds kind create cluster takes per node')
+    parser.add_argument('--node-ready-delay', type=float, default=0.5, dest='node_ready_delay', \
+            help='seconds after cluster creation until the first node is ready')
+    parser.add_argument('--node-ready-stagger', type=float, default=0.05, \
+            dest='node_ready_stagger', help='seconds between two nodes becoming ready')
+    parser.add_argument('--fail', type=str, nargs='+', default=[], dest='fail', \
+            help='fake calls that fail: kind-create, kind-delete, docker-run, docker-network, kubectl ...')
+    parser.add_argument('--start-args', type=str, nargs='+', default=[], dest='start_args', \
+            help='additional options of kind_helper.py --start (i.e. --wait-system-pods)')
+    parser.add_argument('--history', type=str, default=os.path.join(BENCH_DIR, "history.jsonl"), \
+            dest='history', help='file with the results of earlier runs, one json object per line')
+    parser.add_argument('--no-record', action='store_true', default=False, dest='no_record', \
+            help='do not add the results to the history file')
+    parser.add_argument('--compare', action='store_true', default=False, dest='compare', \
+            help='exit with status 1 if a result is worse than the last result with the same options, \
+or if there is no such result')
+    parser.add_argument('--threshold', type=float, default=0.25, dest='threshold', \
+            help='with --compare: relative increase of a time that counts as regression')
+    parser.add_argument('--min-delta', type=float, default=0.05, dest='min_delta', \
+            help='with --compare: a time increase of less seconds is not a regression')
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, dest='verbose', \
+            help='show the output of kind_helper.py')
+    return parser.parse_args()
+
+def main():
+    cmd_args = parse_cmd_line()
+    history = load_history(cmd_args.history)
+
+    entry = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": benchmark_config(cmd_args),
+        "results": run_benchmark(cmd_args),
+    }
+
+    regressions = compare(cmd_args, entry, history) if cmd_args.compare else []
+
+    if not cmd_args.no_record:
+        with open(cmd_args.history, "a") as output_file:
+            output_file.write(json.dumps(entry) + "\n")
+
+    # without --fail, every scenario must succeed.
+    failed = [name for name, result in entry["results"].items() if result["exit_code"] != 0]
+    if len(cmd_args.fail) == 0 and len(failed) != 0:
+        regressions.append("failed scenarios: {}".format(" ".join(failed)))
+
+    if len(regressions) != 0:
+        print("*** regressions ***")
+        for regression in regressions:
+            print(regression)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+# sourced by the fake docker, kind and kubectl of the benchmark.
+#
+# FAKE_STATE      directory of the fake state, every call is logged to $FAKE_STATE/calls.log
+# FAKE_LATENCY    seconds each call takes (default 0)
+# FAKE_FAIL       space separated list of the calls that fail, i.e. "kind-create docker-run"
+
+fake_call() {
+    local tool="$1"
+    shift
+    echo "${tool} $*" >>"${FAKE_STATE}/calls.log"
+    if [[ ${FAKE_LATENCY:-0} != 0 ]]; then
+        sleep "${FAKE_LATENCY}"
+    fi
+}
+
+fake_fail_if() {
+    local name="$1"
+    for fail in ${FAKE_FAIL:-}; do
+        if [[ $fail == "$name" ]]; then
+            echo "fake failure of ${name}" >&2
+            exit 1
+        fi
+    done
+}
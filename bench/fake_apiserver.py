@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+""" fake kubernetes api server for the benchmark.
+
+Serves the nodes (and the kube-system pods) of the clusters created by the fake kind;
+the nodes of cluster <name> are listed in <state>/clusters/<name>, the api of the cluster
+is under the path /<name>. A node becomes Ready --node-ready-delay seconds after its cluster
+was created, each further node --node-ready-stagger seconds later.
+The body of a patch is kept as the object, later GET requests of the path return it.
+The other collections are empty, the log of a container is a few lines of text.
+GET /_stats returns the number of requests per method.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *_args):
+        pass
+
+    def count(self, key):
+        with self.server.lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + 1
+
+    def send_json(self, obj, status=200):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, text):
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def objects(self, cluster, collection):
+        """ returns (time when ready, object) of the nodes or pods of a cluster """
+        file_name = os.path.join(self.server.state_dir, "clusters", cluster)
+        try:
+            created = os.stat(file_name).st_mtime
+            with open(file_name, "r") as input_file:
+                nodes = input_file.read().split()
+        except OSError:
+            return []
+
+        ready_times = [created + self.server.node_ready_delay + index * self.server.node_ready_stagger \
+                for index in range(len(nodes))]
+        if collection == "nodes":
+            return [(ready_time, {"metadata": {"name": node, "labels": {}}}) \
+                    for node, ready_time in zip(nodes, ready_times)]
+
+        pods = []
+        for node, ready_time in zip(nodes, ready_times):
+            pods.append((ready_time, self.pod("kube-proxy-" + node, "kube-proxy", {"k8s-app": "kube-proxy"})))
+            pods.append((ready_time, self.pod("kindnet-" + node, "kindnet-cni", {"app": "kindnet"})))
+        if len(ready_times) != 0:
+            pods.append((max(ready_times), self.pod("coredns", "coredns", {"k8s-app": "kube-dns"})))
+        return pods
+
+    @staticmethod
+    def pod(name, container, labels):
+        return {"metadata": {"name": name, "namespace": "kube-system", "labels": labels}, \
+                "spec": {"containers": [{"name": container}]}}
+
+    @staticmethod
+    def with_status(ready_time, obj, now):
+        obj = dict(obj)
+        obj["status"] = {"conditions": [{"type": "Ready", \
+                "status": "True" if now >= ready_time else "False"}]}
+        return obj
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/_stats":
+            with self.server.lock:
+                return self.send_json(dict(self.server.stats))
+
+        if re.match(r'^/[^/]+/api/v1/namespaces/[^/]+/pods/[^/]+/log$', url.path):
+            self.count("GET")
+            data = "".join("log line {} of {}\n".format(index, url.path) for index in range(10))
+            return self.send_text(data)
+
+        match = re.match(r'^/([^/]+)/api/v1/(nodes|pods|namespaces/kube-system/pods)$', url.path)
+        if match is None and re.match(r'^/[^/]+/api/v1/namespaces$', url.path):
+            self.count("GET")
+            return self.send_json({"items": [{"metadata": {"name": name}} \
+                    for name in ("default", "kube-system")]})
+        if match is None and re.match(r'^/[^/]+/(api/v1|apis/[^/]+/[^/]+)/[a-z]+$', url.path):
+            self.count("GET")
+            return self.send_json({"items": []})
+        if match is None:
+            self.count("GET")
+            with self.server.lock:
+                obj = self.server.objects.get(url.path)
+            if obj is None or not os.path.exists(os.path.join(self.server.state_dir, "clusters", \
+                    url.path.split("/")[1])):
+                return self.send_json({"kind": "Status", "code": 404}, 404)
+            return self.send_json(obj)
+
+        cluster, collection = match.group(1), match.group(2).split("/")[-1]
+        if params.get("watch", ["0"])[0] not in ("1", "true"):
+            self.count("GET")
+            now = time.time()
+            return self.send_json({"items": [self.with_status(ready_time, obj, now) \
+                    for ready_time, obj in self.objects(cluster, collection)]})
+
+        self.count("WATCH")
+        self.watch(cluster, collection, float(params.get("timeoutSeconds", ["30"])[0]))
+
+    def watch(self, cluster, collection, timeout):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(event_type, obj):
+            data = (json.dumps({"type": event_type, "object": obj}) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+            self.wfile.flush()
+
+        deadline = time.time() + timeout
+        try:
+            objects = sorted(self.objects(cluster, collection), key=lambda entry: entry[0])
+            now = time.time()
+            for ready_time, obj in objects:
+                send_event("ADDED", self.with_status(ready_time, obj, now))
+            for ready_time, obj in objects:
+                if ready_time <= now:
+                    continue
+                if ready_time > deadline:
+                    break
+                time.sleep(max(0, ready_time - time.time()))
+                send_event("MODIFIED", self.with_status(ready_time, obj, ready_time))
+            # like the real api server, the watch stays open until its timeout.
+            time.sleep(max(0, deadline - time.time()))
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            pass
+        self.close_connection = True
+
+    def do_PATCH(self):
+        self.count("PATCH")
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length)
+        obj = json.loads(body) if body else {}
+        with self.server.lock:
+            self.server.objects[urllib.parse.urlsplit(self.path).path] = obj
+        self.send_json(obj)
+
+
+def parse_cmd_line():
+    parser = argparse.ArgumentParser(description=__doc__, \
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--state', type=str, required=True, dest='state_dir', \
+            help='state directory of the fake tools')
+    parser.add_argument('--port', type=int, default=0, dest='port', \
+            help='port of the server (default: any free port, it is written to standard output)')
+    parser.add_argument('--node-ready-delay', type=float, default=0.5, dest='node_ready_delay', \
+            help='seconds after cluster creation until the first node is ready')
+    parser.add_argument('--node-ready-stagger', type=float, default=0.05, \
+            dest='node_ready_stagger', help='seconds between two nodes becoming ready')
+    return parser.parse_args()
+
+def main():
+    cmd_args = parse_cmd_line()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", cmd_args.port), FakeApiHandler)
+    server.daemon_threads = True
+    server.state_dir = cmd_args.state_dir
+    server.node_ready_delay = cmd_args.node_ready_delay
+    server.node_ready_stagger = cmd_args.node_ready_stagger
+    server.stats = {}
+    server.objects = {}
+    server.lock = threading.Lock()
+
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+""" load generator for the ingress of a kind cluster (or any http / tcp echo server).
+
+Opens --connections keep-alive connections to the url and sends requests on each of them,
+one after the other, for --duration seconds (or until --requests requests are done).
+Reports the requests per second, the throughput and the latency percentiles.
+With --tcp host:port, the connections are raw tcp connections to an echo server
+(test/echo.py); each request is a message of --size bytes that is sent back.
+
+The client cpu time is reported too: if it is close to the elapsed time multiplied by
+the number of cpus the load generator is the bottleneck, not the server.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import resource
+import socket
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+
+
+class Worker(threading.Thread):
+    """ one connection, sends a request as soon as the response of the last one arrived """
+
+    def __init__(self, cmd_args, deadline, counter):
+        super().__init__(daemon=True)
+        self.cmd_args = cmd_args
+        self.deadline = deadline
+        self.counter = counter
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.connects = 0
+
+    def run(self):
+        if self.cmd_args.tcp != "":
+            self.run_tcp()
+        else:
+            self.run_http()
+
+    def run_http(self):
+        url = urllib.parse.urlsplit(self.cmd_args.url)
+        connection_class = http.client.HTTPConnection
+        if url.scheme == "https":
+            connection_class = http.client.HTTPSConnection
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        body = b"x" * self.cmd_args.size if self.cmd_args.size != 0 else None
+        method = "POST" if body is not None else "GET"
+
+        connection = None
+        while time.time() < self.deadline and self.counter.take():
+            if connection is None:
+                connection = self.new_http_connection(connection_class, url)
+            start_time = time.perf_counter()
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    # the headers and the body of a request are sent by separate writes.
+                    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection.request(method, path, body=body)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                self.errors += 1
+                connection.close()
+                connection = None
+                continue
+            self.latencies.append(time.perf_counter() - start_time)
+            self.bytes += len(data)
+            if response.status >= 400:
+                self.errors += 1
+            if response.will_close:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    def new_http_connection(self, connection_class, url):
+        self.connects += 1
+        if connection_class is http.client.HTTPSConnection and self.cmd_args.insecure:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return connection_class(url.hostname, url.port, timeout=self.cmd_args.timeout, \
+                    context=context)
+        return connection_class(url.hostname, url.port, timeout=self.cmd_args.timeout)
+
+    def run_tcp(self):
+        host, port = self.cmd_args.tcp.rsplit(":", 1)
+        message = b"x" * max(1, self.cmd_args.size)
+
+        sock = None
+        while time.time() < self.deadline and self.counter.take():
+            start_time = time.perf_counter()
+            try:
+                if sock is None:
+                    self.connects += 1
+                    sock = socket.create_connection((host, int(port)), timeout=self.cmd_args.timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(message)
+                received = 0
+                while received < len(message):
+                    data = sock.recv(len(message) - received)
+                    if not data:
+                        raise OSError("connection closed by server")
+                    received += len(data)
+            except OSError:
+                self.errors += 1
+                if sock is not None:
+                    sock.close()
+                sock = None
+                continue
+            self.latencies.append(time.perf_counter() - start_time)
+            self.bytes += received
+        if sock is not None:
+            sock.close()
+
+
+class RequestCounter:
+    """ hands out the --requests requests (unlimited if 0) """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.taken = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.limit == 0:
+            return True
+        with self.lock:
+            if self.taken >= self.limit:
+                return False
+            self.taken += 1
+            return True
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_load(cmd_args):
+    deadline = time.time() + cmd_args.duration
+    counter = RequestCounter(cmd_args.requests)
+    workers = [Worker(cmd_args, deadline, counter) for _ in range(cmd_args.connections)]
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start_time
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    latencies = sorted(latency for worker in workers for latency in worker.latencies)
+    total_bytes = sum(worker.bytes for worker in workers)
+    return {
+        "target": cmd_args.tcp if cmd_args.tcp != "" else cmd_args.url,
+        "connections": cmd_args.connections,
+        "connects": sum(worker.connects for worker in workers),
+        "seconds": seconds,
+        "requests": len(latencies),
+        "errors": sum(worker.errors for worker in workers),
+        "requests_per_second": len(latencies) / seconds if seconds > 0 else 0.0,
+        "bytes_per_second": total_bytes / seconds if seconds > 0 else 0.0,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": latencies[-1] if len(latencies) != 0 else 0.0,
+        "client_cpu_seconds": (usage_after.ru_utime - usage_before.ru_utime) + \
+                (usage_after.ru_stime - usage_before.ru_stime),
+        "cpus": os.cpu_count(),
+    }
+
+def show_result(result):
+    print("target:       {} ({} connections, {} connects)".format(result["target"], \
+            result["connections"], result["connects"]))
+    print("requests:     {} in {:.2f} seconds, {} errors".format(result["requests"], \
+            result["seconds"], result["errors"]))
+    print("rate:         {:.1f} requests/second".format(result["requests_per_second"]))
+    print("throughput:   {:.3f} MB/second (response bodies)".format(\
+            result["bytes_per_second"] / (1024 * 1024)))
+    print("latency:      p50 {:.2f} ms  p95 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms".format(\
+            result["latency_p50"] * 1000, result["latency_p95"] * 1000, \
+            result["latency_p99"] * 1000, result["latency_max"] * 1000))
+    print("client cpu:   {:.2f} seconds ({} cpus)".format(result["client_cpu_seconds"], result["cpus"]))
+
+def parse_cmd_line():
+    parser = argparse.ArgumentParser(description=__doc__, \
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', type=str, default="http://localhost:8001/test-echo-server", dest='url', \
+            help='url of the http requests (i.e. the ingress port of the cluster)')
+    parser.add_argument('--tcp', type=str, default="", dest='tcp', \
+            help='host:port of a tcp echo server; raw tcp messages are sent instead of http requests')
+    parser.add_argument('--connections', '-c', type=int, default=16, dest='connections', \
+            help='number of keep-alive connections that send requests at the same time')
+    parser.add_argument('--duration', '-d', type=float, default=10, dest='duration', \
+            help='seconds the load is sent')
+    parser.add_argument('--requests', '-n', type=int, default=0, dest='requests', \
+            help='stop after this number of requests (0: no limit, until --duration)')
+    parser.add_argument('--size', type=int, default=0, dest='size', \
+            help='size of the request body (http: a POST request if not 0) or of the tcp message')
+    parser.add_argument('--timeout', type=float, default=10, dest='timeout', \
+            help='timeout (seconds) of a connect or a request')
+    parser.add_argument('--insecure', '-k', action='store_true', default=False, dest='insecure', \
+            help='https: do not verify the certificate of the server')
+    parser.add_argument('--json', type=str, default="", dest='json', \
+            help='also write the result to this json file')
+    return parser.parse_args()
+
+def main():
+    cmd_args = parse_cmd_line()
+    if cmd_args.connections < 1:
+        print("Error: --connections must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
+    result = run_load(cmd_args)
+    show_result(result)
+    if cmd_args.json != "":
+        with open(cmd_args.json, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+    if result["requests"] == 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
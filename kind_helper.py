@@ -1,32 +1,125 @@
 #!/usr/bin/env python3
 
 import argparse
-import urllib.request
+import collections
+import contextlib
+import copy
+import glob
+import importlib
 import json
 import os
-import pathlib
-import platform
-import subprocess
 import shlex
+import shutil
+import signal
 import sys
 import stat
 import re
+import threading
+import time
 
 try:
     from collections.abc import Iterable
 except ImportError:
     from collections import Iterable
 
-SYSTEM=platform.system().lower()
+class LazyModule:
+    """ stands for a module that is imported on first access to one of its attributes.
 
-KIND_DOWNLOAD_LOCATION = "https://api.github.com/repos/kubernetes-sigs/kind/releases/latest"
-LATEST_K8S_VERSION = "https://storage.googleapis.com/kubernetes-release/release/stable.txt"
-KUBECTL_LOCATION = \
-        "https://storage.googleapis.com/kubernetes-release/release/{}/bin/" + SYSTEM + "/{}/kubectl"
+    Most commands (i.e. the kubectl pass through of -c) don't need the network and process
+    modules, their import would be a good part of the startup time.
+    A submodule of a package is imported on access, like the attribute of the package.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            return importlib.import_module("{}.{}".format(self._name, attr))
+
+base64 = LazyModule("base64")
+calendar = LazyModule("calendar")
+concurrent = LazyModule("concurrent")
+fcntl = LazyModule("fcntl")
+hashlib = LazyModule("hashlib")
+http = LazyModule("http")
+pathlib = LazyModule("pathlib")
+queue = LazyModule("queue")
+resource = LazyModule("resource")
+select = LazyModule("select")
+selectors = LazyModule("selectors")
+socket = LazyModule("socket")
+ssl = LazyModule("ssl")
+subprocess = LazyModule("subprocess")
+tarfile = LazyModule("tarfile")
+tempfile = LazyModule("tempfile")
+urllib = LazyModule("urllib")
+
+SYSTEM=os.uname().sysname.lower()
+
+# the download locations can be overridden by environment variables (i.e. for a local test server)
+KIND_DOWNLOAD_LOCATION = os.environ.get("KIND_HELPER_KIND_RELEASE_URL", \
+        "https://api.github.com/repos/kubernetes-sigs/kind/releases/latest")
+KIND_LOCATION = os.environ.get("KIND_HELPER_KIND_URL", \
+        "https://github.com/kubernetes-sigs/kind/releases/download/{}/kind-" + SYSTEM + "-{}")
+LATEST_K8S_VERSION = os.environ.get("KIND_HELPER_K8S_STABLE_URL", \
+        "https://storage.googleapis.com/kubernetes-release/release/stable.txt")
+KUBECTL_LOCATION = os.environ.get("KIND_HELPER_KUBECTL_URL", \
+        "https://storage.googleapis.com/kubernetes-release/release/{}/bin/" + SYSTEM + "/{}/kubectl")
+
+INGRESS_MANIFEST_LOCATION = os.environ.get("KIND_HELPER_INGRESS_URL", \
+        "https://raw.githubusercontent.com/kubernetes/ingress-nginx/{}/deploy/static/provider/kind/deploy.yaml")
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_TIMEOUT = 60
+# how long (seconds) the latest version of kind/kubectl is remembered
+LATEST_VERSION_TTL = 24 * 3600
+
+TOOLS_MANIFEST = "tools.json"
+
+DEFAULT_CLUSTER_NAME = "kind"
+
+# log of the output of the processes run by the script (in the --dir directory)
+OUTPUT_LOG_FILE = "logs/kind-helper.log"
+OUTPUT_LOG_MAX_SIZE = 4 * 1024 * 1024
+OUTPUT_LOG_BACKUPS = 3
+# number of output lines of a process that are shown when it fails
+OUTPUT_TAIL_LINES = 50
+# seconds between SIGTERM and SIGKILL, when a process is stopped on timeout
+KILL_GRACE_SECONDS = 5
+# seconds until the version check of a tool (i.e. docker --version) is given up
+PROBE_TIMEOUT = 60
+
+# upstream registries that get a pull-through cache with --mirror
+MIRROR_UPSTREAMS = {
+    "docker.io" : "https://registry-1.docker.io",
+    "registry.k8s.io" : "https://registry.k8s.io",
+    "quay.io" : "https://quay.io",
+}
+MIRROR_LABEL = "kind-helper.mirror"
+MIRROR_UPSTREAM_LABEL = "kind-helper.mirror-upstream"
+
+# image of the local registry and of the pull-through caches
+REGISTRY_IMAGE = "registry:2"
+
+class KindHelperError(Exception):
+    """ raised by show_error; main() turns it into exit status 1, the callers of the
+    python api (KindCluster) can catch it
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return self.message
 
 def show_error(msg):
     print("Error {}".format(msg))
-    sys.exit(1)
+    raise KindHelperError(msg)
 
 def show_script(script):
     line_num=1
@@ -34,56 +127,264 @@ def show_script(script):
         print(f"{line_num} {line}")
         line_num += 1
 
+class Timings:
+    """ records the wall clock time and the child process cpu time of the named phases of a run,
+    and each process started while a phase is active.
+
+    Phases are entered per thread; a process started by a thread without phase of its own
+    (i.e. a worker of a thread pool) is added to the most recently entered phase that is
+    still running.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = []
+        self.open_phases = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        entry = {"name": name, "start_offset": time.time() - self.start_time, \
+                "seconds": None, "status": "running", "processes": []}
+        with self.lock:
+            self.phases.append(entry)
+            self.open_phases.append(entry)
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(entry)
+        try:
+            yield entry
+            entry["status"] = "ok"
+        except BaseException:
+            entry["status"] = "failed"
+            raise
+        finally:
+            stack.pop()
+            end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            entry["seconds"] = time.time() - self.start_time - entry["start_offset"]
+            # the child process usage is per process, it includes phases that run at the same time.
+            entry["child_user_cpu"] = end_usage.ru_utime - usage.ru_utime
+            entry["child_system_cpu"] = end_usage.ru_stime - usage.ru_stime
+            with self.lock:
+                self.open_phases.remove(entry)
+
+    def add_process(self, command_line, start_time, exit_code):
+        process = {"command": command_line, "start_offset": start_time - self.start_time, \
+                "seconds": time.time() - start_time, "exit_code": exit_code}
+        stack = self.local.__dict__.get("stack", [])
+        with self.lock:
+            if len(stack) != 0:
+                stack[-1]["processes"].append(process)
+            elif len(self.open_phases) != 0:
+                self.open_phases[-1]["processes"].append(process)
+
+    def report(self):
+        return {"command": sys.argv, "start": self.start_time, \
+                "seconds": time.time() - self.start_time, "phases": self.phases}
+
+    def show(self):
+        for entry in self.phases:
+            if entry["seconds"] is not None:
+                print("{:>8.2f}s {:>4} processes  {}".format(entry["seconds"], \
+                        len(entry["processes"]), entry["name"]))
+
+    def write_json(self, file_name):
+        try:
+            with open(file_name, "w") as output_file:
+                json.dump(self.report(), output_file, indent=2)
+        except OSError as err:
+            print("Warning: can't write timings to {} error: {}".format(file_name, err))
+
+TIMINGS = Timings()
+
+class OutputLog:
+    """ log file with the output of all processes started by the script.
+
+    The file is opened on first write, it is rotated once it grows beyond
+    OUTPUT_LOG_MAX_SIZE; OUTPUT_LOG_BACKUPS older files are kept (<file>.1 is the newest).
+    """
+
+    def __init__(self):
+        self.file_name = None
+        self.output_file = None
+        self.lock = threading.Lock()
+
+    def set_file(self, file_name):
+        with self.lock:
+            self.file_name = file_name
+
+    def write(self, text):
+        with self.lock:
+            if self.file_name is None:
+                return
+            try:
+                if self.output_file is None:
+                    os.makedirs(os.path.dirname(self.file_name), 0o755, exist_ok=True)
+                    self.output_file = open(self.file_name, "a")
+                self.output_file.write(text)
+                self.output_file.flush()
+                if self.output_file.tell() > OUTPUT_LOG_MAX_SIZE:
+                    self._rotate()
+            except OSError as err:
+                print("Warning: can't write log file {} error: {}".format(self.file_name, err))
+                self.file_name = None
+
+    def _rotate(self):
+        self.output_file.close()
+        self.output_file = None
+        for index in range(OUTPUT_LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.file_name, index)):
+                os.replace("{}.{}".format(self.file_name, index), \
+                        "{}.{}".format(self.file_name, index + 1))
+        os.replace(self.file_name, self.file_name + ".1")
+
+OUTPUT_LOG = OutputLog()
+
+def utf8_boundary(data):
+    """ returns the length of data without a utf-8 character that is incomplete at its end """
+    start = len(data) - 1
+    while start > 0 and len(data) - start < 4 and data[start] & 0xc0 == 0x80:
+        start -= 1
+    if start < 0 or data[start] < 0xc0:
+        return len(data)
+    length = 2 if data[start] < 0xe0 else 3 if data[start] < 0xf0 else 4
+    return start if len(data) - start < length else len(data)
+
 class RunCommand:
-    def __init__(self, command_line, pipe_as_input=None, capture_stdout=True):
+    """ runs a process, its standard output and error are read line by line as they come.
+
+    With capture_stdout the standard output is kept in self.output; otherwise both are
+    passed on to the terminal. All lines go to OUTPUT_LOG; the last OUTPUT_TAIL_LINES lines
+    (only those of standard error with capture_stdout) are kept for the error message.
+    The process runs in a process group of its own, the whole group is killed when the
+    timeout (seconds) expires.
+    """
+
+    def __init__(self, command_line, pipe_as_input=None, capture_stdout=True, env=None, timeout=None):
         self.command_line = command_line
         self.exit_code = 0
+        self.env = env
+        self.timeout = timeout
         self.run(command_line, pipe_as_input, capture_stdout)
 
     def run(self, command_line, pipe_as_input, capture_stdout):
+        start_time = time.time()
+        self.run_imp(command_line, pipe_as_input, capture_stdout)
+        TIMINGS.add_process(command_line, start_time, self.exit_code)
+        return self.exit_code
+
+    def run_imp(self, command_line, pipe_as_input, capture_stdout):
+        self.output = ""
+        self.error_out = ""
+        self.output_lines = []
+        self.tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        self.capture_stdout = capture_stdout
 
         try:
-            if pipe_as_input is None:
-                process = subprocess.Popen(shlex.split(command_line), \
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process = subprocess.Popen(shlex.split(command_line), \
+                    stdin=subprocess.PIPE if pipe_as_input is not None else None, \
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env, \
+                    start_new_session=True)
+        except FileNotFoundError:
+            self.error_out = "file not found"
+            self.exit_code = 1
+            return self.exit_code
 
-                (output, error_out) = process.communicate()
-                self.exit_code = process.wait()
+        OUTPUT_LOG.write("### [{}] {}\n".format(process.pid, command_line))
+        try:
+            timed_out = not self._stream(process, pipe_as_input)
+        except BaseException:
+            self._kill(process)
+            raise
+
+        if timed_out:
+            self._kill(process)
+            self.exit_code = process.returncode if process.returncode not in (0, None) else 1
+            self.tail.append("timed out after {} seconds\n".format(self.timeout))
+        else:
+            self.exit_code = process.wait()
+        OUTPUT_LOG.write("### [{}] exit status: {}\n".format(process.pid, self.exit_code))
+
+        self.output = "".join(self.output_lines)
+        self.error_out = "".join(self.tail)
+        return self.exit_code
+
+    def _stream(self, process, pipe_as_input):
+        """ feeds the input and reads the output of the process; returns False on timeout """
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        partial = {process.stdout: b"", process.stderr: b""}
+        input_data = b"" if pipe_as_input is None else pipe_as_input.encode("utf-8")
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ)
+            selector.register(process.stderr, selectors.EVENT_READ)
+            if process.stdin is not None:
+                os.set_blocking(process.stdin.fileno(), False)
+                selector.register(process.stdin, selectors.EVENT_WRITE)
+
+            while len(selector.get_map()) != 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                for key, _ in selector.select(remaining):
+                    if key.fileobj is process.stdin:
+                        try:
+                            input_data = input_data[os.write(key.fd, input_data[:select.PIPE_BUF]):]
+                        except BrokenPipeError:
+                            input_data = b""
+                        if len(input_data) == 0:
+                            selector.unregister(process.stdin)
+                            process.stdin.close()
+                        continue
+
+                    chunk = os.read(key.fd, 64 * 1024)
+                    if len(chunk) == 0:
+                        selector.unregister(key.fileobj)
+                        if len(partial[key.fileobj]) != 0:
+                            self._add_line(key.fileobj is process.stderr, partial[key.fileobj])
+                        continue
+
+                    lines = (partial[key.fileobj] + chunk).split(b"\n")
+                    partial[key.fileobj] = lines.pop()
+                    lines = [line + b"\n" for line in lines]
+                    # a very long line without newline (i.e. a progress bar) is passed on as it is,
+                    # without a newline: its rest (and the newline) follows with the next chunks.
+                    if len(partial[key.fileobj]) > 64 * 1024:
+                        cut = utf8_boundary(partial[key.fileobj])
+                        lines.append(partial[key.fileobj][:cut])
+                        partial[key.fileobj] = partial[key.fileobj][cut:]
+                    for line in lines:
+                        self._add_line(key.fileobj is process.stderr, line)
+        return True
 
-                self.output = output.decode("utf-8")
-                self.error_out = error_out.decode("utf-8")
+    def _add_line(self, is_stderr, line):
+        text = line.decode("utf-8", "replace")
+        OUTPUT_LOG.write(text)
 
+        if self.capture_stdout:
+            if is_stderr:
+                self.tail.append(text)
             else:
-                if capture_stdout:
-                    process = subprocess.Popen(shlex.split(command_line), \
-                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
-                                stderr=subprocess.PIPE)
-                    (output, error_out) = process.communicate(input=pipe_as_input.encode("utf-8"))
+                self.output_lines.append(text)
+            return
 
-                    self.output = output.decode("utf-8")
-                    self.error_out = error_out.decode("utf-8")
+        self.tail.append(text)
+        output_stream = sys.stderr if is_stderr else sys.stdout
+        output_stream.write(text)
+        output_stream.flush()
 
-                else:
-                    process = subprocess.Popen(shlex.split(command_line), \
-                                stdin=subprocess.PIPE)
-                    process.communicate(input=pipe_as_input.encode("utf-8"))
-                    self.output = ""
-                    self.error_out = ""
-
-                self.exit_code = process.wait()
-
-            #if self.exit_code != 0:
-            #    print(f"Run: {command_line}")
-            #    print(f"status: {self.exit_code}")
-            return self.exit_code
-        except FileNotFoundError:
-            self.output = ""
-            self.error_out = "file not found"
-            self.exit_code = 1
-            #if self.exit_code != 0:
-            #    print(f"Run: {command_line}")
-            #    print(f"status: {self.exit_code}")
-            return self.exit_code
+    @staticmethod
+    def _kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(KILL_GRACE_SECONDS)
+        except ProcessLookupError:
+            process.wait()
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
 
     def result(self):
         return self.exit_code, self.output
@@ -98,22 +399,6 @@ class RunCommand:
             return_value += " " + self.error_out
         return return_value
 
-def has_command(file):
-    cmd = "{} --version".format(file)
-    cmd_runner = RunCommand(cmd)
-    if cmd_runner.exit_code == 0:
-        return True
-    return False
-
-
-def has_kubectl_check():
-    cmd = "kubectl config view"
-    cmd_runner = RunCommand(cmd)
-    if cmd_runner.exit_code == 0:
-        return True
-    return False
-
-
 def is_exe(localfile):
     file_check = pathlib.Path(localfile)
     if file_check.is_file() and os.access(localfile, os.X_OK):
@@ -124,89 +409,451 @@ def download(cmd, url, local_file=None):
 
     print("downloading {} to {} ...".format(url, local_file))
 
-    filedata = urllib.request.urlopen(url)
-    datatowrite = filedata.read()
-
-    if filedata.code != 200:
-        print("failed to downloadurl {} status code {}".format(url, filedata.code))
-        return False, filedata.code, ""
-
-    if cmd == "get_str":
-        return True, filedata.code, datatowrite.decode("utf-8")
     if cmd == "save":
         if local_file is None:
             print("No local file for save")
             return False, -1, ""
-        with open(local_file, 'wb') as output_file:
-            output_file.write(datatowrite)
-        return True, filedata.code, ""
+        status, code, _ = download_file(url, local_file)
+        return status, code, ""
+
+    if cmd != "get_str":
+        print("Illegal command to download {}".format(cmd))
+        return False, -1, ""
+
+    try:
+        with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as filedata:
+            datatowrite = filedata.read()
+            code = filedata.code
+    except urllib.error.HTTPError as err:
+        print("failed to download url {} status code {}".format(url, err.code))
+        return False, err.code, ""
+    except (urllib.error.URLError, OSError) as err:
+        print("failed to download url {} error: {}".format(url, err))
+        return False, -1, ""
+
+    return True, code, datatowrite.decode("utf-8")
+
+
+def download_file(url, local_file, expected_sha256=None, can_resume=True):
+    """ streams url to local_file in chunks, returns (status, http status, sha256 of file)
+
+    The data is written to local_file.part, which is renamed to local_file once the
+    download is complete (and the checksum matches, if expected_sha256 is given).
+    A part file left over from an interrupted download is resumed with a Range request.
+    """
+    part_file = local_file + ".part"
+    hasher = hashlib.sha256()
+
+    offset = 0
+    if can_resume and os.path.isfile(part_file):
+        offset = os.path.getsize(part_file)
+
+    request = urllib.request.Request(url)
+    if offset > 0:
+        request.add_header("Range", "bytes={}-".format(offset))
+
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as err:
+        if err.code == 416 and offset > 0:
+            # range not satisfiable: the part file is of no use.
+            return download_file(url, local_file, expected_sha256, False)
+        print("failed to download url {} status code {}".format(url, err.code))
+        return False, err.code, ""
+    except (urllib.error.URLError, OSError) as err:
+        print("failed to download url {} error: {}".format(url, err))
+        return False, -1, ""
+
+    with response:
+        code = response.code
+        content_range = response.headers.get("Content-Range", "")
+        if offset > 0 and code == 206 and content_range.startswith("bytes {}-".format(offset)):
+            print("resuming download of {} at offset {}".format(url, offset))
+            with open(part_file, "rb") as input_file:
+                for chunk in iter(lambda: input_file.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+            mode = "ab"
+        else:
+            offset = 0
+            mode = "wb"
+
+        try:
+            with open(part_file, mode) as output_file:
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    output_file.write(chunk)
+                    hasher.update(chunk)
+        except OSError as err:
+            # the part file stays, the next attempt continues where this one stopped.
+            print("failed to download url {} error: {}".format(url, err))
+            return False, code, ""
+
+    digest = hasher.hexdigest()
+    if expected_sha256 is not None and digest != expected_sha256:
+        os.remove(part_file)
+        if offset > 0:
+            return download_file(url, local_file, expected_sha256, False)
+        print("checksum mismatch for url {} expected sha256 {} got {}".\
+                format(url, expected_sha256, digest))
+        return False, code, digest
+
+    os.replace(part_file, local_file)
+    return True, code, digest
+
+
+@contextlib.contextmanager
+def file_lock(lock_file_name):
+    with open(lock_file_name, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-    print("Illegal command to download {}".format(cmd))
-    return False, filedata.code, ""
 
+class DownloadCache:
+    """ versioned, content addressed cache of the kind and kubectl binaries (and of image tarballs)
 
-def download_exe(url, localfile):
-    status, code, _ = download("save", url, localfile)
-    if not status:
-        show_error("failed to download url: {} to {}".format(url, localfile))
+    Each binary is stored once in blobs/<sha256>; index.json maps a key
+    (<tool>/<version>/<os>-<platform>) to the blob and the time it was last used.
+    The least recently used entries are removed when the cache grows beyond max_size bytes,
+    and entries that were not used for max_age seconds (if given).
+    """
 
-    res_stat = os.stat(localfile)
-    os.chmod(localfile, res_stat.st_mode | stat.S_IEXEC)
+    def __init__(self, cache_dir, max_size, max_age=None):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(self.blob_dir, 0o755, exist_ok=True)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, "r") as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {"entries": {}, "latest": {}}
+
+    def _write_index(self, index):
+        tmp_file = "{}.{}.tmp".format(self.index_file, os.getpid())
+        with open(tmp_file, "w") as index_file:
+            json.dump(index, index_file, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    @contextlib.contextmanager
+    def _update_index(self):
+        with file_lock(self.index_file + ".lock"):
+            index = self._read_index()
+            yield index
+            self._write_index(index)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256)
+
+    def latest_version(self, tool):
+        """ returns the remembered latest version of tool, None if unknown or too old """
+        latest = self._read_index()["latest"].get(tool)
+        if latest is None or time.time() - latest["checked"] > LATEST_VERSION_TTL:
+            return None
+        return latest["version"]
+
+    def set_latest_version(self, tool, version):
+        with self._update_index() as index:
+            index["latest"][tool] = {"version": version, "checked": time.time()}
+
+    def entry(self, key):
+        """ returns the index entry of key with the path of its blob (None if not cached) """
+        with self._update_index() as index:
+            entry = index["entries"].get(key)
+            if entry is None or not os.path.isfile(self.blob_path(entry["sha256"])):
+                index["entries"].pop(key, None)
+                return None
+            entry["last_used"] = time.time()
+            return dict(entry, path=self.blob_path(entry["sha256"]))
+
+    def lookup(self, key):
+        entry = self.entry(key)
+        return None if entry is None else entry["path"]
+
+    def store(self, key, local_file, sha256, **attributes):
+        """ moves local_file (with content hash sha256) into the cache as the blob of key.
+        attributes are kept in the index entry.
+        """
+        blob = self.blob_path(sha256)
+        os.replace(local_file, blob)
+        with self._update_index() as index:
+            index["entries"][key] = dict(attributes, sha256=sha256, size=os.path.getsize(blob), \
+                    last_used=time.time())
+            self._evict(index, key)
+        return blob
+
+    def fetch(self, key, url, sha256_url=None):
+        """ returns the path of the cached blob for key, downloads it from url if needed """
+
+        blob = self.lookup(key)
+        if blob is not None:
+            return blob
+
+        expected_sha256 = None
+        if sha256_url is not None:
+            status, http_status, checksum = download("get_str", sha256_url)
+            if not status:
+                show_error("Failed to download checksum from {}. http status {}".\
+                        format(sha256_url, http_status))
+            expected_sha256 = checksum.split()[0].lower() if checksum.strip() != "" else None
+
+        part_name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        local_file = os.path.join(self.cache_dir, "download-" + part_name)
+
+        # the lock keeps concurrent runs from writing to the same part file.
+        with file_lock(local_file + ".lock"):
+            blob = self.lookup(key)
+            if blob is not None:
+                return blob
+
+            if expected_sha256 is not None and os.path.isfile(self.blob_path(expected_sha256)):
+                blob = self.blob_path(expected_sha256)
+            else:
+                print("downloading {} ...".format(url))
+                status, http_status, sha256 = download_file(url, local_file, expected_sha256)
+                if not status:
+                    show_error("failed to download url: {}. http status {}".format(url, http_status))
+                blob = self.blob_path(sha256)
+                os.replace(local_file, blob)
+
+            with self._update_index() as index:
+                index["entries"][key] = {"sha256": os.path.basename(blob), \
+                        "size": os.path.getsize(blob), "last_used": time.time()}
+                self._evict(index, key)
+        return blob
+
+    def _evict(self, index, keep_key):
+        entries = index["entries"]
+
+        def total_size():
+            return sum({entry["sha256"]: entry["size"] for entry in entries.values()}.values())
+
+        def is_expired(key):
+            return self.max_age is not None and time.time() - entries[key]["last_used"] > self.max_age
+
+        for key in sorted(entries, key=lambda key: entries[key]["last_used"]):
+            if total_size() <= self.max_size and not is_expired(key):
+                break
+            if key == keep_key:
+                continue
+            sha256 = entries.pop(key)["sha256"]
+            if all(entry["sha256"] != sha256 for entry in entries.values()):
+                try:
+                    os.remove(self.blob_path(sha256))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def install(blob, local_file):
+        """ puts the cached binary to local_file (hard link if possible) """
+        tmp_file = "{}.{}.tmp".format(local_file, os.getpid())
+        try:
+            os.link(blob, tmp_file)
+        except OSError:
+            shutil.copyfile(blob, tmp_file)
+        res_stat = os.stat(tmp_file)
+        os.chmod(tmp_file, res_stat.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
+        os.replace(tmp_file, local_file)
 
-    return status, code
 
-def download_kind(local_file, platform):
+def download_cache(cmd_args):
+    return DownloadCache(os.path.join(cmd_args.temp_dir, "cache"), cmd_args.cache_size * 1024 * 1024)
+
+def latest_kind_version(cache):
+    version = cache.latest_version("kind")
+    if version is not None:
+        return version
+
     status, http_status, download_spec = download("get_str", KIND_DOWNLOAD_LOCATION)
     if not status:
         show_error("Failed to download kind downloads spec from {}. http status {}".\
                 format(KIND_DOWNLOAD_LOCATION, http_status))
 
     spec_data = json.loads(download_spec)
+    version = spec_data.get("tag_name")
+    if version is None:
+        show_error("Can't get latest kind version - unexpected format of json")
 
-    download_url = ""
+    cache.set_latest_version("kind", version)
+    return version
 
-    assets = spec_data.get("assets")
-    if assets is None:
-        show_error("Can't get kind download url - unexpected format of json")
-    for asset in assets:
-        kind_platform = "kind-" + SYSTEM + "-{}".format(platform)
-        name = asset.get("name")
-        if name is None:
-            show_error("Can't get kind download url - unexpected format of json (2)")
-        if name == kind_platform:
-            download_url = asset.get("browser_download_url")
-            if download_url is None:
-                show_error("Can't get kind download url - unexpected format of json (3)")
-            break
+def latest_kubectl_version(cache):
+    version = cache.latest_version("kubectl")
+    if version is not None:
+        return version
 
-    print("kind download url {}".format(download_url))
-
-    if download_url == "":
-        show_error("failed to parse download location of kind tool")
-
-    status, _ = download_exe(download_url, local_file)
-    return status
-
-def download_kubectl(local_file, platform):
     status, http_status, version = download("get_str", LATEST_K8S_VERSION)
     if not status:
         show_error("Failed to download name of latest kubernetes version from {}. http status {}".\
                 format(LATEST_K8S_VERSION, http_status))
 
-    url = KUBECTL_LOCATION.format(version.rstrip(), platform)
+    version = version.strip()
+    cache.set_latest_version("kubectl", version)
+    return version
 
-    print("url {} #".format(url))
-    status, _ = download_exe(url, local_file)
+def download_kind(cmd_args, local_file):
+    cache = download_cache(cmd_args)
 
-    return status
+    version = cmd_args.kind_version
+    if version == "latest":
+        version = latest_kind_version(cache)
 
-def check_prerequisites(cmd_args):
+    url = KIND_LOCATION.format(version, cmd_args.platform)
+    print("kind download url {}".format(url))
+
+    key = "kind/{}/{}-{}".format(version, SYSTEM, cmd_args.platform)
+    cache.install(cache.fetch(key, url, url + ".sha256sum"), local_file)
+
+def download_kubectl(cmd_args, local_file):
+    cache = download_cache(cmd_args)
+
+    version = cmd_args.kubectl_version
+    if version == "latest":
+        version = latest_kubectl_version(cache)
 
-    if not has_command("docker"):
+    url = KUBECTL_LOCATION.format(version, cmd_args.platform)
+    print("url {} #".format(url))
+
+    key = "kubectl/{}/{}-{}".format(version, SYSTEM, cmd_args.platform)
+    cache.install(cache.fetch(key, url, url + ".sha256"), local_file)
+
+def path_fingerprint():
+    # a change to PATH or to any directory on it (i.e. a tool got installed or removed)
+    # invalidates the tools manifest.
+    path_env = os.environ.get("PATH", "")
+    dir_mtimes = {}
+    for path_dir in path_env.split(os.pathsep):
+        dir_mtimes[path_dir] = file_mtime(path_dir)
+    return {"path": path_env, "dirs": dir_mtimes}
+
+def file_mtime(file_name):
+    try:
+        return os.stat(file_name).st_mtime
+    except OSError:
+        return None
+
+def probe_tool(file, version_args):
+    path = shutil.which(file)
+    if path is None:
+        return None
+    cmd_runner = RunCommand("{} {}".format(shlex.quote(path), version_args), timeout=PROBE_TIMEOUT)
+    if cmd_runner.exit_code != 0:
+        return None
+    version = cmd_runner.output.strip().split("\n")[0]
+    return {"path": path, "version": version, "mtime": file_mtime(path)}
+
+def resolve_docker(_cmd_args):
+    tool = probe_tool("docker", "--version")
+    if tool is None:
         show_error("can't find docker in the current path. please install docker")
+    return tool
 
-    has_kind = has_command("kind")
-    has_kubectl = has_kubectl_check()
+def tool_has_version(tool, version):
+    if version == "latest":
+        return True
+    match = re.search(r'v?(\d+\.\d+\.\d+)', tool["version"])
+    return match is not None and match.group(1) == version.lstrip("v")
+
+def resolve_downloadable_tool(cmd_args, file, version_args, version, download_func):
+    tool = probe_tool(file, version_args)
+    if tool is not None and tool_has_version(tool, version):
+        return tool
+
+    local_file = "{}/{}".format(cmd_args.temp_dir, file)
+    tool = None
+    if is_exe(local_file):
+        tool = probe_tool(local_file, version_args)
+
+    if tool is None or not tool_has_version(tool, version):
+        download_func(cmd_args, local_file)
+        tool = probe_tool(local_file, version_args)
+
+    if tool is None:
+        show_error("can't run {}".format(local_file))
+    return tool
+
+def resolve_kind(cmd_args):
+    return resolve_downloadable_tool(cmd_args, "kind", "--version", \
+            cmd_args.kind_version, download_kind)
+
+def resolve_kubectl(cmd_args):
+    return resolve_downloadable_tool(cmd_args, "kubectl", "version --client", \
+            cmd_args.kubectl_version, download_kubectl)
+
+TOOL_RESOLVERS = {
+    "docker" : resolve_docker,
+    "kind" : resolve_kind,
+    "kubectl" : resolve_kubectl,
+}
+
+def tools_manifest_file(cmd_args):
+    return "{}/{}".format(cmd_args.temp_dir, TOOLS_MANIFEST)
+
+def load_tools_manifest(cmd_args, fingerprint):
+    try:
+        with open(tools_manifest_file(cmd_args), "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("fingerprint") != fingerprint or \
+            manifest.get("platform") != cmd_args.platform or \
+            manifest.get("versions") != tool_versions(cmd_args):
+        return None
+
+    tools = manifest.get("tools", {})
+    for name in TOOL_RESOLVERS:
+        tool = tools.get(name)
+        if tool is None or tool.get("mtime") is None or \
+                file_mtime(tool.get("path")) != tool.get("mtime"):
+            return None
+    return tools
+
+def tool_versions(cmd_args):
+    return {"kind": cmd_args.kind_version, "kubectl": cmd_args.kubectl_version}
+
+def save_tools_manifest(cmd_args, fingerprint, tools):
+    manifest = {"fingerprint": fingerprint, "platform": cmd_args.platform, \
+            "versions": tool_versions(cmd_args), "tools": tools}
+    manifest_file = tools_manifest_file(cmd_args)
+    tmp_file = "{}.{}.tmp".format(manifest_file, os.getpid())
+    try:
+        with open(tmp_file, "w") as output_file:
+            json.dump(manifest, output_file, indent=2)
+        os.replace(tmp_file, manifest_file)
+    except OSError as err:
+        print("Warning: can't write tools manifest {} error: {}".format(manifest_file, err))
+
+def resolve_tools(cmd_args):
+    """ returns path and version of docker, kind and kubectl.
+
+    All probes and downloads run at the same time; the result is remembered in the
+    tools manifest of the temp directory, a later run skips the probes,
+    as long as PATH and the binaries did not change.
+    """
+    fingerprint = path_fingerprint()
+
+    if not cmd_args.refresh_tools:
+        tools = load_tools_manifest(cmd_args, fingerprint)
+        if tools is not None:
+            if cmd_args.verbose:
+                print("using tools from {}".format(tools_manifest_file(cmd_args)))
+            return tools
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(TOOL_RESOLVERS)) as executor:
+        futures = {name: executor.submit(resolver, cmd_args) \
+                for name, resolver in TOOL_RESOLVERS.items()}
+        tools = {name: future.result() for name, future in futures.items()}
+
+    save_tools_manifest(cmd_args, fingerprint, tools)
+    return tools
+
+def check_prerequisites(cmd_args):
 
     cmd_args.temp_dir = os.path.expandvars(cmd_args.temp_dir)
     dir_check = pathlib.Path(cmd_args.temp_dir)
@@ -216,31 +863,477 @@ def check_prerequisites(cmd_args):
         except OSError as err:
             show_error("can't create temp directory {} error: {}".format(cmd_args.temp_dir, err))
 
-    if not has_kind:
-        kind = "{}/kind".format(cmd_args.temp_dir)
-        if not is_exe(kind):
-            download_kind(kind, cmd_args.platform)
-    else:
-        kind = "kind"
+    tools = resolve_tools(cmd_args)
 
-    if not has_kubectl:
-        kubectl = "{}/kubectl".format(cmd_args.temp_dir)
-        if not is_exe(kubectl):
-            download_kubectl(kubectl, cmd_args.platform)
-    else:
-        kubectl = "kubectl"
+    if cmd_args.verbose:
+        for name, tool in tools.items():
+            print("{}: {} ({})".format(name, tool["path"], tool["version"]))
 
-    os.environ["KUBECTL"] = kubectl
-    os.environ["KIND"] = kind
+    os.environ["KUBECTL"] = tools["kubectl"]["path"]
+    os.environ["KIND"] = tools["kind"]["path"]
+    os.environ["KIND_VERSION"] = tools["kind"]["version"]
     os.environ["KIND_DIR"] = cmd_args.temp_dir
 
 
-def run_cluster(cmd_args, ingress_options):
+def run_script(cmd_args, script, error_msg, env=None):
+    bashcmd = "/usr/bin/env bash"
+    if cmd_args.verbose:
+        show_script(script)
+        bashcmd += " -x"
+
+    run_start = RunCommand(bashcmd, script, False, env)
+    if run_start.exit_code != 0:
+        show_error("{}: {}".format(error_msg, run_start.make_error_message()))
+
+
+class KubeApiError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message)
+        self.status = status
+
+def parse_yaml_scalar(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in ("'", '"'):
+        return text[1:-1]
+    if text in ("{}", "[]"):
+        return {} if text == "{}" else []
+    if text in ("null", "~", ""):
+        return None
+    if text in ("true", "false"):
+        return text == "true"
+    return text
+
+def parse_simple_yaml(text):
+    """ parses the block style yaml subset of a kubeconfig file (mappings, lists and scalars) """
+
+    lines = []
+    for line in text.splitlines():
+        if line.strip() == "" or line.lstrip().startswith("#"):
+            continue
+        lines.append((len(line) - len(line.lstrip()), line.strip()))
+
+    def parse_block(pos, indent):
+        if lines[pos][1].startswith("- ") or lines[pos][1] == "-":
+            return parse_list(pos, indent)
+        return parse_map(pos, indent)
+
+    def parse_list(pos, indent):
+        result = []
+        while pos < len(lines) and lines[pos][0] == indent and lines[pos][1].startswith("-"):
+            item = lines[pos][1][1:].strip()
+            if item == "":
+                value, pos = parse_block(pos + 1, lines[pos + 1][0])
+            elif re.match(r'^[^\s"\']+:(\s|$)', item):
+                # the first key of a mapping is on the line of the dash.
+                lines[pos] = (indent + 2, item)
+                value, pos = parse_map(pos, indent + 2)
+            else:
+                value, pos = parse_yaml_scalar(item), pos + 1
+            result.append(value)
+        return result, pos
+
+    def parse_map(pos, indent):
+        result = {}
+        while pos < len(lines) and lines[pos][0] == indent and not lines[pos][1].startswith("- "):
+            key, _, value = lines[pos][1].partition(":")
+            pos += 1
+            if value.strip() != "":
+                result[key.strip()] = parse_yaml_scalar(value)
+            elif pos < len(lines) and (lines[pos][0] > indent or \
+                    (lines[pos][0] == indent and lines[pos][1].startswith("-"))):
+                result[key.strip()], pos = parse_block(pos, lines[pos][0])
+            else:
+                result[key.strip()] = None
+        return result, pos
+
+    if len(lines) == 0:
+        return {}
+    value, _ = parse_block(0, lines[0][0])
+    return value
+
+def load_kubeconfig(kubeconfig_file):
+    """ returns the server url and the credentials of the current context of a kubeconfig file """
+
+    try:
+        with open(kubeconfig_file, "r") as input_file:
+            text = input_file.read()
+    except OSError as err:
+        raise KubeApiError("can't read kubeconfig {} error: {}".format(kubeconfig_file, err))
+
+    config = json.loads(text) if text.lstrip().startswith("{") else parse_simple_yaml(text)
+
+    def find(section, name):
+        for entry in config.get(section) or []:
+            if name is None or entry.get("name") == name:
+                return entry
+        raise KubeApiError("kubeconfig {}: no entry {} in {}".format(kubeconfig_file, name, section))
+
+    context = find("contexts", config.get("current-context"))["context"]
+    cluster = find("clusters", context.get("cluster"))["cluster"]
+    user = find("users", context.get("user"))["user"] or {}
+    return cluster, user
+
+class KubeClient:
+    """ small kubernetes api client, sends requests over a pool of keep-alive connections
+
+    This is used instead of kubectl for the steps of cluster setup, where the
+    cost of starting a kubectl process would dominate.
+    """
+
+    FIELD_MANAGER = "kind-helper"
+
+    def __init__(self, kubeconfig_file, pool_size=8):
+        cluster, user = load_kubeconfig(kubeconfig_file)
+
+        server = urllib.parse.urlsplit(cluster["server"])
+        self.host = server.hostname
+        self.port = server.port
+        self.is_https = server.scheme == "https"
+        self.base_path = server.path.rstrip("/")
+        self.headers = {}
+        if user.get("token") is not None:
+            self.headers["Authorization"] = "Bearer {}".format(user["token"])
+
+        self.ssl_context = None
+        if self.is_https:
+            self.ssl_context = self._make_ssl_context(cluster, user)
+
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue()
+
+    @staticmethod
+    def _read_data(config, key):
+        if config.get(key + "-data") is not None:
+            return base64.b64decode(config[key + "-data"]).decode("utf-8")
+        if config.get(key) is not None:
+            with open(config[key], "r") as input_file:
+                return input_file.read()
+        return None
+
+    def _make_ssl_context(self, cluster, user):
+        ca_data = self._read_data(cluster, "certificate-authority")
+        ssl_context = ssl.create_default_context(cadata=ca_data)
+        if cluster.get("insecure-skip-tls-verify"):
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+
+        cert_data = self._read_data(user, "client-certificate")
+        key_data = self._read_data(user, "client-key")
+        if cert_data is not None and key_data is not None:
+            # load_cert_chain only accepts files.
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                cert_file = os.path.join(tmp_dir, "client.crt")
+                key_file = os.path.join(tmp_dir, "client.key")
+                for file_name, data in ((cert_file, cert_data), (key_file, key_data)):
+                    with open(os.open(file_name, os.O_WRONLY | os.O_CREAT, 0o600), "w") as output:
+                        output.write(data)
+                ssl_context.load_cert_chain(cert_file, key_file)
+        return ssl_context
+
+    def _new_connection(self, timeout=DOWNLOAD_TIMEOUT):
+        if self.is_https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, \
+                    context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _url(self, path, params):
+        url = self.base_path + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        return url
+
+    def request(self, method, path, body=None, params=None, content_type="application/json"):
+        """ sends a request, returns the decoded json response. Raises KubeApiError on failure """
+
+        headers = dict(self.headers)
+        headers["Accept"] = "application/json"
+        if body is not None:
+            headers["Content-Type"] = content_type
+            # a string is sent as it is (i.e. a yaml document for server side apply)
+            body = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+
+        for attempt in range(2):
+            try:
+                connection = self.pool.get_nowait()
+            except queue.Empty:
+                connection = self._new_connection()
+            try:
+                connection.request(method, self._url(path, params), body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as err:
+                connection.close()
+                # a pooled keep-alive connection may have been closed by the server; retry once.
+                if attempt == 0:
+                    continue
+                raise KubeApiError("{} {} failed: {}".format(method, path, err))
+
+            if self.pool.qsize() < self.pool_size:
+                self.pool.put(connection)
+            else:
+                connection.close()
+            break
+
+        if response.status >= 300:
+            raise KubeApiError("{} {} failed. status {} {}".format(method, path, \
+                    response.status, data.decode("utf-8", "replace")), response.status)
+        return json.loads(data) if data else {}
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params=params)
 
-    os.environ["reg_name"] = cmd_args.reg_docker_name
-    os.environ["reg_port"] = str(cmd_args.reg_docker_port)
-    os.environ["num_nodes"] = str(cmd_args.num_workers + cmd_args.num_masters)
-    os.environ["wait_for_nodes_timeout"] = str(cmd_args.timeout)
+    def patch(self, path, body):
+        return self.request("PATCH", path, body, content_type="application/merge-patch+json")
+
+    def apply(self, path, body):
+        """ server side apply of an object (json is valid yaml), or of the text of a yaml document """
+        return self.request("PATCH", path, body, \
+                params={"fieldManager": KubeClient.FIELD_MANAGER, "force": "true"}, \
+                content_type="application/apply-patch+yaml")
+
+    def get_to_file(self, path, output_file, params=None):
+        """ copies the body of a GET request to output_file in chunks (for logs, that may be large) """
+
+        try:
+            connection = self.pool.get_nowait()
+        except queue.Empty:
+            connection = self._new_connection()
+        try:
+            connection.request("GET", self._url(path, params), headers=self.headers)
+            response = connection.getresponse()
+            error_data = response.read() if response.status >= 300 else b""
+            while response.status < 300:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output_file.write(chunk)
+        except (http.client.HTTPException, OSError) as err:
+            connection.close()
+            raise KubeApiError("GET {} failed: {}".format(path, err))
+
+        # the response was read to its end, the connection can be used again.
+        if self.pool.qsize() < self.pool_size:
+            self.pool.put(connection)
+        else:
+            connection.close()
+
+        if response.status >= 300:
+            raise KubeApiError("GET {} failed. status {} {}".format(path, response.status, \
+                    error_data.decode("utf-8", "replace")), response.status)
+
+    def watch(self, path, deadline, params=None):
+        """ yields the watch events of a collection until deadline, on a connection of its own """
+
+        params = dict(params or {})
+        timeout = max(1, deadline - time.time())
+        params["watch"] = "1"
+        params["timeoutSeconds"] = str(int(timeout) + 1)
+
+        connection = self._new_connection(timeout)
+        try:
+            headers = dict(self.headers)
+            headers["Accept"] = "application/json"
+            connection.request("GET", self._url(path, params), headers=headers)
+            response = connection.getresponse()
+            if response.status >= 300:
+                raise KubeApiError("watch {} failed. status {}".format(path, response.status), \
+                        response.status)
+            while time.time() < deadline:
+                line = response.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield json.loads(line)
+        except socket.timeout:
+            return
+        except (http.client.HTTPException, OSError) as err:
+            raise KubeApiError("watch {} failed: {}".format(path, err))
+        finally:
+            connection.close()
+
+def has_condition(obj, condition_type):
+    for condition in obj.get("status", {}).get("conditions") or []:
+        if condition.get("type") == condition_type:
+            return condition.get("status") == "True"
+    return False
+
+def wait_for_watch(client, path, timeout, on_event, params=None):
+    """ feeds the watch events of path to on_event, until on_event returns True.
+
+    The watch is restarted if it ends early (i.e. the api server is not up yet)
+    returns False if the condition is not met within timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            for event in client.watch(path, deadline, params):
+                if on_event(event):
+                    return True
+        except KubeApiError:
+            pass
+        time.sleep(1)
+    return False
+
+def wait_for_nodes_ready(cmd_args, client, num_nodes):
+    """ waits until num_nodes nodes are Ready, reports the time it took for each node. """
+
+    start_time = time.time()
+    ready_time = {}
+
+    def on_event(event):
+        node = event.get("object", {})
+        name = node.get("metadata", {}).get("name")
+        if name is None:
+            return False
+
+        if event.get("type") == "DELETED" or not has_condition(node, "Ready"):
+            if ready_time.pop(name, None) is not None:
+                print("node {} is no longer Ready".format(name))
+            return False
+
+        if name not in ready_time:
+            ready_time[name] = time.time() - start_time
+            print("node {} Ready after {:.1f} seconds ({}/{} ready)".\
+                    format(name, ready_time[name], len(ready_time), num_nodes))
+        return len(ready_time) >= num_nodes
+
+    if not wait_for_watch(client, "/api/v1/nodes", cmd_args.timeout, on_event):
+        show_error("timed out waiting for nodes to become ready. {}/{} ready".\
+                format(len(ready_time), num_nodes))
+
+    print("all {} nodes ready after {:.1f} seconds".format(num_nodes, time.time() - start_time))
+    return ready_time
+
+# the kube-system pods that must be present and ready: label selector -> expected number of pods
+# (None stands for one pod per node)
+SYSTEM_PODS = {
+    "k8s-app=kube-dns" : 1,
+    "k8s-app=kube-proxy" : None,
+    "app=kindnet" : None,
+}
+
+def has_labels(obj, selector):
+    labels = obj.get("metadata", {}).get("labels") or {}
+    key, value = selector.split("=")
+    return labels.get(key) == value
+
+def wait_for_system_pods(cmd_args, client, num_nodes):
+    """ waits until all pods in kube-system (CoreDNS, kube-proxy, the CNI) are ready. """
+
+    start_time = time.time()
+    pods = {}
+
+    def on_event(event):
+        pod = event.get("object", {})
+        name = pod.get("metadata", {}).get("name")
+        if name is None:
+            return False
+
+        if event.get("type") == "DELETED":
+            pods.pop(name, None)
+            return False
+
+        ready = has_condition(pod, "Ready") or pod.get("status", {}).get("phase") == "Succeeded"
+        if ready and not pods.get(name, (False, None))[0]:
+            print("pod kube-system/{} ready after {:.1f} seconds".\
+                    format(name, time.time() - start_time))
+        pods[name] = (ready, pod)
+
+        if not all(ready for ready, _ in pods.values()):
+            return False
+        for selector, expected in SYSTEM_PODS.items():
+            count = sum(1 for _, pod in pods.values() if has_labels(pod, selector))
+            if count < (expected if expected is not None else num_nodes):
+                return False
+        return True
+
+    if not wait_for_watch(client, "/api/v1/namespaces/kube-system/pods", \
+            cmd_args.timeout, on_event):
+        show_error("timed out waiting for kube-system pods to become ready")
+
+    print("all kube-system pods ready after {:.1f} seconds".format(time.time() - start_time))
+
+
+def setup_cluster_objects(cmd_args, client, with_ingress):
+    """ documents the local registry in the cluster, annotates (and labels) the nodes.
+
+    Returns the name of the node that is labeled for the ingress (None if without ingress)
+    """
+
+    # Document the local registry
+    # https://github.com/kubernetes/enhancements/tree/master/keps/sig-cluster-lifecycle/generic/1755-communicating-a-local-registry
+    client.apply("/api/v1/namespaces/kube-public/configmaps/local-registry-hosting", {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": "local-registry-hosting", "namespace": "kube-public"},
+        "data": {
+            "localRegistryHosting.v1": \
+                'host: "localhost:{}"\nhelp: "https://kind.sigs.k8s.io/docs/user/local-registry/"\n'.\
+                format(cmd_args.reg_docker_port)
+        }
+    })
+
+    node_labels = {node["metadata"]["name"]: node["metadata"].get("labels") or {} \
+            for node in client.get("/api/v1/nodes")["items"]}
+    nodes = sorted(node_labels)
+
+    ingress_node = None
+    if with_ingress:
+        # the kind config has the host port mappings and the ingress-ready label (a kubelet
+        # node label) on the first control-plane node, the ingress controller must run there.
+        labeled = [node for node in nodes if node_labels[node].get("ingress-ready") == "true"]
+        control_planes = [node for node in nodes \
+                if "node-role.kubernetes.io/control-plane" in node_labels[node]]
+        ingress_node = next(iter(labeled + control_planes + nodes), None)
+
+    # tell https://tilt.dev to use the registry
+    # https://docs.tilt.dev/choosing_clusters.html#discovering-the-registry
+    # one patch per node (annotation and label together), all nodes at the same time.
+    def patch_node(node):
+        metadata = {"annotations": \
+                {"kind.x-k8s.io/registry": "localhost:{}".format(cmd_args.reg_docker_port)}}
+        if node == ingress_node:
+            metadata["labels"] = {"ingress-ready": "true"}
+        client.patch("/api/v1/nodes/{}".format(node), {"metadata": metadata})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=client.pool_size) as executor:
+        for future in [executor.submit(patch_node, node) for node in nodes]:
+            future.result()
+    return ingress_node
+
+
+def kubeconfig_file(cmd_args, cluster_name=None):
+    if cluster_name is None:
+        cluster_name = cmd_args.cluster_name
+    if cluster_name == DEFAULT_CLUSTER_NAME:
+        return "{}/kubeconfig".format(cmd_args.temp_dir)
+    return "{}/kubeconfig-{}".format(cmd_args.temp_dir, cluster_name)
+
+def named_cluster_args(cmd_args, name):
+    cluster_args = copy.copy(cmd_args)
+    cluster_args.cluster_name = name
+    cluster_args.cluster_names = [name]
+    return cluster_args
+
+def cluster_env(cmd_args):
+    """ environment of the start/stop scripts of the cluster """
+    env = dict(os.environ)
+    env["reg_name"] = cmd_args.reg_docker_name
+    env["reg_port"] = str(cmd_args.reg_docker_port)
+    env["reg_image"] = REGISTRY_IMAGE
+    env["reg_storage"] = registry_storage(cmd_args)
+    env["cluster_name"] = cmd_args.cluster_name
+    env["node_image"] = cmd_args.node_image
+    env["KUBECONFIG_FILE"] = kubeconfig_file(cmd_args)
+    return env
+
+def add_cluster_steps(graph, cmd_args, ingress_options, shared_steps, shared_state):
+    """ adds the steps that create the cluster of cmd_args to the step graph.
+
+    shared_steps are the names of the steps for all clusters (prerequisites, registry, ...),
+    shared_state["ingress_bundle"] is set by the step that fetches the ingress bundle,
+    shared_state["node_image"] by the step that loads the node image from the image cache.
+    """
 
     script_ingress_map = ''
 
@@ -287,81 +1380,43 @@ def run_cluster(cmd_args, ingress_options):
     script_fragments = [r'''
 set -xe
 
-# create registry container unless it already exists
-
-running="$(docker inspect -f '{{.State.Running}}' "${reg_name}" 2>/dev/null || true)"
-if [ "${running}" != 'true' ]; then
-  docker run \
-      -d --restart=always -p ${reg_port}:${reg_port} --name ${reg_name} \
-    registry:2
-fi
-
 # create a cluster with the local registry enabled in containerd
-cat <<EOF | ${KIND} create cluster --config=-
+cat <<EOF | ${KIND} create cluster --name "${cluster_name}" ${node_image:+--image "${node_image}"} --config=-
 kind: Cluster
 apiVersion: kind.x-k8s.io/v1alpha4
 containerdConfigPatches:
 - "[plugins.\"io.containerd.grpc.v1.cri\".registry.mirrors.\"localhost:${reg_port}\"]\n  endpoint = [\"http://${reg_name}:${reg_port}\"]"
-nodes:
 ''', \
 '''
 EOF
+''', \
+'''
+set -xe
 
+${KIND} get kubeconfig --name "${cluster_name}" >"${KUBECONFIG_FILE}"
+''', \
+'''
+set -xe
 
-${KIND} get kubeconfig >${KIND_DIR}/kubeconfig
-
-KUBECTL="$KUBECTL --kubeconfig ${KIND_DIR}/kubeconfig "
-
-docker network connect "kind" "${reg_name}"
-
-# Document the local registry
-# https://github.com/kubernetes/enhancements/tree/master/keps/sig-cluster-lifecycle/generic/1755-communicating-a-local-registry
-cat <<EOF | ${KUBECTL} apply -f -
-apiVersion: v1
-kind: ConfigMap
-metadata:
-  name: local-registry-hosting
-  namespace: kube-public
-data:
-  localRegistryHosting.v1: |
-    host: "localhost:${reg_port}"
-    help: "https://kind.sigs.k8s.io/docs/user/local-registry/"
-EOF
-
-# tell https://tilt.dev to use the registry
-# https://docs.tilt.dev/choosing_clusters.html#discovering-the-registry
-#for node in $(${KIND} get nodes); do
-for node in $(${KUBECTL} get nodes | sed '1d' | awk '{print $1}'); do
-  ${KUBECTL} annotate node "${node}" "kind.x-k8s.io/registry=localhost:${reg_port}";
-done
-
-READY_NODES=$(${KUBECTL} get nodes | awk '{ print $2 }' | grep -c '^Ready$') || true
-
-DEADLINE=$(date +%s)
-DEADLINE=$((DEADLINE + wait_for_nodes_timeout))
+# the registry is shared by all clusters, it may be connected already.
+if [ "$(docker inspect -f '{{json .NetworkSettings.Networks.kind}}' "${reg_name}")" == 'null' ]; then
+  docker network connect "kind" "${reg_name}"
+fi
 
-while [[ ${READY_NODES} -lt ${num_nodes} ]]; do
-  TIME_NOW=$(date +%s)
-  if (( TIME_NOW > DEADLINE )); then
-    echo "timed out waiting for nodes to become ready"
-    exit 1
+for mirror in ${MIRROR_CONTAINERS}; do
+  if [ "$(docker inspect -f '{{json .NetworkSettings.Networks.kind}}' "${mirror}")" == 'null' ]; then
+    docker network connect "kind" "${mirror}"
   fi
-  echo "${READY_NODES}/${num_nodes} ready. waiting..."
-  sleep 3
-  READY_NODES=$(${KUBECTL} get nodes | awk '{ print $2 }' | grep -c '^Ready$') || true
 done
+
 ''', \
 '''
-WORKER_NODE_NAME=$(${KUBECTL} get nodes | sed '1d' |grep -v master | head -1 | awk '{ print $1 }')
+set -xe
 
-if [[ ${WORKER_NODE_NAME} == "" ]]; then
-    echo "Error: need to define at least one worker node for hosting the ingress"
-    exit 1
-fi
-${KUBECTL} label node ${WORKER_NODE_NAME} "ingress-ready=true"
+KUBECTL="$KUBECTL --kubeconfig ${KUBECONFIG_FILE} "
 
 echo "initialize nginx ingress"
-${KUBECTL} apply -f https://raw.githubusercontent.com/kubernetes/ingress-nginx/main/deploy/static/provider/kind/deploy.yaml
+${KUBECTL} apply -f "${INGRESS_MANIFEST}"
 
 ${KUBECTL} wait --namespace ingress-nginx \
   --for=condition=ready pod \
@@ -373,29 +1428,175 @@ ${KUBECTL} wait --namespace ingress-nginx \
 #${KUBECTL} apply -f https://projectcontour.io/quickstart/contour.yaml
 #${KUBECTL} patch daemonsets -n projectcontour envoy -p '{"spec":{"template":{"spec":{"nodeSelector":{"ingress-ready":"true"},"tolerations":[{"key":"node-role.kubernetes.io/master","operator":"Equal","effect":"NoSchedule"}]}}}}'
 #
-''',\
-'''
-echo "*** kind cluster running, all nodes are ready ***"
 ''']
 
 
-    script = script_fragments[0] + node_def + script_fragments[1]
-
-    if script_ingress_map != "":
-        script += script_fragments[2]
+    num_nodes = cmd_args.num_workers + cmd_args.num_masters
+    mirrors = parse_mirror_options(cmd_args)
+    state = {}
+
+    def check_existing():
+        env = cluster_env(cmd_args)
+        env["MIRROR_CONTAINERS"] = " ".join(mirror_container_name(registry) for registry in mirrors)
+        state["env"] = env
+        state["spec"] = cluster_spec(cmd_args, node_def, mirrors, script_ingress_map != "")
+        state["reused"] = False
+        if cmd_args.reuse:
+            client = reuse_cluster(cmd_args, state["spec"], num_nodes, script_ingress_map != "")
+            if client is not None:
+                state["client"] = client
+                state["reused"] = True
+
+    def unless_reused(func):
+        return lambda: None if state["reused"] else func()
+
+    def create_cluster():
+        env = state["env"]
+        if cmd_args.node_image == "" and shared_state.get("node_image") is not None:
+            # the default node image was loaded from the image cache, without its digest.
+            env = dict(env, node_image=shared_state["node_image"])
+        run_script(cmd_args, script_fragments[0] + mirror_config_patches(mirrors) + "nodes:\n" + \
+                node_def + script_fragments[1], "Failed to run cluster", env)
+
+    def export_kubeconfig():
+        run_script(cmd_args, script_fragments[2], "Failed to run cluster", state["env"])
+        try:
+            state["client"] = KubeClient(kubeconfig_file(cmd_args))
+        except KubeApiError as err:
+            show_error("Failed to set up cluster: {}".format(err))
 
-    script += script_fragments[3]
+    def connect_network():
+        with registry_lock(cmd_args):
+            # the last cluster of another process may have removed the registry since it was started.
+            run_registry(cmd_args)
+            run_script(cmd_args, script_fragments[3], "Failed to run cluster", state["env"])
 
-    bashcmd = "/usr/bin/env bash"
-    if cmd_args.verbose:
-        show_script(script)
-        bashcmd += " -x"
+    def setup_objects():
+        try:
+            state["ingress_node"] = setup_cluster_objects(cmd_args, state["client"], \
+                    script_ingress_map != "")
+            save_cluster_spec(state["client"], state["spec"])
+        except KubeApiError as err:
+            show_error("Failed to set up cluster: {}".format(err))
+
+    def preload_images():
+        preload_ingress_images(cmd_args, state["ingress_node"], shared_state["ingress_bundle"][1])
+
+    def apply_ingress():
+        env = dict(state["env"])
+        env["INGRESS_MANIFEST"] = shared_state["ingress_bundle"][0]
+        run_script(cmd_args, script_fragments[4], "Failed to run cluster", env)
+
+    prefix = "{}: ".format(cmd_args.cluster_name)
+    group = cmd_args.cluster_name
+
+    # with --reuse, a running cluster of the same spec is kept; all steps but the
+    # (idempotent) network connect are skipped then.
+    existing = graph.add(prefix + "check existing cluster", check_existing, \
+            [shared_steps["prerequisites"], shared_steps["teardown"]], group)
+
+    # the kind config only names the registry containers, they are needed once images are pulled.
+    create = graph.add(prefix + "kind create cluster", unless_reused(create_cluster), \
+            [existing, shared_steps["node image"]], group)
+    kubeconfig = graph.add(prefix + "export kubeconfig", unless_reused(export_kubeconfig), \
+            [create], group)
+    graph.add(prefix + "connect registry to cluster network", connect_network, \
+            [create, shared_steps["registry"], shared_steps["mirrors"]], group)
+    setup = graph.add(prefix + "registry configmap, annotate nodes", unless_reused(setup_objects), \
+            [kubeconfig], group)
+    nodes_ready = graph.add(prefix + "wait for nodes", unless_reused(\
+            lambda: wait_for_nodes_ready(cmd_args, state["client"], num_nodes)), [kubeconfig], group)
+
+    if cmd_args.wait_system_pods:
+        graph.add(prefix + "wait for kube-system pods", unless_reused(\
+                lambda: wait_for_system_pods(cmd_args, state["client"], num_nodes)), \
+                [nodes_ready], group)
 
-    run_start = RunCommand(bashcmd, script, False)
-    if run_start.exit_code == 0:
-        print("*** cluster is running ***")
-    else:
-        show_error("Failed to run cluster: {}".format(run_start.make_error_message()))
+    if script_ingress_map != "":
+        # images are imported into the containerd of the nodes, this does not wait for the nodes to be ready.
+        preload = graph.add(prefix + "preload ingress images", unless_reused(preload_images), \
+                [setup, shared_steps["ingress bundle"]], group)
+        graph.add(prefix + "ingress rollout", unless_reused(apply_ingress), [preload], group)
+
+# the spec of the cluster is kept in this ConfigMap of the cluster, for --reuse
+CLUSTER_SPEC_PATH = "/api/v1/namespaces/kube-public/configmaps/kind-helper-spec"
+INGRESS_CONTROLLER_PATH = "/apis/apps/v1/namespaces/ingress-nginx/deployments/ingress-nginx-controller"
+
+def cluster_spec(cmd_args, node_def, mirrors, with_ingress):
+    """ returns the effective spec of the cluster and its fingerprint (sha256 of the spec) """
+    node_image = cmd_args.node_image
+    if node_image == "":
+        # the default node image is the one of the kind release.
+        node_image = "default of {}".format(os.environ.get("KIND_VERSION", ""))
+
+    spec = {
+        "nodes": node_def,
+        "mirrors": mirror_config_patches(mirrors),
+        "registry": "{}:{}".format(cmd_args.reg_docker_name, cmd_args.reg_docker_port),
+        "node_image": node_image,
+    }
+    if with_ingress:
+        # the host ports of the ingress are in the node definitions; a cluster with another
+        # ingress-nginx version is not reused.
+        spec["ingress"] = {"version": cmd_args.ingress_version}
+    spec_json = json.dumps(spec, sort_keys=True)
+    return {"spec": spec_json, "fingerprint": hashlib.sha256(spec_json.encode("utf-8")).hexdigest()}
+
+def save_cluster_spec(client, spec):
+    client.apply(CLUSTER_SPEC_PATH, {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": "kind-helper-spec", "namespace": "kube-public"},
+        "data": spec,
+    })
+
+def reuse_cluster(cmd_args, spec, num_nodes, with_ingress):
+    """ returns an api client of the cluster, if a healthy cluster of the same spec is running.
+
+    A cluster of the same name with a different spec (or that is not healthy) is deleted,
+    None is returned then.
+    """
+    cmd_runner = RunCommand("{} get clusters".format(shlex.quote(os.environ["KIND"])))
+    if cmd_args.cluster_name not in cmd_runner.output.split():
+        return None
+
+    problem = None
+    cmd_runner = RunCommand("{} get kubeconfig --name {}".format(shlex.quote(os.environ["KIND"]), \
+            shlex.quote(cmd_args.cluster_name)))
+    if cmd_runner.exit_code != 0:
+        problem = "can't get kubeconfig: {}".format(cmd_runner.make_error_message())
+
+    client = None
+    try:
+        if problem is None:
+            with open(kubeconfig_file(cmd_args), "w") as output_file:
+                output_file.write(cmd_runner.output)
+            client = KubeClient(kubeconfig_file(cmd_args))
+            stored = client.get(CLUSTER_SPEC_PATH).get("data") or {}
+            if stored.get("fingerprint") != spec["fingerprint"]:
+                problem = "the spec of the cluster changed"
+        if problem is None:
+            nodes = client.get("/api/v1/nodes")["items"]
+            ready = [node for node in nodes if has_condition(node, "Ready")]
+            if len(nodes) != num_nodes or len(ready) != num_nodes:
+                problem = "{}/{} nodes ready".format(len(ready), num_nodes)
+        if problem is None and with_ingress:
+            status = client.get(INGRESS_CONTROLLER_PATH).get("status", {})
+            if not status.get("availableReplicas"):
+                problem = "the ingress controller is not available"
+    except KubeApiError as err:
+        problem = str(err)
+    except (OSError, ValueError) as err:
+        # the kubeconfig can't be written or read: the cluster is created again
+        problem = "bad kubeconfig: {}".format(err)
+
+    if problem is not None:
+        print("*** cluster {} is not reused: {} ***".format(cmd_args.cluster_name, problem))
+        delete_cluster(cmd_args)
+        return None
+
+    print("*** cluster {} is running with the same spec, it is reused ***".format(cmd_args.cluster_name))
+    return client
 
 
 def parse_ingress_options(cmd_args):
@@ -409,69 +1610,1301 @@ def parse_ingress_options(cmd_args):
                 internal_port = match.group(2)
                 ingress_def.append((external_port, internal_port))
             else:
-                print('-i option argument should be of the following form:\
+                show_error('-i option argument should be of the following form:\
 <positive integer>:<positive integer>. is: {}'.format(port_def))
-
-                sys.exit(1)
     return ingress_def
 
 
-def start_cluster(cmd_args):
-    ingress_options = parse_ingress_options(cmd_args)
-    check_prerequisites(cmd_args)
-    run_cluster(cmd_args, ingress_options)
+def parse_mirror_options(cmd_args):
+    """ returns the upstream registries that get a pull-through cache: registry -> upstream url """
+    if not cmd_args.mirror:
+        return {}
+
+    mirrors = dict(MIRROR_UPSTREAMS)
+    for mirror_def in cmd_args.mirror_upstream:
+        match = re.search(r'^([^=]+)=(https?://\S+)$', mirror_def)
+        if not match:
+            show_error("--mirror-upstream option argument should be of the following form: \
+<registry>=<url>. is: {}".format(mirror_def))
+        mirrors[match.group(1)] = match.group(2)
+    return mirrors
+
+def mirror_container_name(registry):
+    return "kind-mirror-" + re.sub(r'[^a-zA-Z0-9]', '-', registry)
+
+def start_mirrors(cmd_args, mirrors):
+    """ runs a pull-through cache registry for each upstream registry.
+
+    The cached images are kept in a docker volume of the same name as the container,
+    the containers are not removed by --stop (unless --stop-mirror is given).
+    """
+    with registry_lock(cmd_args):
+        for registry, upstream in mirrors.items():
+            start_mirror(registry, upstream)
+
+def start_mirror(registry, upstream):
+    """ runs the pull-through cache of the registry, unless it runs; the caller holds the registry lock """
+    name = mirror_container_name(registry)
+
+    cmd_runner = RunCommand("docker inspect -f '{{{{.State.Running}}}} \
+{{{{index .Config.Labels \"{}\"}}}}' {}".format(MIRROR_UPSTREAM_LABEL, name))
+    if cmd_runner.output.split() == ["true", upstream]:
+        return
+
+    RunCommand("docker rm -f {}".format(name))
+    command_line = "docker run -d --restart=always --name {0} --label {1}={2} \
+--label {3}={4} -v {0}:/var/lib/registry -e REGISTRY_PROXY_REMOTEURL={4} {5}".\
+            format(name, MIRROR_LABEL, registry, MIRROR_UPSTREAM_LABEL, upstream, REGISTRY_IMAGE)
+    cmd_runner = RunCommand(command_line)
+    if cmd_runner.exit_code != 0:
+        show_error("Failed to start pull-through cache for {}: {}".\
+                format(registry, cmd_runner.make_error_message()))
+    print("*** pull-through cache {} for {} started ***".format(name, upstream))
+
+def mirror_config_patches(mirrors):
+    """ containerd config patches that send the pulls of the upstream registries to the caches """
+    patches = ""
+    for registry in mirrors:
+        patches += '- "[plugins.\\"io.containerd.grpc.v1.cri\\".registry.mirrors.\\"{}\\"]\\n  \
+endpoint = [\\"http://{}:5000\\"]"\n'.format(registry, mirror_container_name(registry))
+    return patches
+
+def stop_mirrors(cmd_args):
+    cmd_runner = RunCommand("docker ps -a -q --filter label={}".format(MIRROR_LABEL))
+    if cmd_runner.output.strip() == "":
+        return
+    cmd_runner = RunCommand("docker rm -f {}".format(" ".join(cmd_runner.output.split())))
+    if cmd_runner.exit_code != 0:
+        show_error("Failed to stop pull-through caches: {}".format(cmd_runner.make_error_message()))
+    print("*** pull-through caches stopped ***")
+
+
+def ingress_bundle_dir(cmd_args):
+    return os.path.join(cmd_args.temp_dir, "ingress", cmd_args.ingress_version)
+
+def fetch_ingress_bundle(cmd_args):
+    """ returns the ingress-nginx manifest of --ingress-version and the images it uses.
+
+    The manifest is downloaded once and kept in the temp directory; the images are pulled
+    once into the local docker. The image references of the returned manifest are without
+    digest, so that the images that are preloaded into the nodes are used.
+    """
+    bundle_dir = ingress_bundle_dir(cmd_args)
+    manifest_file = os.path.join(bundle_dir, "deploy.yaml")
+    preload_file = os.path.join(bundle_dir, "deploy-preload.yaml")
+
+    if not os.path.isfile(manifest_file):
+        os.makedirs(bundle_dir, 0o755, exist_ok=True)
+        url = INGRESS_MANIFEST_LOCATION.format(cmd_args.ingress_version)
+        status, http_status, _ = download("save", url, manifest_file)
+        if not status:
+            show_error("Failed to download ingress manifest from {}. http status {}".\
+                    format(url, http_status))
+
+    with open(manifest_file, "r") as input_file:
+        manifest = input_file.read()
+
+    images = []
+    for match in re.finditer(r'^\s*(?:-\s+)?image:\s*"?([^"\s]+)"?\s*$', manifest, re.MULTILINE):
+        if match.group(1) not in images:
+            images.append(match.group(1))
+
+    if not os.path.isfile(preload_file):
+        preload_manifest = re.sub(r'^(\s*(?:-\s+)?image:\s*"?[^"@\s]+)@sha256:[0-9a-f]+', \
+                r'\1', manifest, flags=re.MULTILINE)
+        with open(preload_file + ".tmp", "w") as output_file:
+            output_file.write(preload_manifest)
+        os.replace(preload_file + ".tmp", preload_file)
+
+    def pull_image(image):
+        tag = image.split("@")[0]
+        if RunCommand("docker image inspect {}".format(shlex.quote(tag))).exit_code == 0:
+            return tag
+        print("pulling {} ...".format(image))
+        # pulled by digest, tagged without it (the tag is what the nodes get)
+        for command_line in ["docker pull {}".format(shlex.quote(image)), \
+                "docker tag {} {}".format(shlex.quote(image), shlex.quote(tag))]:
+            cmd_runner = RunCommand(command_line)
+            if cmd_runner.exit_code != 0:
+                show_error("Failed to get ingress image {}: {}".\
+                        format(image, cmd_runner.make_error_message()))
+        return tag
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(images))) as executor:
+        tags = list(executor.map(pull_image, images))
+
+    return preload_file, tags
+
+def preload_ingress_images(cmd_args, ingress_node, images):
+    """ the controller image goes to the ingress node, the other images (admission jobs) to all nodes """
+    controller_images = [image for image in images if "/controller:" in image]
+    other_images = [image for image in images if image not in controller_images]
+
+    if len(controller_images) != 0:
+        load_images_into_nodes(cmd_args, controller_images, lambda node: node == ingress_node)
+    if len(other_images) != 0:
+        load_images_into_nodes(cmd_args, other_images)
+
+def registry_lock(cmd_args):
+    """ lock of the local registry, the pull-through caches and the kind network.
+
+    They are shared by all clusters, also by those of other processes of this script (i.e. the
+    workers of pytest-xdist); starting them and connecting them to the network, and the decision
+    to remove them with the last cluster are done under this lock.
+    """
+    os.makedirs(cmd_args.temp_dir, 0o755, exist_ok=True)
+    return file_lock(os.path.join(cmd_args.temp_dir, "registry.lock"))
+
+def start_registry(cmd_args):
+    with registry_lock(cmd_args):
+        run_registry(cmd_args)
+
+def run_registry(cmd_args):
+    """ starts the container of the local registry, unless it runs; the caller holds the registry lock """
+    script = r'''
+set -xe
 
-def stop_cluster_imp(cmd_args):
-    os.environ["reg_name"] = cmd_args.reg_docker_name
-    os.environ["reg_port"] = str(cmd_args.reg_docker_port)
+# create registry container unless it already exists
 
-    check_prerequisites(cmd_args)
+running="$(docker inspect -f '{{.State.Running}}' "${reg_name}" 2>/dev/null || true)"
+if [ "${running}" != 'true' ]; then
+  docker run \
+      -d --restart=always -p ${reg_port}:${reg_port} --name ${reg_name} \
+      -v "${reg_storage}:/var/lib/registry" -e REGISTRY_STORAGE_DELETE_ENABLED=true \
+    ${reg_image}
+fi
+'''
+    run_script(cmd_args, script, "Failed to start local registry", cluster_env(cmd_args))
+
+def registry_storage(cmd_args):
+    """ docker volume (or host directory) with the images of the local registry """
+    if cmd_args.reg_storage != "":
+        return cmd_args.reg_storage
+    return "{}-storage".format(cmd_args.reg_docker_name)
+
+# manifests of a single image, and of a multi platform image (list of manifests)
+REGISTRY_IMAGE_MANIFESTS = ["application/vnd.docker.distribution.manifest.v2+json", \
+        "application/vnd.oci.image.manifest.v1+json"]
+REGISTRY_MANIFEST_LISTS = ["application/vnd.docker.distribution.manifest.list.v2+json", \
+        "application/vnd.oci.image.index.v1+json"]
+
+class RegistryClient:
+    """ client of the http api of the local registry, a keep-alive connection per thread """
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, method, path, accept=None):
+        """ sends a request, returns (status, headers, body). Raises KubeApiError on failure """
+        headers = {"Accept": ", ".join(accept)} if accept is not None else {}
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            if connection is None:
+                connection = http.client.HTTPConnection("localhost", self.port, \
+                        timeout=DOWNLOAD_TIMEOUT)
+                self.local.connection = connection
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, OSError) as err:
+                connection.close()
+                self.local.connection = None
+                # the server may have closed the keep-alive connection; retry once.
+                if attempt != 0:
+                    raise KubeApiError("{} {} failed: {}".format(method, path, err))
+        return None
+
+    def get_json(self, path, accept=None):
+        status, headers, body = self.request("GET", path, accept)
+        if status != 200:
+            raise KubeApiError("GET {} failed. status {} {}".format(path, status, \
+                    body.decode("utf-8", "replace")), status)
+        return headers, json.loads(body)
+
+    def image_info(self, repo, tag):
+        """ returns the digest of the manifest of repo:tag, the time it was built
+        and the blobs it uses (digest -> size)
+        """
+        headers, manifest = self.get_json("/v2/{}/manifests/{}".format(repo, tag), \
+                REGISTRY_IMAGE_MANIFESTS + REGISTRY_MANIFEST_LISTS)
+        digest = headers.get("Docker-Content-Digest")
+
+        manifests = [manifest]
+        if manifest.get("mediaType") in REGISTRY_MANIFEST_LISTS or "manifests" in manifest:
+            manifests = [self.get_json("/v2/{}/manifests/{}".format(repo, child["digest"]), \
+                    REGISTRY_IMAGE_MANIFESTS)[1] for child in manifest.get("manifests", [])]
+
+        blobs = {}
+        for image_manifest in manifests:
+            for blob in image_manifest.get("layers", []) + [image_manifest.get("config", {})]:
+                if "digest" in blob:
+                    blobs[blob["digest"]] = blob.get("size", 0)
+
+        created = 0
+        if len(manifests) != 0 and "digest" in manifests[0].get("config", {}):
+            _, config = self.get_json("/v2/{}/blobs/{}".format(repo, manifests[0]["config"]["digest"]))
+            match = re.match(r'^(\d+-\d+-\d+T\d+:\d+:\d+)', config.get("created", ""))
+            if match is not None:
+                created = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+        return digest, created, blobs
+
+# the tags of the repositories in the registry storage, the link file of a tag is written on each push
+REGISTRY_REPOSITORIES_DIR = "/var/lib/registry/docker/registry/v2/repositories"
+
+def registry_push_times(cmd_args):
+    """ returns the time of the last push of the tags of the local registry, (repo, tag) -> seconds
+    since the epoch. The api of the registry has no push time, it is the modification time of the
+    tag link in the registry storage; empty if the storage can't be read.
+    """
+    script = "find {} -path '*/_manifests/tags/*/current/link' | xargs -r stat -c '%Y %n'".\
+            format(REGISTRY_REPOSITORIES_DIR)
+    cmd_runner = RunCommand("docker exec {} sh -c {}".format(shlex.quote(cmd_args.reg_docker_name), \
+            shlex.quote(script)))
+    push_times = {}
+    if cmd_runner.exit_code != 0:
+        return push_times
+    for line in cmd_runner.output.splitlines():
+        match = re.match(r'^(\d+) {}/(.+)/_manifests/tags/([^/]+)/current/link$'.\
+                format(re.escape(REGISTRY_REPOSITORIES_DIR)), line)
+        if match is not None:
+            push_times[(match.group(2), match.group(3))] = int(match.group(1))
+    return push_times
+
+def registry_images(client, jobs, push_times):
+    """ returns the images of the registry: list of dict (repo, tags, digest, pushed, blobs),
+    one entry per manifest; tags of the same manifest can only be deleted together.
+
+    pushed is the time of the last push of one of the tags (see registry_push_times), the time
+    the image was built if the push time is not known.
+    """
+    _, catalog = client.get_json("/v2/_catalog?n=100000")
+
+    def list_tags(repo):
+        _, tags = client.get_json("/v2/{}/tags/list".format(repo))
+        return [(repo, tag) for tag in tags.get("tags") or []]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        tags = [tag for repo_tags in executor.map(list_tags, catalog.get("repositories") or []) \
+                for tag in repo_tags]
+        infos = list(executor.map(lambda repo_tag: client.image_info(*repo_tag), tags))
+
+    images = {}
+    for (repo, tag), (digest, created, blobs) in zip(tags, infos):
+        image = images.setdefault((repo, digest), \
+                {"repo": repo, "tags": [], "digest": digest, "pushed": 0, "blobs": blobs})
+        image["tags"].append(tag)
+        image["pushed"] = max(image["pushed"], push_times.get((repo, tag), created))
+    return list(images.values())
+
+def select_images_to_delete(cmd_args, images):
+    """ the images pushed more than --registry-gc-age days ago, and the least recently pushed images
+    beyond the size budget of --registry-gc-size MB (blobs shared by several images are counted once)
+    """
+    now = time.time()
+    delete = []
+    kept_blobs = {}
+    for image in sorted(images, key=lambda image: image["pushed"], reverse=True):
+        if cmd_args.reg_gc_age > 0 and now - image["pushed"] > cmd_args.reg_gc_age * 24 * 3600:
+            delete.append(image)
+            continue
+        blobs = dict(kept_blobs, **image["blobs"])
+        if cmd_args.reg_gc_size > 0 and len(kept_blobs) != 0 and \
+                sum(blobs.values()) > cmd_args.reg_gc_size * 1024 * 1024:
+            delete.append(image)
+            continue
+        kept_blobs = blobs
+    return delete
+
+def registry_disk_usage(cmd_args):
+    cmd_runner = RunCommand("docker exec {} du -sk /var/lib/registry".\
+            format(shlex.quote(cmd_args.reg_docker_name)))
+    fields = cmd_runner.output.split()
+    return int(fields[0]) * 1024 if cmd_runner.exit_code == 0 and len(fields) != 0 else 0
+
+def registry_gc(cmd_args):
+    """ deletes old images from the local registry, then the blobs no image refers to.
+
+    The images (tags) are deleted by the time of their last push (--registry-gc-age) or, least
+    recently pushed first, until the rest fits into the size budget (--registry-gc-size). The
+    garbage collection of the registry then removes the blobs that are no longer referenced;
+    the registry is stopped while it runs.
+    """
+    start_time = time.time()
+    client = RegistryClient(cmd_args.reg_docker_port)
+    size_before = registry_disk_usage(cmd_args)
+    try:
+        images = registry_images(client, cmd_args.jobs, registry_push_times(cmd_args))
+    except KubeApiError as err:
+        show_error("Failed to list the images of the local registry: {}".format(err))
+
+    delete = select_images_to_delete(cmd_args, images)
+    for image in delete:
+        status, _, body = client.request("DELETE", \
+                "/v2/{}/manifests/{}".format(image["repo"], image["digest"]))
+        if status == 405:
+            show_error("The local registry does not allow to delete images, it was started by an \
+earlier version of this script. Restart it: --stop, then --start")
+        if status not in (200, 202, 404):
+            show_error("Failed to delete {}:{} from the local registry. status {} {}".format(\
+                    image["repo"], ",".join(image["tags"]), status, body.decode("utf-8", "replace")))
+        print("deleted {}:{}".format(image["repo"], ",".join(image["tags"])))
+
+    # a running registry keeps the descriptors of the blobs in memory: it would still report the
+    # collected blobs as present, and later pushes would skip their upload. So the registry is
+    # stopped, the garbage collection runs in a container of its own on the registry storage, and
+    # the registry is started again (with an empty cache).
+    with registry_lock(cmd_args):
+        cmd_runner = RunCommand("docker stop {}".format(shlex.quote(cmd_args.reg_docker_name)))
+        if cmd_runner.exit_code != 0:
+            show_error("Failed to stop the local registry: {}".format(cmd_runner.make_error_message()))
+        gc_runner = RunCommand("docker run --rm -v {}:/var/lib/registry {} garbage-collect \
+/etc/docker/registry/config.yml".format(shlex.quote(registry_storage(cmd_args)), REGISTRY_IMAGE))
+        cmd_runner = RunCommand("docker start {}".format(shlex.quote(cmd_args.reg_docker_name)))
+        if gc_runner.exit_code != 0:
+            show_error("Failed to run the garbage collection of the local registry: {}".\
+                    format(gc_runner.make_error_message()))
+        if cmd_runner.exit_code != 0:
+            show_error("Failed to start the local registry: {}".format(cmd_runner.make_error_message()))
+
+    size_after = registry_disk_usage(cmd_args)
+    print("*** local registry: {} of {} images deleted, {:.1f} MB freed ({:.1f} MB used), \
+time: {:.2f} seconds ***".format(len(delete), len(images), (size_before - size_after) / (1024 * 1024), \
+            size_after / (1024 * 1024), time.time() - start_time))
+
+# with --image-cache, the tarballs of the node image and the registry image are kept in this
+# directory of --dir; entries that were not used for this many seconds are removed.
+IMAGE_CACHE_DIR = "image-cache"
+IMAGE_CACHE_MAX_AGE = 30 * 24 * 3600
+
+def image_cache(cmd_args):
+    return DownloadCache(os.path.join(cmd_args.temp_dir, IMAGE_CACHE_DIR), \
+            cmd_args.image_cache_size * 1024 * 1024, IMAGE_CACHE_MAX_AGE)
+
+def node_image_cache_key(cmd_args):
+    """ the default node image is that of the kind release, its entry is pinned to the kind version """
+    if cmd_args.node_image != "":
+        return "image/{}".format(cmd_args.node_image)
+    match = re.search(r'v?\d+\.\d+\.\d+', os.environ.get("KIND_VERSION", ""))
+    return "node-image/kind-{}".format(match.group(0) if match is not None else "unknown")
+
+def has_local_image(image):
+    return RunCommand("docker image inspect {}".format(shlex.quote(image))).exit_code == 0
+
+def load_cached_image(cmd_args, key):
+    """ loads the cached tarball of key with docker load, unless docker has the image.
+
+    Returns the name of the cached image, None if there is no cache entry for key.
+    """
+    entry = image_cache(cmd_args).entry(key)
+    if entry is None:
+        return None
+    if not has_local_image(entry["image"]):
+        print("loading {} from the image cache ...".format(entry["image"]))
+        cmd_runner = RunCommand("docker load -i {}".format(shlex.quote(entry["path"])))
+        if cmd_runner.exit_code != 0:
+            show_error("Failed to load image {} from {}: {}".format(entry["image"], entry["path"], \
+                    cmd_runner.make_error_message()))
+    return entry["image"]
+
+def save_image_to_cache(cmd_args, key, image):
+    """ adds the docker save tarball of image to the cache, unless it is cached already.
+
+    An image that was pulled by digest is tagged without the digest first: docker load does
+    not restore the digest, the image is used by its tag once it came from the cache.
+    A failure is only reported, the image is pulled again on a host without the cache.
+    """
+    cache = image_cache(cmd_args)
+    tag = image.split("@")[0]
+    entry = cache.entry(key)
+    if entry is not None and entry["image"] == tag:
+        return
+
+    if tag != image:
+        cmd_runner = RunCommand("docker tag {} {}".format(shlex.quote(image), shlex.quote(tag)))
+        if cmd_runner.exit_code != 0:
+            print("Warning: can't cache image {}: {}".format(image, cmd_runner.make_error_message()))
+            return
+
+    print("saving {} to the image cache ...".format(tag))
+    tmp_file = os.path.join(cache.cache_dir, "save-{}-{}.tar".format(os.getpid(), \
+            hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]))
+    sha256 = hashlib.sha256()
+    try:
+        # the tarball is hashed while it is written, it is not read a second time. The error output
+        # goes to a file: docker save blocks if it is not read while the tarball is.
+        with tempfile.TemporaryFile() as error_file:
+            with open(tmp_file, "wb") as output_file:
+                process = subprocess.Popen(["docker", "save", tag], stdin=subprocess.DEVNULL, \
+                        stdout=subprocess.PIPE, stderr=error_file)
+                try:
+                    while True:
+                        chunk = process.stdout.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sha256.update(chunk)
+                        output_file.write(chunk)
+                finally:
+                    process.stdout.close()
+                    exit_code = process.wait()
+            error_file.seek(0)
+            error_out = error_file.read().decode("utf-8", "replace")
+
+        if exit_code != 0:
+            print("Warning: can't cache image {}: docker save exit status {} {}".\
+                    format(tag, exit_code, error_out.strip()))
+            return
+        cache.store(key, tmp_file, sha256.hexdigest(), image=tag)
+    finally:
+        # the tarball is moved into the cache by store
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def node_image_of_cluster(cmd_args):
+    """ returns the image of the control plane node container of the cluster """
+    cmd_runner = RunCommand("docker inspect -f '{{{{.Config.Image}}}}' {}".\
+            format(shlex.quote("{}-control-plane".format(cmd_args.cluster_name))))
+    if cmd_runner.exit_code != 0:
+        show_error("Failed to get the node image of cluster {}: {}".\
+                format(cmd_args.cluster_name, cmd_runner.make_error_message()))
+    return cmd_runner.output.strip()
+
+class StepGraph:
+    """ runs steps that name the steps they depend on; each step starts as soon as all
+    of its dependencies completed, steps that don't depend on each other run at the same time.
+
+    Each step belongs to a group (i.e. a cluster); when a step fails, the steps that did not
+    start yet and are of the same group, or depend on the failed step, are cancelled.
+    A failing step without group cancels all steps that did not start yet.
+    The steps that are running at the time of the failure are allowed to complete.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, func, depends=None, group=None):
+        """ adds a step, returns its name; dependencies must be added before the step. """
+        depends = [] if depends is None else [dep for dep in depends if dep is not None]
+        for dep in depends:
+            if dep not in self.steps:
+                raise ValueError("step {} depends on unknown step {}".format(name, dep))
+        self.steps[name] = (func, depends, group)
+        return name
+
+    @staticmethod
+    def _run_step(name, func):
+        with TIMINGS.phase(name):
+            func()
+
+    def run(self):
+        """ runs all steps, returns the groups of the steps that failed """
+        done = set()
+        stopped = set()
+        failed_groups = []
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.steps))) as executor:
+            while True:
+                # dependencies come first in self.steps, a cancellation is passed on in one round.
+                for name, (func, depends, group) in self.steps.items():
+                    if name in done or name in stopped or name in running.values():
+                        continue
+                    if None in failed_groups or group in failed_groups or \
+                            any(dep in stopped for dep in depends):
+                        stopped.add(name)
+                        print("*** cancelled: {} ***".format(name))
+                    elif all(dep in done for dep in depends):
+                        running[executor.submit(self._run_step, name, func)] = name
+
+                if len(running) == 0:
+                    break
+
+                finished, _ = concurrent.futures.wait(running, \
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except (SystemExit, Exception) as err:
+                        if not isinstance(err, (SystemExit, KindHelperError)):
+                            print("Error {}: {}".format(name, err))
+                        stopped.add(name)
+                        group = self.steps[name][2]
+                        if group not in failed_groups:
+                            failed_groups.append(group)
+
+        return failed_groups
+
+def for_each_cluster(cmd_args, func):
+    """ calls func for each cluster of --name, all at the same time.
+
+    Returns the names of the clusters where func failed.
+    """
+    names = cmd_args.cluster_names
+    if len(names) == 1:
+        func(named_cluster_args(cmd_args, names[0]))
+        return []
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = {name: executor.submit(func, named_cluster_args(cmd_args, name)) \
+                for name in names}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except KindHelperError:
+                failed.append(name)
+    return failed
 
+def start_cluster(cmd_args):
+    ingress_options = parse_ingress_options(cmd_args)
+    if len(ingress_options) != 0 and len(cmd_args.cluster_names) > 1:
+        show_error("the ingress host ports can't be shared by more than one cluster")
+
+    graph = StepGraph()
+    shared_state = {}
+
+    def fetch_bundle():
+        shared_state["ingress_bundle"] = fetch_ingress_bundle(cmd_args)
+
+    def load_node_image():
+        shared_state["node_image"] = load_cached_image(cmd_args, node_image_cache_key(cmd_args))
+
+    # the registry, the caches and the ingress images only need docker, not the tools of kind.
+    teardown = graph.add("wait for background deletions", lambda: wait_for_teardowns(cmd_args))
+    prerequisites = graph.add("check prerequisites", lambda: check_prerequisites(cmd_args))
+    registry_image = None
+    node_image = None
+    if cmd_args.image_cache:
+        registry_image = graph.add("load cached registry image", \
+                lambda: load_cached_image(cmd_args, "image/" + REGISTRY_IMAGE))
+        # the entry of the default node image is that of the kind version.
+        node_image = graph.add("load cached node image", load_node_image, [prerequisites])
+
+    shared_steps = {
+        "teardown": teardown,
+        "prerequisites": prerequisites,
+        "node image": node_image,
+        "registry": graph.add("start registry", lambda: start_registry(cmd_args), \
+                [teardown, registry_image]),
+        "mirrors": graph.add("start pull-through caches", \
+                lambda: start_mirrors(cmd_args, parse_mirror_options(cmd_args)), [teardown, registry_image]),
+        "ingress bundle": None,
+    }
+    if len(ingress_options) != 0:
+        shared_steps["ingress bundle"] = graph.add("fetch ingress bundle", fetch_bundle)
+
+    for name in cmd_args.cluster_names:
+        add_cluster_steps(graph, named_cluster_args(cmd_args, name), ingress_options, \
+                shared_steps, shared_state)
+
+    if cmd_args.image_cache:
+        # the images are saved once, on a host that did not have them in the cache.
+        first_args = named_cluster_args(cmd_args, cmd_args.cluster_names[0])
+        graph.add("save registry image to cache", lambda: save_image_to_cache(cmd_args, \
+                "image/" + REGISTRY_IMAGE, REGISTRY_IMAGE), [shared_steps["registry"]])
+        graph.add("save node image to cache", lambda: save_image_to_cache(first_args, \
+                node_image_cache_key(first_args), node_image_of_cluster(first_args)), \
+                ["{}: kind create cluster".format(first_args.cluster_name)], first_args.cluster_name)
+
+    failed = graph.run()
+    if None in failed:
+        show_error("Failed to start the clusters")
+    if len(failed) != 0:
+        show_error("Failed to run clusters: {}".format(" ".join(failed)))
+
+    for name in cmd_args.cluster_names:
+        print("*** cluster {} is running, all nodes are ready ***".format(name))
+
+def delete_cluster(cmd_args):
     script = '''
 
     set -ex
 
-${KIND} delete cluster
-
-REG=$(docker ps -a | grep registry:2[[:space:]] | awk '{ print $1 }')
-if [[ $REG != "" ]]; then
-    docker stop $REG
-    docker rm $REG
-    docker network rm kind
-else
-    echo "local registry already stopped"
-fi
+${KIND} delete cluster --name "${cluster_name}"
+rm -f "${KUBECONFIG_FILE}"
 '''
+    run_script(cmd_args, script, "Failed to stop cluster", cluster_env(cmd_args))
+    print("*** cluster {} is deleted ***".format(cmd_args.cluster_name))
+
+def remove_registry(cmd_args):
+    """ removes the container of the local registry (by its name) """
+    cmd_runner = RunCommand("docker rm -f {}".format(shlex.quote(cmd_args.reg_docker_name)))
+    if cmd_runner.exit_code != 0 and "No such container" not in cmd_runner.error_out:
+        show_error("Failed to remove local registry: {}".format(cmd_runner.make_error_message()))
+
+def remove_kind_network(cmd_args):
+    """ removes the docker network of kind, once all nodes and the registry are gone """
+    # the pull-through caches (and the registry with --keep-registry) stay, but they must leave the network.
+    cmd_runner = RunCommand("docker ps -a -q --filter label={}".format(MIRROR_LABEL))
+    for container in cmd_runner.output.split():
+        RunCommand("docker network disconnect kind {}".format(container))
+    if cmd_args.keep_registry:
+        RunCommand("docker network disconnect kind {}".format(shlex.quote(cmd_args.reg_docker_name)))
+
+    cmd_runner = RunCommand("docker network rm kind")
+    # active endpoints: the nodes of a cluster that another process is creating right now.
+    if cmd_runner.exit_code != 0 and "not found" not in cmd_runner.error_out and \
+            "active endpoints" not in cmd_runner.error_out:
+        show_error("Failed to remove the kind network: {}".format(cmd_runner.make_error_message()))
+
+def teardown_state_file(cmd_args):
+    return os.path.join(cmd_args.temp_dir, "teardowns.json")
+
+def read_teardowns(cmd_args):
+    """ the clusters that are being deleted, by the pid of the teardown; dead teardowns are dropped.
+    Call with the registry lock held.
+    """
+    try:
+        with open(teardown_state_file(cmd_args), "r") as input_file:
+            teardowns = json.load(input_file)
+    except (OSError, ValueError):
+        teardowns = {}
+    return {name: pid for name, pid in teardowns.items() if is_process_alive(pid)}
+
+def write_teardowns(cmd_args, teardowns):
+    with open(teardown_state_file(cmd_args), "w") as output_file:
+        json.dump(teardowns, output_file, indent=2)
+
+def begin_teardown(cmd_args, names):
+    """ records the clusters of this teardown; removes the local registry (unless --keep-registry)
+    if no other cluster is left. Returns the names of the clusters that are left.
+
+    The decision is made under the registry lock, before the clusters are deleted: the clusters
+    of teardowns that run at the same time (i.e. of the workers of pytest-xdist) count as gone,
+    the last teardown to begin removes the registry.
+    """
+    with registry_lock(cmd_args):
+        teardowns = read_teardowns(cmd_args)
+        cmd_runner = RunCommand("{} get clusters".format(shlex.quote(os.environ["KIND"])))
+        remaining = [name for name in cmd_runner.output.split() \
+                if name not in names and name not in teardowns]
+        teardowns.update({name: os.getpid() for name in names})
+        write_teardowns(cmd_args, teardowns)
+        if len(remaining) == 0 and not cmd_args.keep_registry:
+            remove_registry(cmd_args)
+    return remaining
+
+def end_teardown(cmd_args, names):
+    """ removes the kind network once the nodes of all clusters are gone: the teardown that
+    ends last finds no cluster left.
+    """
+    with registry_lock(cmd_args):
+        teardowns = read_teardowns(cmd_args)
+        for name in names:
+            teardowns.pop(name, None)
+        write_teardowns(cmd_args, teardowns)
+        cmd_runner = RunCommand("{} get clusters".format(shlex.quote(os.environ["KIND"])))
+        if len(cmd_runner.output.split()) == 0:
+            remove_kind_network(cmd_args)
+
+def teardown_clusters(cmd_args, names):
+    """ deletes the clusters, all at the same time; the local registry is removed at the same
+    time, if no other cluster is left. The prerequisites must have been checked.
+
+    Returns the names of the clusters that could not be deleted.
+    """
+    graph = StepGraph()
+    deletes = [graph.add("{}: delete cluster".format(name), \
+            lambda name=name: delete_cluster(named_cluster_args(cmd_args, name)), group=name) \
+            for name in names]
+
+    mirrors = None
+    if cmd_args.stop_mirror:
+        mirrors = graph.add("stop pull-through caches", lambda: stop_mirrors(cmd_args), \
+                group="registry")
+
+    # the registry is shared by all clusters, it is removed with the last cluster
+    # (unless --keep-registry); its images are kept in the registry storage volume either way.
+    state = {}
+    def remove_unused():
+        state["remaining"] = begin_teardown(cmd_args, names)
+    registry = graph.add("stop registry", remove_unused, group="registry")
+    graph.add("remove kind network", lambda: end_teardown(cmd_args, names), \
+            deletes + [registry, mirrors], group="registry")
+
+    failed = graph.run()
+    if "registry" in failed:
+        show_error("Failed to stop the local registry")
+    if state.get("remaining") == []:
+        print("*** cluster is stopped ***")
+    elif state.get("remaining") is not None:
+        print("*** local registry still used by clusters: {} ***".format(" ".join(state["remaining"])))
+    return [name for name in names if name in failed]
+
+def teardown_lock_file(cmd_args, name):
+    return os.path.join(cmd_args.temp_dir, "teardown-{}.lock".format(name))
+
+def lock_teardown(cmd_args, name):
+    """ locks the teardown lock file of the cluster, returns the open file.
+
+    The lock file is removed when the deletion is done, the lock of a removed file is retried.
+    """
+    lock_file_name = teardown_lock_file(cmd_args, name)
+    while True:
+        lock_file = open(lock_file_name, "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.stat(lock_file_name).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
 
-    bashcmd = "/usr/bin/env bash"
-    if cmd_args.verbose:
-        #print("script: {}".format(script))
-        bashcmd += " -x"
+def remove_teardown_locks(cmd_args):
+    """ removes the lock files of the detached stop (--stop --detach); they are still held """
+    for name in cmd_args.cluster_names:
+        try:
+            os.unlink(teardown_lock_file(cmd_args, name))
+        except FileNotFoundError:
+            pass
 
-    run_start = RunCommand(bashcmd, script, False)
-    if run_start.exit_code == 0:
-        print("*** cluster is stopped ***")
-    else:
-        show_error("Failed to stop cluster: {}".format(run_start.make_error_message()))
+def wait_for_teardowns(cmd_args):
+    """ waits until the background deletions (--stop --detach) are done.
 
+    The deletion of the last cluster removes the local registry and the network,
+    a start must wait for all of them, not only for those of the same name.
+    """
+    for lock_file_name in sorted(glob.glob(teardown_lock_file(cmd_args, "*"))):
+        try:
+            lock_file = open(lock_file_name, "r")
+        except FileNotFoundError:
+            # the deletion is done
+            continue
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("waiting for the deletion of cluster {} ...".\
+                        format(os.path.basename(lock_file_name)[len("teardown-"):-len(".lock")]))
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+STOP_OPTIONS = [
+    ("cluster_names", "--name"),
+    ("stop_mirror", "--stop-mirror"),
+    ("keep_registry", "--keep-registry"),
+    ("reg_docker_port", "--registry-port"),
+    ("reg_docker_name", "--registry-name"),
+    ("temp_dir", "--dir"),
+    ("platform", "--plat"),
+    ("kind_version", "--kind-version"),
+    ("kubectl_version", "--kubectl-version"),
+    ("verbose", "--verbose"),
+]
+
+def stop_in_background(cmd_args):
+    """ starts a detached process of this script that deletes the clusters, returns at once.
+
+    The process holds a lock per cluster (it inherits the locked files), a later --start of
+    a cluster of the same name waits for the deletion to complete.
+    """
+    os.makedirs(os.path.join(cmd_args.temp_dir, "logs"), 0o755, exist_ok=True)
+    lock_files = [lock_teardown(cmd_args, name) for name in cmd_args.cluster_names]
+
+    command_line = [sys.executable, os.path.abspath(__file__), "--stop", "--teardown-locks"] + \
+            options_command_line(cmd_args, STOP_OPTIONS)
+    log_file_name = os.path.join(cmd_args.temp_dir, "logs", "stop.log")
+    with open(log_file_name, "a") as log_file:
+        subprocess.Popen(command_line, stdin=subprocess.DEVNULL, stdout=log_file, \
+                stderr=subprocess.STDOUT, start_new_session=True, \
+                pass_fds=[lock_file.fileno() for lock_file in lock_files])
+    for lock_file in lock_files:
+        lock_file.close()
+
+    print("*** clusters {} are deleted in the background, log: {} ***".\
+            format(" ".join(cmd_args.cluster_names), log_file_name))
 
 def stop_cluster(cmd_args):
+    if cmd_args.detach:
+        stop_in_background(cmd_args)
+        return
+
+    try:
+        with TIMINGS.phase("check prerequisites"):
+            check_prerequisites(cmd_args)
+
+        failed = teardown_clusters(cmd_args, cmd_args.cluster_names)
+    finally:
+        if cmd_args.teardown_locks:
+            remove_teardown_locks(cmd_args)
+    if len(failed) != 0:
+        show_error("Failed to stop clusters: {}".format(" ".join(failed)))
+
+# namespaces that are kept when a pool cluster is reset
+SYSTEM_NAMESPACES = ["default", "kube-system", "kube-public", "kube-node-lease", \
+        "local-path-storage", "ingress-nginx"]
+
+# objects of the default namespace that are kept when a pool cluster is reset (by name): they are
+# created by the control plane, service/kubernetes and configmap/kube-root-ca.crt.
+SYSTEM_OBJECT_NAMES = ["kubernetes", "kube-root-ca.crt"]
+
+# the cluster scoped objects that a pool cluster reset deletes, if they were created after the claim;
+# webhooks first, they could reject the other deletes.
+POOL_RESET_CLUSTER_COLLECTIONS = [
+    "/apis/admissionregistration.k8s.io/v1/validatingwebhookconfigurations",
+    "/apis/admissionregistration.k8s.io/v1/mutatingwebhookconfigurations",
+    "/apis/apiextensions.k8s.io/v1/customresourcedefinitions",
+    "/apis/apiregistration.k8s.io/v1/apiservices",
+    "/apis/rbac.authorization.k8s.io/v1/clusterrolebindings",
+    "/apis/rbac.authorization.k8s.io/v1/clusterroles",
+    "/apis/scheduling.k8s.io/v1/priorityclasses",
+    "/apis/storage.k8s.io/v1/storageclasses",
+    "/apis/networking.k8s.io/v1/ingressclasses",
+    "/api/v1/persistentvolumes",
+]
+
+def pool_spec(cmd_args):
+    """ short id of the cluster topology, all clusters of a pool have the same spec """
+    spec = {"masters": cmd_args.num_masters, "workers": cmd_args.num_workers, \
+            "ingress": parse_ingress_options(cmd_args), "mirrors": parse_mirror_options(cmd_args), \
+            "node_image": cmd_args.node_image}
+    if len(spec["ingress"]) != 0:
+        spec["ingress_version"] = cmd_args.ingress_version
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+
+def pool_dir(cmd_args):
+    return os.path.join(cmd_args.temp_dir, "pool")
+
+@contextlib.contextmanager
+def pool_state(cmd_args):
+    """ locked read-modify-write of the pool state file """
+    os.makedirs(pool_dir(cmd_args), 0o755, exist_ok=True)
+    state_file = os.path.join(pool_dir(cmd_args), "pool.json")
+
+    with file_lock(state_file + ".lock"):
+        try:
+            with open(state_file, "r") as input_file:
+                state = json.load(input_file)
+        except (OSError, ValueError):
+            state = {"clusters": {}}
+
+        yield state
+
+        tmp_file = "{}.{}.tmp".format(state_file, os.getpid())
+        with open(tmp_file, "w") as output_file:
+            json.dump(state, output_file, indent=2)
+        os.replace(tmp_file, state_file)
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def pool_remember_spec(state, cmd_args):
+    """ the pool state keeps the topology and size of each spec, for releasing and refilling """
+    state.setdefault("specs", {})[pool_spec(cmd_args)] = {"masters": cmd_args.num_masters, \
+            "workers": cmd_args.num_workers, "ingress": list(cmd_args.ingress), \
+            "size": cmd_args.pool_size, "mirror": cmd_args.mirror, \
+            "mirror_upstream": cmd_args.mirror_upstream, "node_image": cmd_args.node_image, \
+            "ingress_version": cmd_args.ingress_version}
+
+def pool_spec_args(cmd_args, state, spec):
+    spec_args = copy.copy(cmd_args)
+    spec_entry = state.get("specs", {}).get(spec)
+    if spec_entry is not None:
+        spec_args.num_masters = spec_entry["masters"]
+        spec_args.num_workers = spec_entry["workers"]
+        spec_args.ingress = spec_entry["ingress"]
+        spec_args.pool_size = spec_entry["size"]
+        spec_args.mirror = spec_entry["mirror"]
+        spec_args.mirror_upstream = spec_entry["mirror_upstream"]
+        spec_args.node_image = spec_entry.get("node_image", cmd_args.node_image)
+        spec_args.ingress_version = spec_entry.get("ingress_version", cmd_args.ingress_version)
+    return spec_args
+
+def pool_drop_dead_entries(state, spec):
+    """ removes the entries of processes that died while creating the cluster (fill or claim) """
+    for name in pool_clusters(state, spec, "creating") + pool_clusters(state, spec, "claiming"):
+        if not is_process_alive(state["clusters"][name]["pid"]):
+            del state["clusters"][name]
+
+def pool_clusters(state, spec, cluster_state=None):
+    return sorted(name for name, entry in state["clusters"].items() \
+            if entry["spec"] == spec and (cluster_state is None or entry["state"] == cluster_state))
+
+def pool_create_cluster(cmd_args, name):
+    """ creates one cluster of the pool, returns True on success """
+    try:
+        start_cluster(named_cluster_args(cmd_args, name))
+        return True
+    except KindHelperError:
+        return False
+
+def pool_fill(cmd_args):
+    """ creates clusters until the pool has --pool-size unclaimed clusters of this spec """
+
+    spec = pool_spec(cmd_args)
+    with_ingress = len(parse_ingress_options(cmd_args)) != 0
+    if cmd_args.pool_size > 1 and with_ingress:
+        show_error("the ingress host ports can't be shared by more than one cluster of the pool")
+
+    os.makedirs(pool_dir(cmd_args), 0o755, exist_ok=True)
+
+    # only one process fills the pool at a time.
+    with file_lock(os.path.join(pool_dir(cmd_args), "fill.lock")):
+        while True:
+            with pool_state(cmd_args) as state:
+                pool_remember_spec(state, cmd_args)
+                pool_drop_dead_entries(state, spec)
+
+                available = len(pool_clusters(state, spec, "ready")) + \
+                        len(pool_clusters(state, spec, "creating"))
+                if with_ingress:
+                    # the host ports of a claimed cluster are still taken.
+                    available = len(pool_clusters(state, spec))
+                if available >= cmd_args.pool_size:
+                    break
+
+                index = 0
+                while "pool-{}-{}".format(spec, index) in state["clusters"]:
+                    index += 1
+                name = "pool-{}-{}".format(spec, index)
+                state["clusters"][name] = {"spec": spec, "state": "creating", \
+                        "pid": os.getpid(), "kubeconfig": kubeconfig_file(cmd_args, name), \
+                        "time": time.time()}
+
+            print("*** pool: creating cluster {} ***".format(name))
+            created = pool_create_cluster(cmd_args, name)
+
+            with pool_state(cmd_args) as state:
+                if created:
+                    state["clusters"][name]["state"] = "ready"
+                    state["clusters"][name]["time"] = time.time()
+                else:
+                    del state["clusters"][name]
+            if not created:
+                show_error("pool: failed to create cluster {}".format(name))
+
+    print("*** pool: {} clusters of spec {} are ready ***".format(cmd_args.pool_size, spec))
+
+# options of the background fill process: (attribute of cmd_args, command line option)
+POOL_FILL_OPTIONS = [
+    ("pool_size", "--pool-size"),
+    ("num_masters", "--masters"),
+    ("num_workers", "--workers"),
+    ("ingress", "--ingress"),
+    ("ingress_version", "--ingress-version"),
+    ("timeout", "--timeout"),
+    ("wait_system_pods", "--wait-system-pods"),
+    ("reg_docker_port", "--registry-port"),
+    ("reg_docker_name", "--registry-name"),
+    ("reg_storage", "--registry-storage"),
+    ("mirror", "--mirror"),
+    ("mirror_upstream", "--mirror-upstream"),
+    ("temp_dir", "--dir"),
+    ("platform", "--plat"),
+    ("kind_version", "--kind-version"),
+    ("kubectl_version", "--kubectl-version"),
+    ("node_image", "--node-image"),
+    ("image_cache", "--image-cache"),
+    ("image_cache_size", "--image-cache-size"),
+]
+
+def options_command_line(cmd_args, options):
+    """ returns the command line options that pass on the values of options: list of (dest, option) """
+    command_line = []
+    for dest, option in options:
+        value = getattr(cmd_args, dest)
+        if isinstance(value, bool):
+            if value:
+                command_line.append(option)
+        elif isinstance(value, (list, tuple)):
+            if len(value) != 0:
+                command_line += [option] + [str(item) for item in value]
+        elif value is not None and value != "":
+            # an empty string is the default of the option (i.e. --ingress, --node-image)
+            command_line += [option, str(value)]
+    return command_line
+
+def pool_refill_in_background(cmd_args):
+    """ starts a detached process of this script that fills the pool again """
+
+    command_line = [sys.executable, os.path.abspath(__file__), "--pool-fill"] + \
+            options_command_line(cmd_args, POOL_FILL_OPTIONS)
+
+    log_file_name = os.path.join(pool_dir(cmd_args), "fill.log")
+    with open(log_file_name, "a") as log_file:
+        subprocess.Popen(command_line, stdin=subprocess.DEVNULL, stdout=log_file, \
+                stderr=subprocess.STDOUT, start_new_session=True)
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """ sends the output of this process and of its child processes to stderr """
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+
+def pool_claim(cmd_args):
+    """ hands out a ready cluster of the pool: prints the cluster name and its kubeconfig.
+
+    The pool is refilled with the options of its last --pool-fill (size, registry ...),
+    the claim only needs the options of the spec.
+    """
+
+    spec = pool_spec(cmd_args)
+    with pool_state(cmd_args) as state:
+        refill_args = pool_spec_args(cmd_args, state, spec)
+        pool_drop_dead_entries(state, spec)
+        ready = pool_clusters(state, spec, "ready")
+        name = None
+        if len(ready) != 0:
+            name = ready[0]
+            state["clusters"][name].update({"state": "claimed", "time": time.time()})
+
+    if name is None:
+        # empty pool: create a cluster for this claim right now.
+        with pool_state(cmd_args) as state:
+            index = 0
+            while "pool-{}-{}".format(spec, index) in state["clusters"]:
+                index += 1
+            name = "pool-{}-{}".format(spec, index)
+            # the entry of a claim that dies while creating the cluster is dropped (by its pid).
+            state["clusters"][name] = {"spec": spec, "state": "claiming", "pid": os.getpid(), \
+                    "kubeconfig": kubeconfig_file(cmd_args, name), "time": time.time()}
+
+        # the output of the creation must not mix with the result on stdout.
+        with stdout_to_stderr():
+            created = pool_create_cluster(cmd_args, name)
+        with pool_state(cmd_args) as state:
+            if created:
+                state["clusters"][name] = {"spec": spec, "state": "claimed", \
+                        "kubeconfig": kubeconfig_file(cmd_args, name), "time": time.time()}
+            else:
+                del state["clusters"][name]
+        if not created:
+            show_error("pool: failed to create cluster {}".format(name))
+
+    pool_refill_in_background(refill_args)
+    print("{} {}".format(name, kubeconfig_file(cmd_args, name)))
+
+def creation_time(obj):
+    """ the creationTimestamp of the object in seconds since the epoch """
+    return calendar.timegm(time.strptime(obj["metadata"]["creationTimestamp"], "%Y-%m-%dT%H:%M:%SZ"))
+
+def pool_delete_cluster_objects(client, since):
+    """ deletes the cluster scoped objects created since the claim (the system objects are older) """
+    for collection in POOL_RESET_CLUSTER_COLLECTIONS:
+        for obj in client.get(collection)["items"]:
+            # the api services of custom resources are managed by the api server.
+            if creation_time(obj) < int(since) or \
+                    "kube-aggregator.kubernetes.io/automanaged" in (obj["metadata"].get("labels") or {}):
+                continue
+            try:
+                client.request("DELETE", "{}/{}".format(collection, obj["metadata"]["name"]))
+            except KubeApiError as err:
+                if err.status != 404:
+                    raise
+
+def pool_reset_cluster(cmd_args, name, since):
+    """ deletes everything the user created in the namespaces of the cluster, and the cluster
+    scoped objects created since the claim (time since)
+    """
+    kubeconfig = kubeconfig_file(cmd_args, name)
+    client = KubeClient(kubeconfig)
+    pool_delete_cluster_objects(client, since)
+    namespaces = [item["metadata"]["name"] for item in client.get("/api/v1/namespaces")["items"]]
+
+    kubectl = "{} --kubeconfig {}".format(shlex.quote(os.environ["KUBECTL"]), shlex.quote(kubeconfig))
+    keep = ",".join("metadata.name!={}".format(name) for name in SYSTEM_OBJECT_NAMES)
+    commands = ["{} delete all,ingress,configmap,secret,role,rolebinding,pvc \
+--field-selector {} --namespace default --wait=true".format(kubectl, keep)]
+    user_namespaces = [namespace for namespace in namespaces if namespace not in SYSTEM_NAMESPACES]
+    if len(user_namespaces) != 0:
+        commands.append("{} delete namespace --wait=true {}".format(kubectl, " ".join(user_namespaces)))
+
+    for command in commands:
+        cmd_runner = RunCommand(command)
+        if cmd_runner.exit_code != 0:
+            raise KubeApiError(cmd_runner.make_error_message())
+
+def pool_release(cmd_args):
+    """ gives a claimed cluster back to the pool; it is reset, or deleted with --pool-recycle """
+
+    name = cmd_args.pool_release
+    with pool_state(cmd_args) as state:
+        entry = state["clusters"].get(name)
+        if entry is None or entry["state"] != "claimed":
+            show_error("pool: cluster {} is not claimed".format(name))
+        entry["state"] = "releasing"
+        claim_time = entry["time"]
+        cmd_args = pool_spec_args(cmd_args, state, entry["spec"])
+
     check_prerequisites(cmd_args)
-    stop_cluster_imp(cmd_args)
 
-#def use_image(cmd_args):
-#    check_prerequisites(cmd_args)
-#
-#    cmd = '{} load docker-image {}'.format(os.environ["KIND"], cmd_args.image)
-#    run_start = RunCommand(cmd, None, True)
-#    if run_start.exit_code == 0:
-#        print("*** image imported ***")
-#    else:
-#        show_error("Failed to import image to kind cluster: {}".\
-#           format(run_start.make_error_message()))
-#
+    recycle = cmd_args.pool_recycle
+    if not recycle:
+        try:
+            pool_reset_cluster(cmd_args, name, claim_time)
+        except KubeApiError as err:
+            print("pool: failed to reset cluster {}: {}. recycling it".format(name, err))
+            recycle = True
+
+    if recycle:
+        with pool_state(cmd_args) as state:
+            del state["clusters"][name]
+        stop_in_background(named_cluster_args(cmd_args, name))
+        pool_refill_in_background(cmd_args)
+    else:
+        with pool_state(cmd_args) as state:
+            state["clusters"][name].update({"state": "ready", "time": time.time()})
+    print("*** pool: cluster {} released ***".format(name))
+
+def pool_drain(cmd_args):
+    """ deletes all clusters of the pool with this spec """
+
+    spec = pool_spec(cmd_args)
+    with pool_state(cmd_args) as state:
+        names = pool_clusters(state, spec)
+        for name in names:
+            del state["clusters"][name]
+
+    if len(names) != 0:
+        cmd_args.cluster_names = names
+        stop_in_background(cmd_args)
+
+KIND_CLUSTER_LABEL = "io.x-k8s.kind.cluster"
+KIND_ROLE_LABEL = "io.x-k8s.kind.role"
+
+def list_cluster_nodes(cmd_args):
+    """ returns the node containers of the cluster: list of (container id, node name, role) """
+    command_line = "docker ps --no-trunc --filter label={}={} --format '{{{{.ID}}}}\\t{{{{.Names}}}}\\t\
+{{{{.Label \"{}\"}}}}'".format(KIND_CLUSTER_LABEL, cmd_args.cluster_name, KIND_ROLE_LABEL)
+    cmd_runner = RunCommand(command_line)
+    if cmd_runner.exit_code != 0:
+        show_error("Failed to list nodes of cluster {}: {}".\
+                format(cmd_args.cluster_name, cmd_runner.make_error_message()))
+
+    nodes = []
+    for line in cmd_runner.output.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 3:
+            nodes.append(tuple(fields))
+    return sorted(nodes, key=lambda node: node[1])
+
+def image_index_file(cmd_args):
+    return "{}/image-index-{}.json".format(cmd_args.temp_dir, cmd_args.cluster_name)
+
+def load_image_index(cmd_args, nodes):
+    """ returns the image ids loaded into each node: node container id -> image name -> image id """
+    try:
+        with open(image_index_file(cmd_args), "r") as input_file:
+            index = json.load(input_file)
+    except (OSError, ValueError):
+        index = {}
+    # a node container that no longer exists took its images with it.
+    return {node_id: index.get(node_id, {}) for node_id, _, _ in nodes}
+
+def save_image_index(cmd_args, index):
+    tmp_file = "{}.{}.tmp".format(image_index_file(cmd_args), os.getpid())
+    with open(tmp_file, "w") as output_file:
+        json.dump(index, output_file, indent=2)
+    os.replace(tmp_file, image_index_file(cmd_args))
+
+def image_ids(images):
+    cmd_runner = RunCommand("docker image inspect -f '{{{{.Id}}}}' {}".\
+            format(" ".join(shlex.quote(image) for image in images)))
+    if cmd_runner.exit_code != 0:
+        show_error("Failed to inspect images: {}".format(cmd_runner.make_error_message()))
+    return dict(zip(images, cmd_runner.output.split()))
+
+def import_image_archive(node_name, archive):
+    """ imports an archive of docker save into the containerd of a node """
+    command_line = ["docker", "exec", "-i", node_name, "ctr", "--namespace=k8s.io", \
+            "images", "import", "--all-platforms", "--digests", "-"]
+    start_time = time.time()
+    with open(archive, "rb") as input_file:
+        process = subprocess.run(command_line, stdin=input_file, \
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    TIMINGS.add_process(" ".join(command_line), start_time, process.returncode)
+    return process.returncode, process.stderr.decode("utf-8")
+
+def load_images(cmd_args):
+    check_prerequisites(cmd_args)
+    load_images_into_nodes(cmd_args, cmd_args.images)
+
+def load_images_into_nodes(cmd_args, images, node_filter=None):
+    """ loads docker images into all nodes of the cluster (or those accepted by node_filter), in parallel.
+
+    An index of the image ids that were loaded into each node container is kept, images
+    that did not change since they were last loaded are skipped.
+    """
+    all_nodes = list_cluster_nodes(cmd_args)
+    if len(all_nodes) == 0:
+        show_error("cluster {} has no nodes. is it running?".format(cmd_args.cluster_name))
+    nodes = [node for node in all_nodes if node_filter is None or node_filter(node[1])]
+
+    ids = image_ids(images)
+    index = load_image_index(cmd_args, nodes)
+
+    # nodes that need the same set of images share one archive of docker save.
+    missing_images = {}
+    for node_id, node_name, _ in nodes:
+        missing = tuple(image for image in images \
+                if cmd_args.image_force or index[node_id].get(image) != ids[image])
+        if len(missing) != 0:
+            missing_images.setdefault(missing, []).append((node_id, node_name))
+        for image in images:
+            if image not in missing:
+                print("{}: {} is up to date".format(node_name, image))
+
+    if len(missing_images) == 0:
+        print("*** all images are up to date ***")
+        return
+
+    start_time = time.time()
+    failed = 0
+    with tempfile.TemporaryDirectory(dir=cmd_args.temp_dir) as tmp_dir, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, cmd_args.jobs)) as executor:
+
+        def save_images(archive_index, images):
+            archive = os.path.join(tmp_dir, "images-{}.tar".format(archive_index))
+            cmd_runner = RunCommand("docker save -o {} {}".format(shlex.quote(archive), \
+                    " ".join(shlex.quote(image) for image in images)))
+            if cmd_runner.exit_code != 0:
+                show_error("Failed to save images: {}".format(cmd_runner.make_error_message()))
+            return archive
+
+        archives = {images: executor.submit(save_images, archive_index, images) \
+                for archive_index, images in enumerate(missing_images)}
+
+        def load_node(images, node_name):
+            archive = archives[images].result()
+            node_start = time.time()
+            exit_code, error_out = import_image_archive(node_name, archive)
+            return exit_code, error_out, time.time() - node_start
+
+        futures = [(images, node_id, node_name, executor.submit(load_node, images, node_name)) \
+                for images, node_list in missing_images.items() for node_id, node_name in node_list]
+
+        for images, node_id, node_name, future in futures:
+            exit_code, error_out, duration = future.result()
+            if exit_code == 0:
+                print("{}: loaded {} in {:.1f} seconds".format(node_name, " ".join(images), duration))
+                for image in images:
+                    index[node_id][image] = ids[image]
+            else:
+                failed += 1
+                print("{}: failed to load {}: {}".format(node_name, " ".join(images), error_out))
 
-def parse_cmd_line():
+    save_image_index(cmd_args, index)
+    if failed != 0:
+        show_error("Failed to import images into {} nodes".format(failed))
+    print("*** images imported in {:.1f} seconds ***".format(time.time() - start_time))
+
+def make_parser():
     usage = '''
 This program automates creation of useful k8s clusters by means of utilising the kind utility.
 
@@ -489,22 +2922,43 @@ It runs a local docker registry and can be used
     group.add_argument('--start', '-s', action='store_true', default=False, dest='isstart',\
             help='start k8s kind cluster & local docker registry')
 
+    name_opt = group.add_argument('--name', '-a', type=str, nargs='+', \
+            default=[DEFAULT_CLUSTER_NAME], dest='cluster_names', \
+            help='name of the cluster. --start and --stop accept several names, the clusters are \
+created/deleted at the same time and share the local registry')
+
     group.add_argument('--masters', '-m', type=int, default=1, dest='num_masters',\
             help='number of master nodes')
 
     group.add_argument('--workers', '-w', type=int, default=1, dest='num_workers',\
             help='number of worker nodes')
 
-    group.add_argument('--timeout', '-t', type=int, default="120", \
+    timeout_opt = group.add_argument('--timeout', '-t', type=int, default="120", \
             dest='timeout', help='timeout while waiting for nodes to become ready')
 
-    group.add_argument('--registry-port', '-p', type=int, default=5000,\
+    group.add_argument('--node-image', type=str, default="", dest='node_image', \
+            help='node image of the cluster (kind create cluster --image), the default is the \
+node image of the kind release')
+
+    group.add_argument('--reuse', action='store_true', default=False, dest='reuse', \
+            help='keep a running cluster of the same name if it has the same spec (nodes, ingress, \
+registry, node image) and is healthy; otherwise it is deleted and created again')
+
+    group.add_argument('--wait-system-pods', action='store_true', default=False, \
+            dest='wait_system_pods', \
+            help='after the nodes are ready: also wait for the kube-system pods (CoreDNS, CNI) to be ready')
+
+    reg_port_opt = group.add_argument('--registry-port', '-p', type=int, default=5000,\
             dest='reg_docker_port',\
             help='number of docker registery port')
 
-    group.add_argument('--registry-name', '-n', type=str, default="kind-registry", \
+    reg_name_opt = group.add_argument('--registry-name', '-n', type=str, default="kind-registry", \
             dest='reg_docker_name', help='docker registery name')
 
+    group.add_argument('--registry-storage', type=str, default="", dest='reg_storage', \
+            help='docker volume (or absolute path of a host directory) with the images of the \
+local registry; they are kept when the registry is removed. Default: <registry name>-storage')
+
 
     group.add_argument('--ingress', '-i', type=str, nargs='+', default="",\
             dest='ingress',\
@@ -512,6 +2966,20 @@ It runs a local docker registry and can be used
 Add multiple values of the following form <external-port>:<internal-port;\
 first is the port visible from outside the cluster, second is the port inside the cluster')
 
+    group.add_argument('--ingress-version', type=str, default="controller-v1.10.1", \
+            dest='ingress_version', help='version (git tag) of ingress-nginx used with --ingress. \
+The manifest and the images are kept in the --dir directory and loaded into the nodes \
+before the ingress is deployed')
+
+    group.add_argument('--mirror', action='store_true', default=False, dest='mirror', \
+            help='run a pull-through cache for docker.io, registry.k8s.io and quay.io next to the \
+local registry; the nodes pull images of these registries through the cache. \
+The cache is kept when the cluster is stopped')
+
+    group.add_argument('--mirror-upstream', type=str, nargs='+', default=[], \
+            dest='mirror_upstream', help='with --mirror: add or change the upstream registry of a \
+cache, values of the form <registry>=<url>, for example docker.io=http://my-registry:5000')
+
     dir_opt = group.add_argument('--dir', '-d', type=str, dest='temp_dir', default="$HOME/kind-tmp-dir",\
             help='if kind or kubectl tools not found then try to download to this directory')
 
@@ -521,78 +2989,1171 @@ first is the port visible from outside the cluster, second is the port inside th
     verbose_opt = group.add_argument('--verbose', '-v', action='store_true', default=False, \
             dest='verbose', help='verbose output')
 
+    kind_version_opt = group.add_argument('--kind-version', type=str, dest='kind_version', \
+            default="latest", help='version of kind to download (if needed), for example v0.20.0')
+
+    kubectl_version_opt = group.add_argument('--kubectl-version', type=str, \
+            dest='kubectl_version', default="latest", \
+            help='version of kubectl to download (if needed), for example v1.27.3')
+
+    cache_size_opt = group.add_argument('--cache-size', type=int, dest='cache_size', default=512, \
+            help='maximum size (MB) of the cache for downloaded kind and kubectl binaries')
+
+    group.add_argument('--image-cache', action='store_true', default=False, \
+            dest='image_cache', help='keep docker save tarballs of the node image (pinned to the kind \
+version) and of the registry image in the --dir directory; they are loaded with docker load when \
+docker does not have them, so that a new host starts the cluster without pulling the images')
+
+    group.add_argument('--image-cache-size', type=int, dest='image_cache_size', \
+            default=4096, help='maximum size (MB) of the image cache; the least recently used \
+tarballs are removed, and those that were not used for 30 days')
+
+    timings_opt = group.add_argument('--timings-json', type=str, default="", dest='timings_json', \
+            help='write the duration of each phase of the run, and of each process \
+it started, to this json file')
+
+    refresh_opt = group.add_argument('--refresh-tools', action='store_true', default=False, \
+            dest='refresh_tools', \
+            help='ignore the cached location of docker, kind and kubectl, search them again')
+
     group = parse.add_argument_group("Stop the cluster")
 
     group.add_argument('--stop', '-k', action='store_true', default=False, dest='isstop',\
             help='stop k8s kind cluster & local docker registry')
 
+    group.add_argument('--stop-mirror', action='store_true', default=False, dest='stop_mirror',\
+            help='also remove the pull-through caches of --mirror (the cached images are kept \
+in docker volumes)')
+
+    group.add_argument('--keep-registry', action='store_true', default=False, dest='keep_registry',\
+            help='do not remove the local registry container with the last cluster')
+
+    group.add_argument('--detach', action='store_true', default=False, dest='detach',\
+            help='return at once, the clusters are deleted by a background process (log in \
+logs/stop.log of the --dir directory); a --start of the same cluster waits for the deletion')
+
+    # the background process of --detach holds the teardown locks (it inherits the locked files)
+    group.add_argument('--teardown-locks', action='store_true', default=False, dest='teardown_locks',\
+            help=argparse.SUPPRESS)
+
     # that's the trick for having the same option in two groups
     group._group_actions.append(dir_opt)
     group._group_actions.append(plat_opt)
     group._group_actions.append(verbose_opt)
+    group._group_actions.append(kind_version_opt)
+    group._group_actions.append(kubectl_version_opt)
+    group._group_actions.append(cache_size_opt)
+    group._group_actions.append(refresh_opt)
+    group._group_actions.append(timings_opt)
+    group._group_actions.append(name_opt)
+
+    group = parse.add_argument_group("pool of ready clusters (the cluster options of --start apply)")
+
+    group.add_argument('--pool-fill', action='store_true', default=False, dest='pool_fill',\
+            help='create clusters until the pool has --pool-size ready clusters')
+
+    group.add_argument('--pool-size', type=int, default=1, dest='pool_size',\
+            help='number of ready clusters that are kept in the pool')
+
+    group.add_argument('--pool-claim', action='store_true', default=False, dest='pool_claim',\
+            help='take a ready cluster from the pool; prints the cluster name and the path of its \
+kubeconfig. The pool is filled up again in the background')
+
+    group.add_argument('--pool-release', type=str, default="", dest='pool_release',\
+            help='give the claimed cluster with this name back to the pool, the namespaces of the \
+cluster are cleared')
+
+    group.add_argument('--pool-recycle', action='store_true', default=False, dest='pool_recycle',\
+            help='with --pool-release: delete the cluster instead of clearing it, a new one is created')
+
+    group.add_argument('--pool-drain', action='store_true', default=False, dest='pool_drain',\
+            help='delete all clusters of the pool')
 
     group = parse.add_argument_group("add docker image to cluster")
 
-#    group.add_argument('--image', '-i', type=str, dest='image', default="",\
-#            help='load docker image so that it is accessible from kind cluster')
-#
-#
-#    # that's the trick for having the same option in two groups
-#    group._group_actions.append(dir_opt)
-#    group._group_actions.append(plat_opt)
-#    group._group_actions.append(verbose_opt)
-#
+    group.add_argument('--image', type=str, nargs='+', dest='images', default=[],\
+            help='load docker images into all nodes of the cluster (at the same time). \
+Images that did not change since they were last loaded into a node are skipped')
+
+    group.add_argument('--image-force', action='store_true', default=False, dest='image_force',\
+            help='load the images of --image even if they did not change')
 
-    group = parse.add_argument_group("get shell to node")
+    jobs_opt = group.add_argument('--jobs', '-j', type=int, dest='jobs', default=8,\
+            help='number of commands that run at the same time (for --image, --node-exec, --kubectl-batch, \
+--apply, --diagnostics and --registry-gc)')
+
+    # that's the trick for having the same option in two groups
+    group._group_actions.append(dir_opt)
+    group._group_actions.append(name_opt)
+    group._group_actions.append(verbose_opt)
+
+    group = parse.add_argument_group("prune the images of the local registry")
+
+    group.add_argument('--registry-gc', action='store_true', default=False, dest='reg_gc',\
+            help='delete the images of the local registry that are older than --registry-gc-age, \
+and the least recently pushed images beyond --registry-gc-size; then remove the blobs that no image refers to')
+
+    group.add_argument('--registry-gc-age', type=float, default=0, dest='reg_gc_age',\
+            help='with --registry-gc: delete images pushed more than this number of days ago \
+(0: no age limit); an image that is pushed again counts from the new push')
+
+    group.add_argument('--registry-gc-size', type=int, default=0, dest='reg_gc_size',\
+            help='with --registry-gc: keep the most recently pushed images that fit into this size (MB) \
+(0: no size limit)')
+
+    group._group_actions.append(reg_port_opt)
+    group._group_actions.append(reg_name_opt)
+    group._group_actions.append(jobs_opt)
+
+    group = parse.add_argument_group("get shell to node, run a command on the nodes")
 
     group.add_argument('--node', '-e', type=str, dest='node', default="",\
-            help='run shell in kind cluster node with this name')
+            help='run shell in kind cluster node with this name (the cluster name is added \
+if the node name does not start with it)')
+
+    group.add_argument('--node-exec', '-x', type=str, dest='node_exec', default="",\
+            help='run this shell command on all nodes of the cluster, --jobs of them at the same time; \
+the output lines are prefixed with the node name')
+
+    group.add_argument('--node-role', type=str, dest='node_role', default="all",\
+            choices=["all", "control-plane", "worker"], help='with --node-exec: run the command on \
+the nodes of this role only')
+
+    group._group_actions.append(name_opt)
+    group._group_actions.append(jobs_opt)
+
+    group = parse.add_argument_group("sample the resource usage of the nodes")
+
+    group.add_argument('--monitor', type=str, dest='monitor', default="",\
+            help='sample cpu, memory, io and pressure (psi) of each node container and of the host \
+into this csv file, until --monitor-duration seconds passed or the process is stopped by \
+SIGINT/SIGTERM; then show the average and peak usage per node. Reads the cgroup files directly, \
+the sampling adds almost no load')
+
+    group.add_argument('--monitor-interval', type=float, dest='monitor_interval', default=1.0,\
+            help='seconds between two samples of --monitor')
+
+    group.add_argument('--monitor-duration', type=float, dest='monitor_duration', default=0,\
+            help='stop --monitor after this number of seconds (0: until stopped by SIGINT/SIGTERM)')
+
+    group._group_actions.append(name_opt)
+    group._group_actions.append(dir_opt)
 
     group = parse.add_argument_group("kubectl wrapper - run kubectl on kind cluster")
 
     group.add_argument('--kubectl', '-c', type=str, dest='kubectl', default="",\
             help='value of options is a command line that is passed to kubectl with kind cluster config')
 
+    group.add_argument('--kubectl-batch', '-b', type=str, dest='kubectl_batch', default="",\
+            help='file with one kubectl command line per line (- for standard input); \
+runs all of them with one start of this program, the output is shown in the order of the input')
+
+    group.add_argument('--apply', '-f', type=str, nargs='+', dest='apply', default=[],\
+            help='apply the manifest files (of a directory: its .yaml, .yml and .json files) in one \
+pass: namespaces and CRDs first, then RBAC, config and services, then the workloads; the objects of \
+each group are applied at the same time (server side apply). Then wait for the rollout of all \
+Deployments, DaemonSets, StatefulSets and Ingresses at the same time, within --timeout seconds')
+
+    group.add_argument('--apply-no-wait', action='store_true', default=False, dest='apply_no_wait',\
+            help='with --apply: do not wait for the rollout')
+
+    group.add_argument('--diagnostics', '-g', type=str, dest='diagnostics', default="",\
+            help='write the objects, events, describe output, container logs and node logs of the \
+cluster into this compressed tar file (.tar.gz), fetching --jobs of them at the same time')
+
     # that's the trick for having the same option in two groups
+    group._group_actions.append(jobs_opt)
     group._group_actions.append(dir_opt)
+    group._group_actions.append(name_opt)
+    group._group_actions.append(timeout_opt)
 
+    return parse
+
+def parse_cmd_line():
+    parse = make_parser()
     return parse.parse_args(), parse
 
-def run_shell(node_name):
+def run_shell(cmd_args):
+    node_name = cmd_args.node
+    if not node_name.startswith(cmd_args.cluster_name + "-"):
+        node_name = "{}-{}".format(cmd_args.cluster_name, node_name)
+
     command_line = "docker exec -it {} /bin/bash".format(node_name)
 
     process = subprocess.Popen(shlex.split(command_line))
     process.communicate()
 
+def run_node_exec(cmd_args):
+    """ runs the command on all nodes of the cluster (or those of --node-role), --jobs at the same time.
+
+    The output of each node is shown in the order of the node names, each line prefixed
+    by the node name, followed by the exit status and duration of the command on the node.
+    """
+    nodes = [node for node in list_cluster_nodes(cmd_args) \
+            if cmd_args.node_role == "all" or node[2] == cmd_args.node_role]
+    if len(nodes) == 0:
+        show_error("cluster {} has no {} nodes. is it running?".format(cmd_args.cluster_name, \
+                "" if cmd_args.node_role == "all" else cmd_args.node_role))
+
+    def run_one(node_name):
+        start_time = time.time()
+        process = subprocess.run(["docker", "exec", node_name, "sh", "-c", cmd_args.node_exec], \
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return process.returncode, process.stdout.decode("utf-8", "replace"), time.time() - start_time
+
+    exec_start = time.time()
+    exec_exit_code = 0
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, cmd_args.jobs)) as executor:
+        futures = [(node_name, executor.submit(run_one, node_name)) for _, node_name, _ in nodes]
+        for node_name, future in futures:
+            exit_code, output, duration = future.result()
+            for line in output.splitlines():
+                print("{}: {}".format(node_name, line))
+            print("### {} (exit status: {} time: {:.2f} seconds)".format(node_name, exit_code, duration), \
+                    flush=True)
+            if exit_code != 0:
+                failed += 1
+                if exec_exit_code == 0:
+                    exec_exit_code = exit_code
+
+    print("### {} nodes, {} failed, time: {:.2f} seconds".\
+            format(len(nodes), failed, time.time() - exec_start))
+    sys.exit(exec_exit_code)
+
+# --monitor reads the cgroup files of the node containers under this directory
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# the columns of the --monitor file, after time and node. cpu is in percent of one cpu, the
+# pressure columns are the percentage of the time that some task waited for the resource.
+MONITOR_COLUMNS = ["cpu", "memory_mb", "io_read_mbs", "io_write_mbs", \
+        "cpu_pressure", "memory_pressure", "io_pressure"]
+
+def parse_flat_keyed(text):
+    """ parses the 'key value' lines of a cgroup or proc file """
+    values = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            values[fields[0].rstrip(":")] = fields[1]
+    return values
+
+def parse_cgroup_cpu_stat(text):
+    return {"cpu": int(parse_flat_keyed(text)["usage_usec"])}
+
+def parse_cpuacct_usage(text):
+    # nanoseconds
+    return {"cpu": int(text) // 1000}
+
+def parse_memory_bytes(text):
+    return {"memory": int(text)}
+
+def parse_cgroup_io_stat(text):
+    # one line per device: 8:0 rbytes=1 wbytes=2 rios=3 ...
+    read_bytes = write_bytes = 0
+    for line in text.splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key == "rbytes":
+                read_bytes += int(value)
+            elif key == "wbytes":
+                write_bytes += int(value)
+    return {"io_read": read_bytes, "io_write": write_bytes}
+
+def parse_blkio_service_bytes(text):
+    # one line per device and operation: 8:0 Read 1234
+    read_bytes = write_bytes = 0
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == "Read":
+            read_bytes += int(fields[2])
+        elif len(fields) == 3 and fields[1] == "Write":
+            write_bytes += int(fields[2])
+    return {"io_read": read_bytes, "io_write": write_bytes}
+
+def pressure_parser(name):
+    """ returns the parser of a pressure file: the total microseconds that some task stalled """
+    def parse(text):
+        for line in text.splitlines():
+            if line.startswith("some "):
+                return {name: int(line.rpartition("total=")[2])}
+        return {}
+    return parse
+
+def parse_proc_stat(text):
+    # the busy time of all cpus, in clock ticks
+    fields = [int(field) for field in text.splitlines()[0].split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    return {"cpu": (sum(fields[:8]) - idle) * 1000000 // os.sysconf("SC_CLK_TCK")}
+
+def parse_proc_meminfo(text):
+    values = parse_flat_keyed(text)
+    return {"memory": (int(values["MemTotal"]) - int(values["MemAvailable"])) * 1024}
+
+class ResourceReader:
+    """ reads the counters of a node container (its cgroup) or of the host.
+
+    The files are opened once, a sample re-reads each of them with one pread call;
+    no process is started while sampling, that keeps the load of the monitor negligible.
+    """
+
+    def __init__(self, name, files):
+        self.name = name
+        self.fds = []
+        for file_name, parser in files:
+            try:
+                self.fds.append((os.open(file_name, os.O_RDONLY), parser))
+            except OSError:
+                pass
+
+    def read(self):
+        """ returns the counters: name -> value, raises OSError once the cgroup is gone """
+        values = {}
+        for fd, parser in self.fds:
+            values.update(parser(os.pread(fd, 65536, 0).decode("ascii", "replace")))
+        return values
+
+    def close(self):
+        for fd, _ in self.fds:
+            os.close(fd)
+        self.fds = []
+
+def container_cgroup_path(path, container_id):
+    """ the cgroup of the container: kind moves the init process of the node to a child cgroup """
+    parts = path.rstrip("/").split("/")
+    for index in range(len(parts), 0, -1):
+        if container_id[:12] in parts[index - 1]:
+            return "/".join(parts[:index])
+    return path
+
+def node_resource_files(pid, container_id):
+    """ returns the files of the cgroup of the node container: list of (file name, parser) """
+    with open("/proc/{}/cgroup".format(pid), "r") as cgroup_file:
+        lines = cgroup_file.read().splitlines()
+
+    if os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        path = [line.split(":", 2)[2] for line in lines if line.startswith("0::")][0]
+        cgroup_dir = os.path.join(CGROUP_ROOT, container_cgroup_path(path, container_id).lstrip("/"))
+        return [(os.path.join(cgroup_dir, file_name), parser) for file_name, parser in [
+            ("cpu.stat", parse_cgroup_cpu_stat),
+            ("memory.current", parse_memory_bytes),
+            ("io.stat", parse_cgroup_io_stat),
+            ("cpu.pressure", pressure_parser("cpu_pressure")),
+            ("memory.pressure", pressure_parser("memory_pressure")),
+            ("io.pressure", pressure_parser("io_pressure"))]]
+
+    # cgroup v1: the directory of each controller (it may be mounted with others, i.e. cpu,cpuacct)
+    controller_dirs = {}
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        path = container_cgroup_path(path, container_id).lstrip("/")
+        for controller in controllers.split(","):
+            for mount_dir in (controllers, controller):
+                cgroup_dir = os.path.join(CGROUP_ROOT, mount_dir, path)
+                if controller not in controller_dirs and os.path.isdir(cgroup_dir):
+                    controller_dirs[controller] = cgroup_dir
+    files = []
+    for controller, file_names, parser in [
+            ("cpuacct", ["cpuacct.usage"], parse_cpuacct_usage),
+            ("memory", ["memory.usage_in_bytes"], parse_memory_bytes),
+            ("blkio", ["blkio.throttle.io_service_bytes_recursive", "blkio.throttle.io_service_bytes"], \
+                    parse_blkio_service_bytes)]:
+        for file_name in file_names:
+            file_name = os.path.join(controller_dirs.get(controller, "/nonexistent"), file_name)
+            if os.path.exists(file_name):
+                files.append((file_name, parser))
+                break
+    return files
+
+def host_resource_files():
+    return [("/proc/stat", parse_proc_stat), ("/proc/meminfo", parse_proc_meminfo), \
+            ("/proc/pressure/cpu", pressure_parser("cpu_pressure")), \
+            ("/proc/pressure/memory", pressure_parser("memory_pressure")), \
+            ("/proc/pressure/io", pressure_parser("io_pressure"))]
+
+def node_resource_readers(cmd_args):
+    """ returns a ResourceReader for each node container of the cluster """
+    nodes = list_cluster_nodes(cmd_args)
+    if len(nodes) == 0:
+        show_error("cluster {} has no nodes. is it running?".format(cmd_args.cluster_name))
+
+    command_line = "docker inspect --format '{{{{.State.Pid}}}}' {}".\
+            format(" ".join(container_id for container_id, _, _ in nodes))
+    cmd_runner = RunCommand(command_line)
+    if cmd_runner.exit_code != 0:
+        show_error("Failed to inspect the nodes of cluster {}: {}".\
+                format(cmd_args.cluster_name, cmd_runner.make_error_message()))
+
+    readers = []
+    for (container_id, node_name, _), pid in zip(nodes, cmd_runner.output.split()):
+        try:
+            reader = ResourceReader(node_name, node_resource_files(pid, container_id))
+        except (OSError, IndexError) as err:
+            show_error("can't find the cgroup of node {} (pid {}): {}".format(node_name, pid, err))
+        if len(reader.fds) == 0:
+            show_error("can't read the cgroup files of node {} under {}; --monitor needs the docker \
+daemon on this host (not in a virtual machine)".format(node_name, CGROUP_ROOT))
+        readers.append(reader)
+    return readers
+
+def resource_rates(previous, current, seconds):
+    """ returns the values of a sample row (MONITOR_COLUMNS) from two readings of the counters """
+    def rate(key, scale):
+        if key not in current or key not in previous:
+            return None
+        return max(0, current[key] - previous[key]) / seconds / scale
+
+    return {
+        "cpu": rate("cpu", 10000),
+        "memory_mb": current["memory"] / (1024 * 1024) if "memory" in current else None,
+        "io_read_mbs": rate("io_read", 1024 * 1024),
+        "io_write_mbs": rate("io_write", 1024 * 1024),
+        "cpu_pressure": rate("cpu_pressure", 10000),
+        "memory_pressure": rate("memory_pressure", 10000),
+        "io_pressure": rate("io_pressure", 10000),
+    }
+
+def show_monitor_summary(cmd_args, rows, num_samples, seconds):
+    """ shows the average and peak usage of each node, the hottest (highest average cpu) first """
+    print("*** monitor: {} samples in {:.1f} seconds (host: {} cpus), written to {} ***".format(\
+            num_samples, seconds, os.cpu_count(), cmd_args.monitor))
+    print("{:<32} {:>8} {:>8} {:>9} {:>9} {:>9} {:>20}".format("node", "cpu% avg", "cpu% max", \
+            "mem MB", "read MB", "write MB", "stall% cpu/mem/io"))
+
+    def peak(name, column):
+        values = [row[column] for row in rows[name] if row[column] is not None]
+        return max(values) if len(values) != 0 else None
+
+    def average(name, column):
+        values = [row[column] for row in rows[name] if row[column] is not None]
+        return sum(values) / len(values) if len(values) != 0 else None
+
+    def total(name, column):
+        return sum(row[column] * row["seconds"] for row in rows[name] if row[column] is not None)
+
+    def text(value, precision=1):
+        return "-" if value is None else "{:.{}f}".format(value, precision)
+
+    nodes = sorted((name for name in rows if name != "host"), key=lambda name: -(average(name, "cpu") or 0))
+    for name in nodes + ["host"]:
+        if len(rows[name]) == 0:
+            continue
+        print("{:<32} {:>8} {:>8} {:>9} {:>9} {:>9} {:>20}".format(name, text(average(name, "cpu")), \
+                text(peak(name, "cpu")), text(peak(name, "memory_mb"), 0), \
+                text(total(name, "io_read_mbs")), text(total(name, "io_write_mbs")), \
+                "/".join(text(peak(name, column)) for column in \
+                ["cpu_pressure", "memory_pressure", "io_pressure"])))
+
+def run_monitor(cmd_args):
+    """ samples cpu, memory, io and pressure (psi) of the node containers and of the host.
+
+    The counters are read from the cgroup files of the node containers (and from /proc for
+    the host) every --monitor-interval seconds, until --monitor-duration seconds passed or
+    the process gets SIGINT/SIGTERM. Each sample adds a csv row per node to the --monitor file,
+    the rates are those of the interval. At exit the average and peak usage per node is shown.
+    """
+    if cmd_args.monitor_interval <= 0:
+        show_error("--monitor-interval must be more than 0 seconds")
+    readers = node_resource_readers(cmd_args)
+    readers.append(ResourceReader("host", host_resource_files()))
+
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_args: stop_event.set())
+
+    try:
+        output_file = open(cmd_args.monitor, "w")
+    except OSError as err:
+        show_error("can't write {} error: {}".format(cmd_args.monitor, err))
+
+    rows = {reader.name: [] for reader in readers}
+    previous = {reader.name: reader.read() for reader in readers}
+    start_time = previous_time = time.monotonic()
+    num_samples = 0
+    with output_file:
+        output_file.write(",".join(["time", "node"] + MONITOR_COLUMNS) + "\n")
+        next_time = start_time + cmd_args.monitor_interval
+        while len(readers) > 1:
+            if stop_event.wait(max(0, next_time - time.monotonic())):
+                break
+            now = time.monotonic()
+            wall_time = time.time()
+            lines = []
+            for reader in list(readers):
+                try:
+                    current = reader.read()
+                except OSError:
+                    # the node container was deleted
+                    print("node {} is gone".format(reader.name), file=sys.stderr)
+                    reader.close()
+                    readers.remove(reader)
+                    continue
+                row = resource_rates(previous[reader.name], current, now - previous_time)
+                previous[reader.name] = current
+                row["seconds"] = now - previous_time
+                rows[reader.name].append(row)
+                lines.append(",".join(["{:.2f}".format(wall_time), reader.name] + \
+                        ["" if row[column] is None else "{:.2f}".format(row[column]) \
+                        for column in MONITOR_COLUMNS]))
+            output_file.write("\n".join(lines) + "\n")
+            output_file.flush()
+            num_samples += 1
+            previous_time = now
+            next_time += cmd_args.monitor_interval
+            if cmd_args.monitor_duration != 0 and now - start_time >= cmd_args.monitor_duration:
+                break
+
+    for reader in readers:
+        reader.close()
+    show_monitor_summary(cmd_args, rows, num_samples, time.monotonic() - start_time)
+
+# the collections listed into the diagnostics archive, one request each
+DIAGNOSTICS_COLLECTIONS = {
+    "namespaces": "/api/v1/namespaces",
+    "nodes": "/api/v1/nodes",
+    "events": "/api/v1/events",
+    "pods": "/api/v1/pods",
+    "services": "/api/v1/services",
+    "endpoints": "/api/v1/endpoints",
+    "configmaps": "/api/v1/configmaps",
+    "deployments": "/apis/apps/v1/deployments",
+    "daemonsets": "/apis/apps/v1/daemonsets",
+    "statefulsets": "/apis/apps/v1/statefulsets",
+    "replicasets": "/apis/apps/v1/replicasets",
+    "jobs": "/apis/batch/v1/jobs",
+    "ingresses": "/apis/networking.k8s.io/v1/ingresses",
+}
+
+# the resources of kubectl describe, it runs once per namespace
+DIAGNOSTICS_DESCRIBE = "pods,deployments,daemonsets,statefulsets,services,ingresses,jobs"
+
+# the files of each node in the diagnostics archive: file name -> shell command run on the node
+DIAGNOSTICS_NODE_COMMANDS = {
+    "kubelet.log": "journalctl --no-pager -u kubelet",
+    "containerd.log": "journalctl --no-pager -u containerd",
+    "containers.txt": "crictl ps -a",
+    "images.txt": "crictl images",
+}
+
+# a part of the diagnostics archive is kept in memory up to this size, then in a temporary file
+DIAGNOSTICS_SPOOL_SIZE = 1024 * 1024
+
+def collect_diagnostics(cmd_args):
+    """ writes the state of the cluster into one compressed tar archive (--diagnostics).
+
+    The collections of the cluster are listed once, then the describe output of each namespace,
+    the logs of all containers (and of the previous instance of a restarted container) and the
+    logs of the nodes are fetched, --jobs of them at the same time. Each part is added to the
+    archive as soon as it is complete; until then it is held in a spooled temporary file,
+    so the memory use does not grow with the size of the logs.
+    """
+    start_time = time.time()
+    try:
+        client = KubeClient(kubeconfig_file(cmd_args), pool_size=max(1, cmd_args.jobs))
+    except (KubeApiError, OSError) as err:
+        show_error("Failed to collect diagnostics of cluster {}: {}".format(cmd_args.cluster_name, err))
+    kubectl = [find_kubectl(cmd_args), "--kubeconfig", kubeconfig_file(cmd_args)]
+    nodes = list_cluster_nodes(cmd_args)
+    prefix = "diagnostics-{}".format(cmd_args.cluster_name)
+    errors = []
+
+    def list_collection(path):
+        items = client.get(path).get("items", [])
+        part = tempfile.SpooledTemporaryFile(max_size=DIAGNOSTICS_SPOOL_SIZE)
+        part.write(json.dumps(items, indent=2).encode("utf-8"))
+        return part, items
+
+    def fetch_log(namespace, pod, container, previous):
+        part = tempfile.SpooledTemporaryFile(max_size=DIAGNOSTICS_SPOOL_SIZE)
+        params = {"container": container}
+        if previous:
+            params["previous"] = "true"
+        try:
+            client.get_to_file("/api/v1/namespaces/{}/pods/{}/log".format(namespace, pod), part, params)
+        except KubeApiError:
+            part.close()
+            raise
+        return part, None
+
+    def run_to_part(command_line):
+        part = tempfile.SpooledTemporaryFile(max_size=DIAGNOSTICS_SPOOL_SIZE)
+        process = subprocess.run(command_line, stdin=subprocess.DEVNULL, stdout=part, \
+                stderr=subprocess.STDOUT)
+        if process.returncode != 0:
+            part.write("\n(exit status {})\n".format(process.returncode).encode("utf-8"))
+        return part, None
+
+    with tarfile.open(cmd_args.diagnostics, "w:gz") as archive, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, cmd_args.jobs)) as executor:
+
+        def add_part(name, part):
+            info = tarfile.TarInfo("{}/{}".format(prefix, name))
+            info.size = part.seek(0, os.SEEK_END)
+            info.mtime = time.time()
+            part.seek(0)
+            archive.addfile(info, part)
+            part.close()
+
+        def add_completed(futures):
+            """ adds the parts to the archive in the order they complete; returns their results """
+            results = {}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    part, results[name] = future.result()
+                except (KubeApiError, OSError) as err:
+                    errors.append("{}: {}".format(name, err))
+                    continue
+                add_part(name, part)
+            return results
+
+        futures = {executor.submit(list_collection, path): "cluster/{}.json".format(name) \
+                for name, path in DIAGNOSTICS_COLLECTIONS.items()}
+        futures[executor.submit(run_to_part, kubectl + ["describe", "nodes"])] = "describe/nodes.txt"
+        for _, node_name, _ in nodes:
+            for file_name, command in DIAGNOSTICS_NODE_COMMANDS.items():
+                futures[executor.submit(run_to_part, ["docker", "exec", node_name, "sh", "-c", command])] = \
+                        "nodes/{}/{}".format(node_name, file_name)
+        listed = add_completed(futures)
+
+        futures = {}
+        for namespace in listed.get("cluster/namespaces.json") or []:
+            name = namespace["metadata"]["name"]
+            futures[executor.submit(run_to_part, kubectl + ["describe", DIAGNOSTICS_DESCRIBE, \
+                    "-n", name])] = "describe/{}.txt".format(name)
+
+        for pod in listed.get("cluster/pods.json") or []:
+            namespace, pod_name = pod["metadata"]["namespace"], pod["metadata"]["name"]
+            status = pod.get("status", {})
+            restarts = {container["name"]: container.get("restartCount", 0) for container in \
+                    (status.get("initContainerStatuses") or []) + (status.get("containerStatuses") or [])}
+            for container in (pod["spec"].get("initContainers") or []) + pod["spec"].get("containers", []):
+                container_name = container["name"]
+                log_name = "logs/{}/{}/{}".format(namespace, pod_name, container_name)
+                futures[executor.submit(fetch_log, namespace, pod_name, container_name, False)] = \
+                        log_name + ".log"
+                if restarts.get(container_name, 0) != 0:
+                    futures[executor.submit(fetch_log, namespace, pod_name, container_name, True)] = \
+                            log_name + ".previous.log"
+        add_completed(futures)
+
+        part = tempfile.SpooledTemporaryFile(max_size=DIAGNOSTICS_SPOOL_SIZE)
+        part.write("".join(error + "\n" for error in errors).encode("utf-8"))
+        add_part("errors.txt", part)
+
+    for error in errors:
+        print("Error: {}".format(error), file=sys.stderr)
+    print("*** diagnostics of cluster {} written to {} ({} errors, time: {:.2f} seconds) ***".\
+            format(cmd_args.cluster_name, cmd_args.diagnostics, len(errors), time.time() - start_time))
+
+# the order of --apply: each group is applied at the same time, after the groups before it.
+# Kinds that are not listed (i.e. custom resources) are applied with the workloads.
+APPLY_GROUPS = [
+    ["Namespace", "CustomResourceDefinition", "PriorityClass", "StorageClass"],
+    ["ServiceAccount", "ClusterRole", "ClusterRoleBinding", "Role", "RoleBinding", \
+            "ResourceQuota", "LimitRange", "NetworkPolicy"],
+    ["ConfigMap", "Secret", "PersistentVolume", "PersistentVolumeClaim", "Service", "IngressClass"],
+    ["Deployment", "DaemonSet", "StatefulSet", "ReplicaSet", "Job", "CronJob", "Pod", \
+            "HorizontalPodAutoscaler", "PodDisruptionBudget", "Ingress"],
+    ["ValidatingWebhookConfiguration", "MutatingWebhookConfiguration", "APIService"],
+]
+APPLY_DEFAULT_GROUP = 3
+
+# --apply waits until the objects of these kinds are rolled out
+ROLLOUT_KINDS = ["Deployment", "DaemonSet", "StatefulSet", "Ingress"]
+
+CRD_COLLECTION_PATH = "/apis/apiextensions.k8s.io/v1/customresourcedefinitions"
+
+def manifest_header(text):
+    """ returns apiVersion, kind, name and namespace of a yaml document, without parsing the rest """
+    header = {}
+    in_metadata = False
+    metadata_indent = None
+    for line in text.splitlines():
+        if line.strip() == "" or line.lstrip().startswith("#"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        key, _, value = line.strip().partition(":")
+        value = re.sub(r'\s+#.*$', '', value)
+        if indent == 0:
+            in_metadata = key == "metadata"
+            metadata_indent = None
+            if key in ("apiVersion", "kind"):
+                header[key] = parse_yaml_scalar(value)
+        elif in_metadata:
+            if metadata_indent is None:
+                metadata_indent = indent
+            if indent == metadata_indent and key in ("name", "namespace"):
+                header[key] = parse_yaml_scalar(value)
+    return header
+
+def read_manifests(paths):
+    """ returns the objects of the manifest files (of a directory: its .yaml, .yml and .json files).
+
+    Each object is a dict with file, text (the document, that's what is applied), apiVersion,
+    kind, name and namespace.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(file_name for file_name in glob.glob(os.path.join(path, "*")) \
+                    if os.path.splitext(file_name)[1] in (".yaml", ".yml", ".json"))
+        else:
+            files.append(path)
+
+    objects = []
+    for file_name in files:
+        try:
+            with open(file_name, "r") as input_file:
+                text = input_file.read()
+        except OSError as err:
+            show_error("can't read manifest {} error: {}".format(file_name, err))
+
+        if text.lstrip().startswith("{"):
+            try:
+                obj = json.loads(text)
+            except ValueError as err:
+                show_error("can't parse manifest {} error: {}".format(file_name, err))
+            items = obj.get("items", []) if obj.get("kind", "").endswith("List") else [obj]
+            documents = [(json.dumps(item), item) for item in items]
+        else:
+            documents = []
+            for document in re.split(r'^(?:---|\.\.\.)(?:[ \t].*)?$', text, flags=re.MULTILINE):
+                documents.append((document, manifest_header(document)))
+
+        for document, header in documents:
+            metadata = header.get("metadata", header)
+            if header.get("kind") is None:
+                continue
+            if header.get("apiVersion") is None or metadata.get("name") is None:
+                show_error("manifest {}: {} without apiVersion or metadata.name".\
+                        format(file_name, header["kind"]))
+            objects.append({"file": file_name, "text": document, "apiVersion": header["apiVersion"], \
+                    "kind": header["kind"], "name": metadata["name"].strip(), \
+                    "namespace": (metadata.get("namespace") or "").strip()})
+    return objects
+
+def apply_group_index(kind):
+    for index, kinds in enumerate(APPLY_GROUPS):
+        if kind in kinds:
+            return index
+    return APPLY_DEFAULT_GROUP
+
+def discover_resources(client, api_version):
+    """ returns the resources of an api version: kind -> (plural name, is namespaced) """
+    path = "/api/v1" if api_version == "v1" else "/apis/{}".format(api_version)
+    try:
+        resource_list = client.get(path)
+    except KubeApiError as err:
+        show_error("api version {} is not served by the cluster: {}".format(api_version, err))
+    return {resource["kind"]: (resource["name"], resource.get("namespaced", False)) \
+            for resource in resource_list.get("resources", []) if "/" not in resource["name"]}
+
+def object_path(obj, resources):
+    """ returns the api path of the object """
+    if obj["kind"] not in resources.get(obj["apiVersion"], {}):
+        show_error("manifest {}: kind {} is not served by api version {}".\
+                format(obj["file"], obj["kind"], obj["apiVersion"]))
+    plural, namespaced = resources[obj["apiVersion"]][obj["kind"]]
+    prefix = "/api/v1" if obj["apiVersion"] == "v1" else "/apis/{}".format(obj["apiVersion"])
+    if namespaced:
+        return "{}/namespaces/{}/{}/{}".format(prefix, obj["namespace"], plural, obj["name"])
+    return "{}/{}/{}".format(prefix, plural, obj["name"])
+
+def object_display_name(obj):
+    if obj["namespace"] != "":
+        return "{} {}/{}".format(obj["kind"], obj["namespace"], obj["name"])
+    return "{} {}".format(obj["kind"], obj["name"])
+
+def is_rolled_out(kind, obj):
+    """ true if the (watched) object is rolled out, like kubectl rollout status """
+    status = obj.get("status") or {}
+    spec = obj.get("spec") or {}
+    if kind == "Ingress":
+        return len((status.get("loadBalancer") or {}).get("ingress") or []) != 0
+    if status.get("observedGeneration", 0) < obj.get("metadata", {}).get("generation", 0):
+        return False
+    if kind == "DaemonSet":
+        desired = status.get("desiredNumberScheduled", 0)
+        return status.get("updatedNumberScheduled", 0) >= desired and \
+                status.get("numberAvailable", 0) >= desired
+    replicas = spec.get("replicas", 1)
+    if kind == "StatefulSet":
+        return status.get("updatedReplicas", 0) >= replicas and status.get("readyReplicas", 0) >= replicas
+    # Deployment: the old replicas must be gone too.
+    return status.get("updatedReplicas", 0) >= replicas and status.get("replicas", 0) <= replicas and \
+            status.get("availableReplicas", 0) >= replicas
+
+def wait_for_object(client, path, deadline, is_done):
+    """ waits until is_done returns true for the watched object of path, returns the time it took """
+    start_time = time.time()
+    collection, _, name = path.rpartition("/")
+    if not wait_for_watch(client, collection, deadline - start_time, \
+            lambda event: event.get("type") != "DELETED" and is_done(event.get("object", {})), \
+            {"fieldSelector": "metadata.name={}".format(name)}):
+        return None
+    return time.time() - start_time
+
+def apply_manifests(cmd_args):
+    """ applies the manifests of --apply in one pass, then waits for their rollout.
+
+    The objects are sorted into the groups of APPLY_GROUPS (namespaces and CRDs first, then
+    RBAC, config and services, then the workloads); the objects of a group are applied by
+    server side apply at the same time (--jobs requests), the next group starts once the
+    group is applied (and its CRDs are established). Then it waits for all Deployments,
+    DaemonSets, StatefulSets and Ingresses at the same time, all within --timeout seconds.
+    """
+    start_time = time.time()
+    deadline = start_time + cmd_args.timeout
+    objects = read_manifests(cmd_args.apply)
+    if len(objects) == 0:
+        show_error("no objects in the manifests {}".format(" ".join(cmd_args.apply)))
+    try:
+        client = KubeClient(kubeconfig_file(cmd_args), pool_size=max(1, cmd_args.jobs))
+    except (KubeApiError, OSError) as err:
+        show_error("Failed to connect to cluster {}: {}".format(cmd_args.cluster_name, err))
+
+    groups = {}
+    for obj in objects:
+        groups.setdefault(apply_group_index(obj["kind"]), []).append(obj)
+
+    resources = {}
+    paths = {}
+
+    def apply_one(obj):
+        client.apply(paths[id(obj)], obj["text"])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, cmd_args.jobs)) as executor:
+        for index in sorted(groups):
+            group = groups[index]
+            # the api versions of custom resources are served once their CRDs are established.
+            versions = sorted({obj["apiVersion"] for obj in group if obj["apiVersion"] not in resources})
+            for version, found in zip(versions, executor.map(\
+                    lambda version: discover_resources(client, version), versions)):
+                resources[version] = found
+            for obj in group:
+                if resources.get(obj["apiVersion"], {}).get(obj["kind"], ("", False))[1] and \
+                        obj["namespace"] == "":
+                    obj["namespace"] = "default"
+                paths[id(obj)] = object_path(obj, resources)
+
+            group_start = time.time()
+            futures = [(obj, executor.submit(apply_one, obj)) for obj in group]
+            errors = []
+            for obj, future in futures:
+                try:
+                    future.result()
+                    print("applied {}".format(object_display_name(obj)))
+                except KubeApiError as err:
+                    errors.append("{} ({}): {}".format(object_display_name(obj), obj["file"], err))
+            if len(errors) != 0:
+                show_error("Failed to apply:\n{}".format("\n".join(errors)))
+            print("*** applied {} objects ({}) in {:.2f} seconds ***".format(len(group), \
+                    ", ".join(sorted({obj["kind"] for obj in group})), time.time() - group_start))
+
+            crds = [obj for obj in group if obj["kind"] == "CustomResourceDefinition"]
+            for obj, seconds in zip(crds, executor.map(lambda obj: wait_for_object(client, paths[id(obj)], \
+                    deadline, lambda crd: has_condition(crd, "Established")), crds)):
+                if seconds is None:
+                    show_error("timed out waiting for {} to be established".format(object_display_name(obj)))
+
+    rollouts = [obj for obj in objects if obj["kind"] in ROLLOUT_KINDS]
+    if cmd_args.apply_no_wait or len(rollouts) == 0:
+        print("*** {} objects applied in {:.2f} seconds ***".format(len(objects), time.time() - start_time))
+        return
+
+    # one thread per object, each watches its object; they share the deadline.
+    not_ready = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(rollouts)) as executor:
+        futures = [(obj, executor.submit(wait_for_object, client, paths[id(obj)], deadline, \
+                lambda watched, kind=obj["kind"]: is_rolled_out(kind, watched))) for obj in rollouts]
+        for obj, future in futures:
+            seconds = future.result()
+            if seconds is None:
+                not_ready.append(object_display_name(obj))
+            else:
+                print("{} rolled out after {:.1f} seconds".format(object_display_name(obj), seconds))
+
+    if len(not_ready) != 0:
+        show_error("timed out after {} seconds waiting for the rollout of: {}".\
+                format(cmd_args.timeout, ", ".join(not_ready)))
+    print("*** {} objects applied and rolled out in {:.2f} seconds ***".\
+            format(len(objects), time.time() - start_time))
+
+def find_kubectl(cmd_args):
+    """ returns the kubectl binary, as remembered in the tools manifest (if it is up to date) """
+    cmd_args.temp_dir = os.path.expandvars(cmd_args.temp_dir)
+
+    tools = load_tools_manifest(cmd_args, path_fingerprint())
+    if tools is not None:
+        return tools["kubectl"]["path"]
+
+    kubectl = shutil.which("kubectl")
+    if kubectl is not None:
+        return kubectl
+    return "{}/kubectl".format(cmd_args.temp_dir)
+
 def run_kubectl(cmd_args):
-    has_kubectl = has_kubectl_check()
-    if not has_kubectl:
-        kubectl = "{}/kubectl".format(cmd_args.temp_dir)
+    """ replaces this process by kubectl; signals, the terminal and the exit status are those of kubectl """
+    kubectl = find_kubectl(cmd_args)
+
+    try:
+        command = shlex.split(cmd_args.kubectl)
+    except ValueError as err:
+        show_error("can't parse kubectl command line: {}".format(err))
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        os.execv(kubectl, [kubectl, "--kubeconfig", kubeconfig_file(cmd_args)] + command)
+    except OSError as err:
+        show_error("can't run {} error: {}".format(kubectl, err))
+
+def read_batch_commands(batch_file):
+    if batch_file == "-":
+        lines = sys.stdin.read().splitlines()
     else:
-        kubectl = "kubectl"
+        try:
+            with open(batch_file, "r") as input_file:
+                lines = input_file.read().splitlines()
+        except OSError as err:
+            show_error("can't read kubectl batch file {} error: {}".format(batch_file, err))
 
-    command_line = "{} --kubeconfig {}/kubeconfig {}". \
-            format(os.path.expandvars(kubectl), os.path.expandvars(cmd_args.temp_dir), cmd_args.kubectl)
-    process = subprocess.Popen(shlex.split(command_line))
-    process.communicate()
-    exit_code = process.wait()
-    sys.exit(exit_code)
+    return [line.strip() for line in lines if line.strip() != "" and not line.strip().startswith("#")]
 
+def run_kubectl_batch(cmd_args):
+    """ runs each line of the batch file as kubectl command line, --jobs of them at the same time.
+
+    The output of each command is shown in the order of the input, followed by its
+    exit status and duration.
+    """
+    commands = read_batch_commands(cmd_args.kubectl_batch)
+    kubectl = [find_kubectl(cmd_args), "--kubeconfig", kubeconfig_file(cmd_args)]
+
+    def run_one(command):
+        start_time = time.time()
+        try:
+            process = subprocess.run(kubectl + shlex.split(command), stdin=subprocess.DEVNULL, \
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            exit_code, output, error_out = process.returncode, process.stdout, process.stderr
+        except (OSError, ValueError) as err:
+            exit_code, output, error_out = 1, b"", str(err).encode("utf-8")
+        return exit_code, output, error_out, time.time() - start_time
+
+    batch_start = time.time()
+    batch_exit_code = 0
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, cmd_args.jobs)) as executor:
+        futures = [executor.submit(run_one, command) for command in commands]
+        for index, (command, future) in enumerate(zip(commands, futures)):
+            exit_code, output, error_out, duration = future.result()
+            print("### [{}] kubectl {} (exit status: {} time: {:.2f} seconds)".\
+                    format(index + 1, command, exit_code, duration), flush=True)
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            sys.stderr.buffer.write(error_out)
+            sys.stderr.flush()
+            if exit_code != 0:
+                failed += 1
+                if batch_exit_code == 0:
+                    batch_exit_code = exit_code
+
+    print("### {} commands, {} failed, time: {:.2f} seconds".\
+            format(len(commands), failed, time.time() - batch_start))
+    sys.exit(batch_exit_code)
+
+
+
+class ClusterConfig:
+    """ options of a cluster for the python api, by keyword; the defaults are those of the
+    command line. i.e. ClusterConfig(name="test", workers=3, ingress=["8080:80"])
+    """
+
+    # keyword -> dest of the command line option
+    OPTIONS = {
+        "name": "cluster_name",
+        "masters": "num_masters",
+        "workers": "num_workers",
+        "timeout": "timeout",
+        "node_image": "node_image",
+        "reuse": "reuse",
+        "wait_system_pods": "wait_system_pods",
+        "ingress": "ingress",
+        "ingress_version": "ingress_version",
+        "registry_port": "reg_docker_port",
+        "registry_name": "reg_docker_name",
+        "registry_storage": "reg_storage",
+        "keep_registry": "keep_registry",
+        "mirror": "mirror",
+        "mirror_upstream": "mirror_upstream",
+        "dir": "temp_dir",
+        "platform": "platform",
+        "kind_version": "kind_version",
+        "kubectl_version": "kubectl_version",
+        "cache_size": "cache_size",
+        "image_cache": "image_cache",
+        "image_cache_size": "image_cache_size",
+        "jobs": "jobs",
+        "verbose": "verbose",
+    }
+
+    def __init__(self, **options):
+        unknown = [key for key in options if key not in ClusterConfig.OPTIONS]
+        if len(unknown) != 0:
+            raise TypeError("unknown cluster options: {}".format(", ".join(unknown)))
+
+        defaults = make_parser().parse_args([])
+        defaults.cluster_name = defaults.cluster_names[0]
+        for key, dest in ClusterConfig.OPTIONS.items():
+            setattr(self, key, options.get(key, getattr(defaults, dest)))
+        self.dir = os.path.expandvars(self.dir)
+
+    def to_args(self):
+        """ returns the options as parsed command line (that's what the functions of the script take) """
+        cmd_args = make_parser().parse_args([])
+        for key, dest in ClusterConfig.OPTIONS.items():
+            setattr(cmd_args, dest, getattr(self, key))
+        cmd_args.cluster_names = [self.name]
+        return cmd_args
+
+class KindCluster:
+    """ python api: a cluster of this script, for test code that drives it from python.
+
+    start() and stop() do the same as --start and --stop, kubectl() runs kubectl against the
+    cluster and returns its completed process, client() returns the kubernetes api client.
+    A failure raises KindHelperError. As context manager the cluster is started and stopped.
+    """
+
+    def __init__(self, config=None, **options):
+        if config is None:
+            config = ClusterConfig(**options)
+        elif len(options) != 0:
+            raise TypeError("pass either a ClusterConfig or options")
+        self.config = config
+        self.cmd_args = config.to_args()
+        self._client = None
+        self._kubectl = None
+        OUTPUT_LOG.set_file(os.path.join(config.dir, OUTPUT_LOG_FILE))
+
+    @property
+    def name(self):
+        return self.config.name
+
+    @property
+    def kubeconfig(self):
+        return kubeconfig_file(self.cmd_args)
+
+    def start(self):
+        start_cluster(self.cmd_args)
+        self._client = None
+        return self
+
+    def stop(self, detach=False):
+        cmd_args = copy.copy(self.cmd_args)
+        cmd_args.detach = detach
+        stop_cluster(cmd_args)
+        self._client = None
+
+    def is_running(self):
+        check_prerequisites(self.cmd_args)
+        cmd_runner = RunCommand("{} get clusters".format(shlex.quote(os.environ["KIND"])))
+        return self.name in cmd_runner.output.split()
+
+    def client(self):
+        """ kubernetes api client of the cluster (over keep-alive connections) """
+        if self._client is None:
+            try:
+                self._client = KubeClient(self.kubeconfig)
+            except (KubeApiError, OSError) as err:
+                show_error("Failed to connect to cluster {}: {}".format(self.name, err))
+        return self._client
+
+    def kubectl(self, *args, check=True, stdin_data=None, timeout=None):
+        """ runs kubectl with the arguments, returns the completed process (output as text).
+        check: raise KindHelperError if the exit status is not 0.
+        stdin_data: text passed to the standard input of kubectl (i.e. for apply -f -).
+        """
+        if self._kubectl is None:
+            self._kubectl = find_kubectl(self.cmd_args)
+        process = subprocess.run([self._kubectl, "--kubeconfig", self.kubeconfig] + list(args), \
+                input=stdin_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, \
+                universal_newlines=True, stdin=None if stdin_data is not None else subprocess.DEVNULL)
+        if check and process.returncode != 0:
+            show_error("kubectl {} failed. exit status {} {}".format(" ".join(args), \
+                    process.returncode, process.stderr))
+        return process
+
+    def load_images(self, *images, force=False):
+        """ loads the docker images into all nodes of the cluster (like --image) """
+        cmd_args = copy.copy(self.cmd_args)
+        cmd_args.images = list(images)
+        cmd_args.image_force = force
+        load_images(cmd_args)
+
+    def diagnostics(self, archive):
+        """ writes the diagnostics archive of the cluster (like --diagnostics) """
+        cmd_args = copy.copy(self.cmd_args)
+        cmd_args.diagnostics = archive
+        collect_diagnostics(cmd_args)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_exc_info):
+        self.stop()
 
 
 def main():
-    cmd_args, cmd_parser = parse_cmd_line()
+    try:
+        cmd_args, cmd_parser = parse_cmd_line()
+        cmd_args.temp_dir = os.path.expandvars(cmd_args.temp_dir)
+        cmd_args.cluster_name = cmd_args.cluster_names[0]
+        if len(cmd_args.cluster_names) > 1 and not (cmd_args.isstart or cmd_args.isstop):
+            show_error("only --start and --stop accept more than one cluster name")
+        OUTPUT_LOG.set_file(os.path.join(cmd_args.temp_dir, OUTPUT_LOG_FILE))
 
+        try:
+            run_command(cmd_args, cmd_parser)
+        finally:
+            if cmd_args.timings_json != "":
+                TIMINGS.write_json(cmd_args.timings_json)
+            if cmd_args.verbose and (cmd_args.isstart or cmd_args.isstop):
+                TIMINGS.show()
+    except KindHelperError:
+        # show_error has shown the message
+        sys.exit(1)
+
+def run_command(cmd_args, cmd_parser):
     if cmd_args.isstart:
         start_cluster(cmd_args)
     elif cmd_args.isstop:
         stop_cluster(cmd_args)
+    elif cmd_args.pool_fill:
+        pool_fill(cmd_args)
+    elif cmd_args.pool_claim:
+        pool_claim(cmd_args)
+    elif cmd_args.pool_release != "":
+        pool_release(cmd_args)
+    elif cmd_args.pool_drain:
+        pool_drain(cmd_args)
     elif cmd_args.node != "":
-        run_shell(cmd_args.node)
+        run_shell(cmd_args)
+    elif cmd_args.node_exec != "":
+        run_node_exec(cmd_args)
+    elif cmd_args.monitor != "":
+        run_monitor(cmd_args)
     elif cmd_args.kubectl != "":
         run_kubectl(cmd_args);
-#    elif cmd_args.image != "":
-#        use_image(cmd_args)
+    elif cmd_args.kubectl_batch != "":
+        run_kubectl_batch(cmd_args)
+    elif len(cmd_args.apply) != 0:
+        apply_manifests(cmd_args)
+    elif cmd_args.diagnostics != "":
+        collect_diagnostics(cmd_args)
+    elif cmd_args.reg_gc:
+        registry_gc(cmd_args)
+    elif len(cmd_args.images) != 0:
+        load_images(cmd_args)
     else:
         cmd_parser.print_help()
 
@@ -0,0 +1,70 @@
+""" pytest plugin: a kind cluster that serves the whole test session.
+
+Enable it with `-p pytest_kind_helper` (kind_helper.py and this file must be importable,
+i.e. in the rootdir of the tests or on PYTHONPATH), or with
+`pytest_plugins = ["pytest_kind_helper"]` in conftest.py.
+
+The fixture kind_cluster is the KindCluster of the session. It is started with --reuse,
+so a cluster of the same spec that is still running (i.e. kept by --kind-keep in an earlier
+session) is used right away. With pytest-xdist, the session fixtures exist once per worker:
+each worker gets a cluster of its own, named <name>-<worker id>; they share the local registry
+(its start and its removal with the last cluster are serialized by a lock file in the --dir directory).
+
+Override the fixture kind_cluster_config to change the options of the cluster, i.e.
+
+    @pytest.fixture(scope="session")
+    def kind_cluster_config(kind_cluster_config):
+        kind_cluster_config.ingress = ["8080:80"]
+        return kind_cluster_config
+"""
+
+import os
+
+import pytest
+
+import kind_helper
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("kind_helper", "kind cluster of the test session")
+    group.addoption("--kind-name", default=kind_helper.DEFAULT_CLUSTER_NAME, dest="kind_name", \
+            help="name of the cluster (with pytest-xdist the worker id is appended)")
+    group.addoption("--kind-workers", type=int, default=1, dest="kind_workers", \
+            help="number of worker nodes of the cluster")
+    group.addoption("--kind-masters", type=int, default=1, dest="kind_masters", \
+            help="number of master nodes of the cluster")
+    group.addoption("--kind-dir", default=None, dest="kind_dir", \
+            help="--dir directory of kind_helper.py")
+    group.addoption("--kind-keep", action="store_true", default=False, dest="kind_keep", \
+            help="do not delete the cluster at the end of the session, the next session reuses it")
+
+def cluster_name(config):
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "")
+    name = config.getoption("kind_name")
+    return "{}-{}".format(name, worker) if worker != "" else name
+
+@pytest.fixture(scope="session")
+def kind_cluster_config(request):
+    """ the ClusterConfig of the session cluster, from the --kind-* options of pytest """
+    options = {
+        "name": cluster_name(request.config),
+        "workers": request.config.getoption("kind_workers"),
+        "masters": request.config.getoption("kind_masters"),
+        "reuse": True,
+    }
+    if request.config.getoption("kind_dir") is not None:
+        options["dir"] = request.config.getoption("kind_dir")
+    return kind_helper.ClusterConfig(**options)
+
+@pytest.fixture(scope="session")
+def kind_cluster(request, kind_cluster_config):
+    """ the running KindCluster of the session (one per xdist worker) """
+    cluster = kind_helper.KindCluster(kind_cluster_config)
+    try:
+        cluster.start()
+    except kind_helper.KindHelperError as err:
+        pytest.fail("can't start kind cluster {}: {}".format(cluster.name, err), pytrace=False)
+    yield cluster
+    if not request.config.getoption("kind_keep"):
+        # the deletion runs in the background, a following session waits for it.
+        cluster.stop(detach=True)
@@ -1,17 +1,26 @@
-import socket
+import socketserver
 
 HOST = ''                 # Symbolic name meaning all available interfaces
 PORT = 50007              # Arbitrary non-privileged port
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.bind((HOST, PORT))
-s.listen(1)
 
+class EchoHandler(socketserver.BaseRequestHandler):
+    # sends back everything it receives, until the client closes the connection
 
-while True:
-    conn, addr = s.accept()
-    print('Connected by', addr)
-    data = conn.recv(1024)
-    if not data:
-        break
-    conn.sendall(data)
-    conn.close()
+    def handle(self):
+        print('Connected by', self.client_address)
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+class EchoServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # one thread per connection
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+server = EchoServer((HOST, PORT), EchoHandler)
+server.serve_forever()
@@ -4,41 +4,70 @@ import socketserver
 import urllib.parse
 import datetime
 import logging
+import os
 
 HTTP_LISTEN_PORT=8001
 
-class Handler(http.server.SimpleHTTPRequestHandler):
+# set ECHO_LOG_REQUESTS=1 to log every request (to gh.log and the console);
+# under load the logging would be the bottleneck of the server.
+LOG_REQUESTS = os.environ.get("ECHO_LOG_REQUESTS", "") != ""
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive connections: the response has a Content-Length, the connection stays open.
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately, nagle would delay the body.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *_args):
+        pass
 
     def do_GET(self):
 
         #print("get path {}".format(self.path))
 
+        url_parsed = urllib.parse.urlparse(self.path)
+        now = datetime.datetime.now()
+        msg = "<h2>echo response</h2>"\
+                "<br>Time: {}<br>Path: {}<br>Query: {}".\
+                format(now.strftime("%Y-%m-%d %H:%M:%S"),\
+                url_parsed.path,\
+                url_parsed.query).encode('utf-8')
+
         # Construct a server response.
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(msg)))
         self.send_header("Cache-Control", "no-cache, no-store, must-revalidate")
         self.send_header("Pragma", "no-cache")
         self.send_header("Expires", "0")
         self.end_headers()
 
-        url_parsed = urllib.parse.urlparse(self.path)
-        query = url_parsed.query
-        now = datetime.datetime.now()
-        msg = "<h2>echo response</h2>"\
-                "<br>Time: {}<br>Path: {}<br>Query: {}".\
-                format(now.strftime("%Y-%m-%d %H:%M:%S"),\
-                url_parsed.path,\
-                url_parsed.query)
+        self.wfile.write(msg)
+        if LOG_REQUESTS:
+            logging.info("request: path {} params {}".format(url_parsed.path, url_parsed.query))
+
+    def do_POST(self):
+        # echoes the request body
+        length = int(self.headers.get('Content-Length', '0'))
+        data = self.rfile.read(length)
+
+        self.send_response(200)
+        self.send_header('Content-type', self.headers.get('Content-Type', 'application/octet-stream'))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if LOG_REQUESTS:
+            logging.info("request: POST path {} length {}".format(self.path, length))
 
-        self.wfile.write(msg.encode('utf-8'))
-        logging.info("request: path {} params {}".format(url_parsed.path, url_parsed.query))
- 
 
-class TCPServer(socketserver.TCPServer):
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     # Allow to restart the mock server without needing to wait for the socket
     # to end TIME_WAIT: we only listen locally, and we may restart often in
     # some workflows
     allow_reuse_address = True
+    # one thread per connection; they don't keep the server from exiting.
+    daemon_threads = True
+    request_queue_size = 128
 
 def set_info_logger():
     root = logging.getLogger()
@@ -50,7 +79,8 @@ def set_info_logger():
     root.addHandler(console_handler)
 
 
-set_info_logger()
-print('Server listening on port 8000 {}'.format(HTTP_LISTEN_PORT))
+if LOG_REQUESTS:
+    set_info_logger()
+print('Server listening on port {}'.format(HTTP_LISTEN_PORT))
 httpd = TCPServer(('', HTTP_LISTEN_PORT), Handler)
 httpd.serve_forever()
@@ -78,11 +78,8 @@ docker_tag aaa/mm/kind-test-pod localhost:${REGISTRY_PORT}/kind-test-pod
 sed -e s/PORTNUM/${REGISTRY_PORT}/ test/deployment.yaml >test/deployment-port.yaml
 
 # create pod in registry that refers to ./kind_helper.py kind registry
-./kind_helper.py -c 'create -f test/service_account.yaml'
-./kind_helper.py -c 'create -f test/role.yaml'
-./kind_helper.py -c 'create -f test/role_binding.yaml'  
-./kind_helper.py -c 'create -f test/deployment-port.yaml'
-./kind_helper.py -c 'wait -f test/deployment.yaml --for condition=available'
+./kind_helper.py --apply test/service_account.yaml test/role.yaml test/role_binding.yaml \
+    test/deployment-port.yaml
 
 echo "*** deployment available ***"
 
@@ -41,16 +41,8 @@ cleanup() {
     ./kind_helper.py -c 'get pods -l test-echo-server'
     ./kind_helper.py -c 'get logs -l test-echo-server'
 
-    for n in $(./kind_helper.py -c 'get ns' | grep Active |  awk '{print $1;}'); do
-        echo "namespace $n"
-        ./kind_helper.py -c 'get pods -n '$n
-        if [[ $n == "default" ]] || [[ $n == "ingress-nginx" ]]; then
-
-            for p in $(./kind_helper.py -c "get pods -n $n -o jsonpath=\"{range .items[*]}{' '}{.metadata.name}{end}\""); do
-                ./kind_helper.py -c "describe pod -n $n $p"
-            done
-        fi
-     done
+    # objects, describe output, container and node logs of the cluster, in one archive
+    ./kind_helper.py --diagnostics ./test-with-ingress-tls-diagnostics.tar.gz
 
 
     # kill the cluster on exit
@@ -112,41 +104,15 @@ docker_tag aaa/mm/kind-test-pod localhost:${REGISTRY_PORT}/kind-test-pod
 sed -e s/PORTNUM/${REGISTRY_PORT}/ test/deployment.yaml >test/deployment-port.yaml
 
 # create pod in registry that refers to kind registry
-./kind_helper.py -c 'create -f test/service_account.yaml'
-./kind_helper.py -c 'create -f test/role.yaml'
-./kind_helper.py -c 'create -f test/role_binding.yaml'
-./kind_helper.py -c 'create -f test/deployment-port.yaml'
-./kind_helper.py -c 'create -f test/service.yaml'
-./kind_helper.py -c 'create -f test/ingress-tls.yaml'
-
-./kind_helper.py -c 'wait -f test/deployment.yaml --for condition=available'
+# applies the objects in dependency order, waits for the deployment to be available
+# and for the ingress to be attached to the load balancer
+./kind_helper.py --apply test/service_account.yaml test/role.yaml test/role_binding.yaml \
+    test/deployment-port.yaml test/service.yaml test/ingress-tls.yaml --timeout 600
 
-echo "*** deployment available ***"
+echo "*** deployment available, ingress attached to the load balancer ***"
 
 ./kind_helper.py -c 'get pods -o wide'
 
-
-echo "*** wait for ingress object to be active (be attached to load balancer) ***"
-
-COUNT=0
-while [[ true ]]; do 
-
-    HAS_LB=$(./kind_helper.py -c 'get ingresses test-echo-server -n default -o json' | jq .status.loadBalancer.ingress)
-    echo "${HAS_LB}"
-    if [[ $HAS_LB != "null" ]] && [[ $HAS_LB != "{}" ]]; then
-      break
-    fi
-    sleep 3
-
-    if [[ $COUNT -gt 200 ]]; then
-        echo "waiting too long for ingress to be available, exit with error..."
-        ./kind_helper.py -c 'get ingresses test-echo-server -n default -o json'
-        ./kind_helper.py -c 'get get pods -n default'
-        exit 1
-    fi
-    ((COUNT+=1))
-done
-
 ./kind_helper.py -c 'get ingresses test-echo-server -n default -o yaml'
 
 RESPONSE=$(curl -k -v https://localhost:${EXTERNAL_PORT}/test-echo-server)
@@ -28,29 +28,28 @@ docker_tag() {
 # the same with long options
 ./kind_helper.py --start --masters 1 --workers 3 --timeout 120 --ingress ${EXTERNAL_PORT}:80 --verbose --registry-port ${REGISTRY_PORT}
 
+# cpu, memory, io and pressure of the nodes while the test runs; the summary is shown on cleanup
+./kind_helper.py --monitor ./test-with-ingress-monitor.csv &
+MONITOR_PID=$!
+
 cleanup() {
     echo "*** cleanup ***"
     set +e
-    ./kind_helper.py -c 'version'
-    ./kind_helper.py -c 'get events'
-    ./kind_helper.py -c 'get ing'
-    ./kind_helper.py -c 'get deployment'
-
-    ./kind_helper.py -c 'get ing test-echo-server'
-    ./kind_helper.py -c 'describe ing test-echo-server'
-    ./kind_helper.py -c 'get deployment test-echo-server'
-    ./kind_helper.py -c 'get pods -l test-echo-server'
-    ./kind_helper.py -c 'get logs -l test-echo-server'
-    for n in $(./kind_helper.py -c 'get ns' | grep Active |  awk '{print $1;}'); do
-        echo "namespace $n"
-        ./kind_helper.py -c 'get pods -n '$n
-        if [[ $n == "default" ]] || [[ $n == "ingress-nginx" ]]; then
-
-            for p in $(./kind_helper.py -c "get pods -n $n -o jsonpath=\"{range .items[*]}{' '}{.metadata.name}{end}\""); do
-                ./kind_helper.py -c "describe pod -n $n $p"
-            done
-        fi
-    done
+    kill $MONITOR_PID
+    wait $MONITOR_PID
+    ./kind_helper.py --kubectl-batch - <<EOF
+version
+get events
+get ing
+get deployment
+get ing test-echo-server
+describe ing test-echo-server
+get deployment test-echo-server
+get pods -l test-echo-server
+get logs -l test-echo-server
+EOF
+    # objects, describe output, container and node logs of the cluster, in one archive
+    ./kind_helper.py --diagnostics ./test-with-ingress-diagnostics.tar.gz
 
     # kill the cluster on exit
     if [[ $STOP_CLUSTER_ON_EXIT != "" ]]; then
@@ -99,42 +98,15 @@ docker_tag aaa/mm/kind-test-pod localhost:${REGISTRY_PORT}/kind-test-pod
 sed -e s/PORTNUM/${REGISTRY_PORT}/ test/deployment.yaml >test/deployment-port.yaml
 
 # create pod in registry that refers to kind registry
-./kind_helper.py -c 'create -f test/service_account.yaml'
-./kind_helper.py -c 'create -f test/role.yaml'
-./kind_helper.py -c 'create -f test/role_binding.yaml'  
-./kind_helper.py -c 'create -f test/deployment-port.yaml'
-./kind_helper.py -c 'create -f test/service.yaml' 
-./kind_helper.py -c 'create -f test/ingress.yaml'
-
-./kind_helper.py -c 'wait -f test/deployment.yaml --for condition=available'
+# applies the objects in dependency order, waits for the deployment to be available
+# and for the ingress to be attached to the load balancer
+./kind_helper.py --apply test/service_account.yaml test/role.yaml test/role_binding.yaml \
+    test/deployment-port.yaml test/service.yaml test/ingress.yaml --timeout 600
 
-echo "*** deployment available ***"
+echo "*** deployment available, ingress attached to the load balancer ***"
 
 ./kind_helper.py -c 'get pods -o wide'
 
-
-echo "*** wait for ingress object to be active (be attached to load balancer) ***"
-
-COUNT=0
-while [[ true ]]; do
-
-
-    HAS_LB=$(./kind_helper.py -c 'get ingresses test-echo-server -n default -o json' | jq .status.loadBalancer.ingress)
-    echo "${HAS_LB}"
-    if [[ $HAS_LB != "null" ]] && [[ $HAS_LB != "{}" ]]; then
-      break
-    fi
-    sleep 3
-
-    if [[ $COUNT -gt 200 ]]; then
-        echo "waiting too long for ingress to be available, exit with error..."
-        ./kind_helper.py -c 'get ingresses test-echo-server -n default -o json'
-
-       exit 1
-    fi
-    ((COUNT+=1))
-done
-
 ./kind_helper.py -c 'get ingresses test-echo-server -n default -o yaml'
 
 RESPONSE=$(curl  http://localhost:${EXTERNAL_PORT}/test-echo-server)
@@ -147,5 +119,8 @@ if [[ $HAS_RESPONSE != 1 ]]; then
     exit 1
 fi
 
+# what the host port mapping and the ingress controller sustain, with keep-alive connections
+./bench/ingress_load.py --url http://localhost:${EXTERNAL_PORT}/test-echo-server --connections 16 --duration 5
+
 echo "*** test completed ***"
 